@@ -0,0 +1,6 @@
+"""
+DATCHK
+A command line datfile parser and rom validator written in python.
+
+Written By: Daws
+"""
@@ -0,0 +1,198 @@
+"""
+DATCHK
+A command line datfile parser and rom validator written in python.
+
+Written By: Daws
+"""
+
+from .generate import generate_roms, write_corpus, write_dat
+from .suite import (
+    STARTUP_BUDGET,
+    BenchmarkSuite,
+    compare_results,
+    load_results,
+    save_results,
+)
+
+from pathlib import Path
+from rich.align import Align
+from rich.console import Console
+from rich.table import Table
+import argparse
+import json
+import sys
+import tempfile
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        prog="python -m benchmarks", description="Benchmark datchk"
+    )
+    parser.add_argument(
+        "--entries",
+        type=int,
+        default=10000,
+        help="Number of entries in the generated datfile",
+        metavar="N",
+    )
+    parser.add_argument(
+        "--files",
+        type=int,
+        default=200,
+        help="Number of files in the generated corpus",
+        metavar="N",
+    )
+    parser.add_argument(
+        "--repeat", type=int, default=3, help="Runs of each benchmark", metavar="N"
+    )
+    parser.add_argument(
+        "--seed", type=int, default=0, help="Seed for the generated data", metavar="N"
+    )
+    parser.add_argument(
+        "--workdir",
+        help="Keep the generated datfile and corpus here, reused if present",
+        metavar="PATH",
+    )
+    parser.add_argument(
+        "-o", "--output", help="Write results to a JSON file", metavar="PATH"
+    )
+    parser.add_argument(
+        "--compare", help="Compare with a previous results file", metavar="PATH"
+    )
+    parser.add_argument(
+        "--threshold",
+        type=float,
+        default=0.10,
+        help="Slowdown flagged as a regression, 0.10 is 10%%",
+        metavar="RATIO",
+    )
+    parser.add_argument(
+        "--startup-budget",
+        type=float,
+        default=STARTUP_BUDGET,
+        help="Seconds datchk --help may take to print, flagged when exceeded",
+        metavar="SECONDS",
+    )
+    args = parser.parse_args()
+
+    if args.entries < 1 or args.files < 0 or args.repeat < 1:
+        print("[ERROR] --entries and --repeat must be at least 1\nQuitting ..")
+        exit()
+    # Every file in the corpus needs an entry to be generated from
+    args.files = min(args.files, args.entries)
+    return args
+
+
+def prepare(workdir: Path, args, console: Console) -> tuple:
+    """
+    Generates the datfile and corpus, a workdir with the same parameters is
+    reused so repeated runs don't pay for the generation again. The number
+    of files with each outcome is saved with them.
+    """
+    name = f"bench-{args.entries}-{args.files}-{args.seed}"
+    datfile = workdir / f"{name}.dat"
+    corpus = workdir / name
+    outcomes = workdir / f"{name}.json"
+
+    if datfile.exists() and corpus.exists() and outcomes.exists():
+        return datfile, corpus, json.loads(outcomes.read_text())
+
+    console.print(
+        f"[*] Generating {args.entries} entries and {args.files} files..",
+        style="bold yellow",
+    )
+    roms = generate_roms(args.entries, args.files, args.seed)
+    expected = write_corpus(corpus, roms, args.seed)
+    write_dat(datfile, roms)
+    outcomes.write_text(json.dumps(expected))
+    return datfile, corpus, expected
+
+
+def build_results_table(results: dict, comparison: dict) -> Table:
+    table = Table(title="Benchmark Results", show_lines=True)
+    table.add_column("Benchmark")
+    table.add_column("Seconds", justify="right")
+    table.add_column("Throughput", justify="right")
+    if comparison:
+        table.add_column("Baseline", justify="right")
+        table.add_column("Change", justify="right")
+
+    for name, result in results.items():
+        throughput = ""
+        if "bytes_per_second" in result:
+            throughput = f"{result['bytes_per_second'] / (1024 * 1024):.1f} MiB/s"
+        elif "items_per_second" in result:
+            throughput = f"{result['items_per_second']:,.0f}/s"
+
+        row = [name, f"{result['seconds']:.4f}", throughput]
+        if comparison:
+            if name in comparison:
+                old, new, ratio, regressed = comparison[name]
+                color = "red" if regressed else "green"
+                row += [f"{old:.4f}", f"[{color}]{(ratio - 1) * 100:+.1f}%"]
+            else:
+                row += ["", ""]
+        table.add_row(*row)
+
+    return table
+
+
+def main():
+    args = parse_args()
+    console = Console()
+
+    with tempfile.TemporaryDirectory(prefix="datchk-bench-") as tmp:
+        workdir = Path(args.workdir or tmp)
+        workdir.mkdir(parents=True, exist_ok=True)
+        datfile, corpus, expected = prepare(workdir, args, console)
+
+        suite = BenchmarkSuite(
+            datfile, corpus, tmp, args.repeat, args.seed, expected
+        )
+        results = suite.run(console)
+
+    params = {
+        "entries": args.entries,
+        "files": args.files,
+        "repeat": args.repeat,
+        "seed": args.seed,
+    }
+    if args.output:
+        save_results(args.output, params, results)
+
+    comparison = {}
+    if args.compare:
+        baseline = load_results(args.compare)
+        if baseline["params"] != params:
+            console.print(
+                "[!] Baseline was run with different parameters", style="bold red"
+            )
+        comparison = compare_results(baseline, results, args.threshold)
+
+    console.print(Align.center(build_results_table(results, comparison)))
+
+    failed = False
+    startup = results["startup_help"]["seconds"]
+    if startup > args.startup_budget:
+        console.print(
+            f"[-] Startup took {startup:.3f}s, over the budget of "
+            f"{args.startup_budget:.3f}s",
+            style="bold red",
+        )
+        failed = True
+
+    regressed = [name for name, c in comparison.items() if c[3]]
+    if regressed:
+        console.print(
+            f"[-] Slower than baseline by more than {args.threshold:.0%}: "
+            f"{', '.join(regressed)}",
+            style="bold red",
+        )
+        failed = True
+
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,168 @@
+"""
+DATCHK
+A command line datfile parser and rom validator written in python.
+
+Written By: Daws
+"""
+
+from dataclasses import dataclass
+from pathlib import Path
+from xml.sax.saxutils import quoteattr
+from zipfile import ZipFile, ZipInfo, ZIP_DEFLATED
+import hashlib
+import random
+import zlib
+
+# Sizes of the generated rom files, most are small like cartridge roms with
+# a few larger ones like disc images
+SMALL_SIZES = (16 * 1024, 256 * 1024)
+LARGE_SIZES = (1024 * 1024, 4 * 1024 * 1024)
+LARGE_EVERY = 20
+
+REGIONS = ["USA", "Europe", "Japan", "World"]
+
+
+@dataclass(slots=True)
+class BenchRom:
+    """
+    A single entry of a synthetic datfile, data is only kept for the entries
+    which have a file in the corpus
+    """
+
+    game: str
+    name: str
+    size: int
+    crc: str
+    md5: str
+    sha1: str
+    sha256: str
+    data: bytes = None
+
+
+def get_game_name(i: int) -> str:
+    return f"Bench Game {i:07d} ({REGIONS[i % len(REGIONS)]})"
+
+
+def make_rom(game: str, data: bytes) -> BenchRom:
+    return BenchRom(
+        game=game,
+        name=f"{game}.bin",
+        size=len(data),
+        crc=f"{zlib.crc32(data):08x}",
+        md5=hashlib.md5(data).hexdigest(),
+        sha1=hashlib.sha1(data).hexdigest(),
+        sha256=hashlib.sha256(data).hexdigest(),
+        data=data,
+    )
+
+
+def make_filler_rom(game: str, rng: random.Random) -> BenchRom:
+    # Entries without a file only need plausible looking digests, hashing
+    # random data for a million entries would dominate the generation time
+    return BenchRom(
+        game=game,
+        name=f"{game}.bin",
+        size=rng.randint(*SMALL_SIZES),
+        crc=f"{rng.getrandbits(32):08x}",
+        md5=f"{rng.getrandbits(128):032x}",
+        sha1=f"{rng.getrandbits(160):040x}",
+        sha256=f"{rng.getrandbits(256):064x}",
+    )
+
+
+def generate_roms(entries: int, files: int, seed: int = 0) -> list:
+    """
+    Returns the entries of a synthetic datfile, the first files entries hold
+    the data for a file in the corpus
+    """
+    rng = random.Random(seed)
+    roms = []
+    for i in range(entries):
+        game = get_game_name(i)
+        if i < files:
+            sizes = LARGE_SIZES if i % LARGE_EVERY == LARGE_EVERY - 1 else SMALL_SIZES
+            roms.append(make_rom(game, rng.randbytes(rng.randint(*sizes))))
+        else:
+            roms.append(make_filler_rom(game, rng))
+
+    return roms
+
+
+def write_dat(path, roms: list) -> Path:
+    """
+    Writes the entries in the same layout as a No-Intro datfile
+    """
+    path = Path(path)
+    with open(path, "w", encoding="utf-8") as f:
+        f.write('<?xml version="1.0"?>\n<datafile>\n')
+        f.write(
+            "\t<header>\n\t\t<name>Datchk Benchmark</name>\n"
+            "\t\t<description>Synthetic datfile</description>\n"
+            "\t\t<version>1</version>\n\t</header>\n"
+        )
+        for rom in roms:
+            f.write(
+                f"\t<game name={quoteattr(rom.game)}>\n"
+                f"\t\t<description>{rom.game}</description>\n"
+                f"\t\t<rom name={quoteattr(rom.name)} size=\"{rom.size}\" "
+                f'crc="{rom.crc}" md5="{rom.md5}" sha1="{rom.sha1}" '
+                f'sha256="{rom.sha256}" status="verified"/>\n'
+                "\t</game>\n"
+            )
+        f.write("</datafile>\n")
+
+    return path
+
+
+def write_zip(path: Path, name: str, data: bytes) -> None:
+    # A fixed timestamp keeps the archive identical between runs
+    info = ZipInfo(name, date_time=(2000, 1, 1, 0, 0, 0))
+    info.compress_type = ZIP_DEFLATED
+    with ZipFile(path, "w") as z:
+        z.writestr(info, data)
+
+
+def write_7z(path: Path, name: str, data: bytes) -> bool:
+    try:
+        import py7zr
+    except ImportError:
+        return False
+
+    with py7zr.SevenZipFile(path, "w") as z:
+        z.writestr(data, name)
+    return True
+
+
+def write_corpus(path, roms: list, seed: int = 0) -> dict:
+    """
+    Writes a file for every entry with data, returns the number of files
+    written for each expected outcome.
+    The mix is fixed by position so every run checks the same files:
+    one in ten is misnamed (PBIN), one in ten is corrupted (FAIL), one in
+    ten is a file which isn't in the datfile (NIDF), and a fifth each are
+    stored in zip and 7z archives.
+    """
+    rng = random.Random(seed)
+    path = Path(path)
+    path.mkdir(parents=True, exist_ok=True)
+    counts = {"PASS": 0, "PBIN": 0, "FAIL": 0, "NIDF": 0}
+
+    for i, rom in enumerate(r for r in roms if r.data is not None):
+        name, data, outcome = rom.name, rom.data, "PASS"
+        if i % 10 == 7:
+            name, outcome = f"Misnamed {i:07d}.bin", "PBIN"
+        elif i % 10 == 8:
+            pos = rng.randrange(len(data))
+            data = data[:pos] + bytes([data[pos] ^ 0xFF]) + data[pos + 1 :]
+            outcome = "FAIL"
+        elif i % 10 == 9:
+            name, data, outcome = f"Unknown {i:07d}.bin", rng.randbytes(1024), "NIDF"
+
+        stem = Path(name).stem
+        if i % 5 == 1:
+            write_zip(path / f"{stem}.zip", name, data)
+        elif not (i % 5 == 3 and write_7z(path / f"{stem}.7z", name, data)):
+            (path / name).write_bytes(data)
+        counts[outcome] += 1
+
+    return counts
@@ -0,0 +1,280 @@
+"""
+DATCHK
+A command line datfile parser and rom validator written in python.
+
+Written By: Daws
+"""
+
+from datchk.arg_handler import ArgHandler
+from datchk.check import Check
+from datchk.dat_handler import DatParser
+from datchk.search import Search
+from datchk.utilities import HashHandler, scan_path
+
+from contextlib import redirect_stdout
+from collections import Counter
+from pathlib import Path
+from rich.console import Console
+from statistics import median
+from time import perf_counter
+import io
+import json
+import os
+import platform
+import random
+import subprocess
+import sys
+
+RESULTS_VERSION = 1
+
+# Number of names and digests looked up by the lookup benchmarks
+LOOKUP_SAMPLE = 10000
+
+# Seconds datchk may take to print its first output, see bench_startup()
+STARTUP_BUDGET = 0.15
+
+REPO_DIR = Path(__file__).resolve().parent.parent
+
+
+def get_check_args(datfile, path, *options) -> ArgHandler:
+    """
+    Parses the command line of a check of a directory, so the benchmarks
+    always run a check with the same options and defaults as datchk -c
+    """
+    return ArgHandler(["-f", str(datfile), "-c", str(path), *options])
+
+
+def time_runs(func, repeat: int) -> list:
+    runs = []
+    for _ in range(repeat):
+        start = perf_counter()
+        func()
+        runs.append(perf_counter() - start)
+    return runs
+
+
+def time_first_output(argv: list, cache_dir=None) -> float:
+    """
+    Runs datchk in a new interpreter and returns the seconds until it
+    writes its first byte of output, which is what a user waits for.
+    With cache_dir, compiled indexes go there instead of the user's cache.
+    """
+    env = None
+    if cache_dir is not None:
+        env = os.environ | {"XDG_CACHE_HOME": str(cache_dir)}
+    start = perf_counter()
+    with subprocess.Popen(
+        [sys.executable, "-m", "datchk", *argv],
+        cwd=REPO_DIR,
+        env=env,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.DEVNULL,
+    ) as proc:
+        proc.stdout.read(1)
+        elapsed = perf_counter() - start
+        proc.stdout.read()
+    return elapsed
+
+
+class BenchmarkSuite:
+    """
+    Times each stage of datchk against a generated datfile and corpus.
+    Every benchmark is run repeat times and the fastest run is used for
+    comparisons, as it is the least affected by other load on the machine.
+    """
+
+    def __init__(
+        self, datfile, corpus, workdir, repeat: int = 3, seed: int = 0, expected=None
+    ):
+        self.datfile = Path(datfile)
+        self.corpus = Path(corpus)
+        # Number of files with each outcome, as returned by write_corpus().
+        # A check which doesn't reproduce them fails the benchmarks, so a
+        # faster but wrong check can't pass as an improvement.
+        self.expected: dict = expected
+        self.workdir = Path(workdir)
+        # datchk run by the benchmarks caches into the workdir, which is a
+        # temporary directory unless --workdir is given
+        self.cache_dir = self.workdir / "cache"
+        self.repeat = repeat
+        self.rng = random.Random(seed)
+        self.results: dict = {}
+        self.dat: DatParser = None
+
+    def add(self, name: str, runs: list, items: int = None, nbytes: int = None):
+        result = {"seconds": min(runs), "median": median(runs), "runs": runs}
+        if items:
+            result["items"] = items
+            result["items_per_second"] = items / min(runs)
+        if nbytes:
+            result["bytes"] = nbytes
+            result["bytes_per_second"] = nbytes / min(runs)
+        self.results[name] = result
+
+    def run(self, console: Console = None) -> dict:
+        for bench in [
+            self.bench_startup,
+            self.bench_parse,
+            self.bench_load_index,
+            self.bench_lookup_name,
+            self.bench_lookup_digest,
+            self.bench_search,
+            self.bench_hash,
+            self.bench_check,
+            self.bench_check_quick,
+        ]:
+            name = bench.__name__.removeprefix("bench_")
+            if console is not None:
+                console.print(f"[*] Running {name}..", style="bold yellow")
+            bench()
+        return self.results
+
+    def bench_startup(self) -> None:
+        # --help only needs the argument parser, a check of a single file
+        # also loads the datfile (from its compiled index after the first run)
+        self.add(
+            "startup_help",
+            [
+                time_first_output(["--help"], self.cache_dir)
+                for _ in range(self.repeat)
+            ],
+        )
+        argv = ["-f", str(self.datfile), "-c", str(next(scan_path(self.corpus)))]
+        time_first_output(argv, self.cache_dir)
+        self.add(
+            "startup_check",
+            [time_first_output(argv, self.cache_dir) for _ in range(self.repeat)],
+        )
+
+    def bench_parse(self) -> None:
+        runs = time_runs(lambda: DatParser(self.datfile, use_index=False), self.repeat)
+        self.dat = DatParser(self.datfile, use_index=False)
+        self.add("parse", runs, items=self.dat.entries)
+
+    def bench_load_index(self) -> None:
+        index_dir = self.workdir / "index"
+        # The first load compiles the index, only loads from it are timed
+        DatParser(self.datfile, index_dir=index_dir)
+        runs = time_runs(lambda: DatParser(self.datfile, index_dir=index_dir), self.repeat)
+        self.add("load_index", runs, items=self.dat.entries)
+
+    def get_sample(self) -> list:
+        count = min(LOOKUP_SAMPLE, len(self.dat.roms))
+        return self.rng.sample(self.dat.roms, count)
+
+    def bench_lookup_name(self) -> None:
+        names = [rom.name for rom in self.get_sample()]
+        # Half of the lookups miss, like a folder with misnamed files
+        names += [f"Missing {i}.bin" for i in range(len(names))]
+
+        def lookup():
+            for name in names:
+                self.dat.find_rom_by_name(name)
+
+        self.add("lookup_name", time_runs(lookup, self.repeat), items=len(names))
+
+    def bench_lookup_digest(self) -> None:
+        sample = self.get_sample()
+
+        def lookup():
+            for rom in sample:
+                self.dat.find_rom_by_digest(rom.md5, "md5", rom.size)
+                self.dat.find_rom_by_digest(rom.sha1, "sha1")
+
+        self.add(
+            "lookup_digest", time_runs(lookup, self.repeat), items=len(sample) * 2
+        )
+
+    def bench_search(self) -> None:
+        search = Search(Console(file=io.StringIO()), self.dat)
+        # show() asks for a selection, only the search itself is timed
+        search.show = lambda: None
+        self.add("search", time_runs(lambda: search.search("Game 00001"), self.repeat))
+
+    def bench_hash(self) -> None:
+        paths = [p for p in scan_path(self.corpus) if Path(p).suffix == ".bin"]
+        nbytes = sum(os.path.getsize(p) for p in paths)
+
+        def hash_files():
+            hasher = HashHandler()
+            for path in paths:
+                hasher.get_digests(path, ["crc", "md5", "sha1", "sha256"])
+
+        self.add("hash", time_runs(hash_files, self.repeat), len(paths), nbytes)
+
+    def run_check(self, *options) -> int:
+        console = Console(file=io.StringIO())
+        with redirect_stdout(io.StringIO()):
+            args = get_check_args(self.datfile, self.corpus, *options)
+            chk = Check(console, self.dat, args)
+            chk.check()
+        self.check_outcomes(chk, options)
+        return chk.rom_count
+
+    def check_outcomes(self, chk: Check, options) -> None:
+        if self.expected is None:
+            return
+        outcomes = Counter(chk.results_count, PASS=chk.results_passed)
+        if +outcomes != +Counter(self.expected):
+            print(
+                f"[ERROR] Check with {' '.join(['-c', *options])} found {dict(outcomes)}, "
+                f"expected {self.expected}\nQuitting .."
+            )
+            sys.exit(1)
+
+    def bench_check(self) -> None:
+        runs = time_runs(self.run_check, self.repeat)
+        self.add("check", runs, items=self.run_check())
+
+    def bench_check_quick(self) -> None:
+        runs = time_runs(lambda: self.run_check("--quick"), self.repeat)
+        self.add("check_quick", runs, items=self.run_check("--quick"))
+
+
+def get_environment() -> dict:
+    return {
+        "python": platform.python_version(),
+        "implementation": platform.python_implementation(),
+        "platform": platform.platform(),
+        "machine": platform.machine(),
+        "cpus": os.cpu_count(),
+        "argv": sys.argv[1:],
+    }
+
+
+def save_results(path, params: dict, results: dict) -> None:
+    data = {
+        "version": RESULTS_VERSION,
+        "environment": get_environment(),
+        "params": params,
+        "results": results,
+    }
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(data, f, indent=2)
+
+
+def load_results(path) -> dict:
+    with open(path, encoding="utf-8") as f:
+        data = json.load(f)
+
+    if data.get("version") != RESULTS_VERSION:
+        print(f"[ERROR] Unsupported benchmark results file: {path}\nQuitting ..")
+        exit()
+    return data
+
+
+def compare_results(baseline: dict, results: dict, threshold: float) -> dict:
+    """
+    Returns {name:(baseline_seconds, seconds, ratio, regressed)} for every
+    benchmark in both runs, a benchmark regressed when it got slower by
+    more than threshold (0.1 is 10%)
+    """
+    comparison = {}
+    for name, result in results.items():
+        if name not in baseline["results"]:
+            continue
+        old = baseline["results"][name]["seconds"]
+        new = result["seconds"]
+        ratio = new / old if old > 0 else 1.0
+        comparison[name] = (old, new, ratio, ratio > 1 + threshold)
+    return comparison
@@ -4,3 +4,27 @@ A command line datfile parser and rom validator written in python.
 
 Written By: Daws
 """
+
+# The library API is imported on first use, so `python -m datchk` and
+# importing a single submodule don't load it
+_EXPORTS = {
+    "Checker": "api",
+    "load_dat": "api",
+    "RomResult": "engine",
+    "Rom": "dat_handler",
+    "DatParser": "dat_handler",
+    "DatSet": "dat_handler",
+    "DatfileError": "dat_handler",
+    "get_record": "output",
+    "scan_path": "utilities",
+}
+
+__all__ = list(_EXPORTS)
+
+
+def __getattr__(name: str):
+    if name not in _EXPORTS:
+        raise AttributeError(f"module 'datchk' has no attribute {name!r}")
+    from importlib import import_module
+
+    return getattr(import_module(f".{_EXPORTS[name]}", __name__), name)
@@ -6,23 +6,53 @@ Written By: Daws
 """
 
 from .arg_handler import ArgHandler
-from .check import Check
-from .dat_handler import DatParser
-from .search import Search
-from rich.console import Console
 
-args = ArgHandler()
-console = Console()
-dat = DatParser(args.datfile)
+import sys
 
 
-def main():
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    if argv[:1] == ["serve"]:
+        from .daemon import serve_main
+
+        return serve_main(argv[1:])
+    if argv[:1] == ["client"]:
+        from .daemon import client_main
+
+        return client_main(argv[1:])
+    if argv[:1] == ["merge"]:
+        from .merge import merge_main
+
+        return merge_main(argv[1:])
+
+    # Everything past argument parsing is imported when it is needed, so
+    # --help and argument errors don't pay for rich, py7zr or the datfile
+    args = ArgHandler(argv)
+    if not (args.check or args.search or args.debug):
+        return
+
+    from .dat_handler import DatfileError, load_dats
+    from rich.console import Console
+
+    console = Console()
+    try:
+        dat = load_dats(args.datfiles, args.index_dir, args.use_index)
+    except DatfileError as e:
+        print(f"[ERROR] {e}\nQuitting ..")
+        exit()
+
+    if args.debug:
+        dat.print_load_stats()
 
     if args.check:
+        from .check import Check
+
         chk = Check(console, dat, args)
         chk.check()
 
     if args.search:
+        from .search import Search
+
         dat_search = Search(console, dat)
         dat_search.search(args.search)
 
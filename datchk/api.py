@@ -0,0 +1,122 @@
+"""
+DATCHK
+A command line datfile parser and rom validator written in python.
+
+Written By: Daws
+"""
+
+from .cache import HashCache
+from .dat_handler import DatParser, load_dats
+from .engine import CheckOptions, iter_results
+from .utilities import find_datfiles
+
+from os.path import abspath
+
+ALGORITHMS = ["md5", "sha1", "sha256"]
+
+
+def load_dat(*paths, index_dir=None, use_index=True) -> DatParser:
+    """
+    Loads one or more datfiles, or directories of datfiles, for checking.
+    The parser is read only once loaded, so one parser can be shared by
+    every Checker and thread in a process.
+    Raises DatfileError for a datfile which can't be parsed.
+    """
+    datfiles = list(
+        dict.fromkeys(
+            abspath(datfile) for path in paths for datfile in find_datfiles(path)
+        )
+    )
+    if not datfiles:
+        raise ValueError("no datfiles were found")
+    return load_dats(datfiles, index_dir, use_index)
+
+
+class Checker:
+    """
+    Checks files against a loaded datfile without any display, argument
+    parsing or module level state. The same checks as `datchk -c` are run,
+    results are yielded as each file is decided.
+
+        dat = load_dat("nes.dat")
+        with Checker(dat, algorithm="sha1", jobs=4) as checker:
+            for result in checker.check(paths):
+                print(result.path, result.ocode)
+
+    A Checker with a hash cache has to be used from the thread which
+    created it, without a cache it can be used from any thread.
+    """
+
+    def __init__(
+        self,
+        dat: DatParser,
+        algorithm: str = "md5",
+        quick: bool = False,
+        jobs: int = 1,
+        processes: bool = False,
+        buffer_size: int = None,
+        use_mmap: bool = False,
+        cache=None,
+        rehash: bool = False,
+        timings: bool = False,
+    ) -> None:
+        if algorithm not in ALGORITHMS:
+            raise ValueError(f"unknown algorithm: {algorithm}")
+        if jobs < 1:
+            raise ValueError("jobs must be at least 1")
+
+        self.dat = dat
+        self.jobs = jobs
+        self.processes = processes
+        self.rehash = rehash
+        self.options = CheckOptions(
+            algorithm=algorithm,
+            quick=quick,
+            buffer_size=buffer_size,
+            use_mmap=use_mmap,
+            profile=timings,
+        )
+        self.cache: HashCache = HashCache(cache) if cache is not None else None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.close()
+
+    def check_files(self, paths):
+        """
+        Yields the list of RomResult of every file in paths, one result for a
+        plain file or one for each member of an archive. With jobs > 1 files
+        are yielded in the order they finish. Paths are read from the
+        iterable as they are needed, so it can be a generator of any length.
+        An OSError reading a file is raised from the generator.
+        """
+        yield from iter_results(
+            self.dat,
+            (abspath(path) for path in paths),
+            self.options,
+            self.jobs,
+            self.processes,
+            self.cache,
+            self.rehash,
+        )
+
+    def check(self, paths):
+        """
+        Yields a RomResult for every file and archive member in paths, see
+        check_files()
+        """
+        for file_results in self.check_files(paths):
+            yield from file_results
+
+    def check_file(self, path) -> list:
+        """
+        Checks a single file, returns its list of RomResult
+        """
+        return next(self.check_files([path]))
+
+    def close(self) -> None:
+        if self.cache is not None:
+            self.cache.close()
+            self.cache = None
@@ -5,6 +5,9 @@ A command line datfile parser and rom validator written in python.
 Written By: Daws
 """
 
+from .output import OUTPUT_FORMATS
+from .utilities import SHARD_METHODS, SYMLINK_POLICIES, find_datfiles
+
 import argparse
 from os.path import isdir, isfile, abspath
 
@@ -21,70 +24,318 @@ class CustomHelpFormatter(argparse.HelpFormatter):
         return ", ".join(action.option_strings) + " " + args_string
 
 
-fmt = lambda prog: CustomHelpFormatter(prog)
-parser = argparse.ArgumentParser(
-    formatter_class=fmt, description="Command line datfile parser and validator"
-)
-parser.add_argument(
-    "path", nargs="?", type=str, help="Path to file or directory", metavar="PATH"
-)
-parser.add_argument("-f", "--file", help="Path to datfile", metavar="PATH")
-parser.add_argument(
-    "-r",
-    "--rename",
-    action="store_true",
-    help="Rename an incorrectly named file with its datfile entry name",
-)
-parser.add_argument(
-    "-c", "--check", action="store_true", help="Validate file or directory of files"
-)
-parser.add_argument(
-    "-a",
-    "--algorithm",
-    help="Set hash algorithm [md5,sha1,sha256]",
-    metavar="ALGORITHM",
-)
-parser.add_argument(
-    "-s", "--search", help="Search datfile with a keyword", metavar="KEYWORD"
-)
-parser.add_argument(
-    "-l",
-    "--live",
-    action="store_true",
-    help="Check operation will use live display",
-)
-parser.add_argument(
-    "-d",
-    "--debug",
-    action="store_true",
-    help="Enable debug logging",
-)
-
-args = parser.parse_args()
+def parse_size(value: str) -> int:
+    """
+    Parses a size in bytes with an optional K, M or G suffix, such as 512K
+    """
+    units = {"K": 1024, "M": 1024**2, "G": 1024**3}
+    value = value.strip().upper().removesuffix("B").removesuffix("I")
+    try:
+        if value and value[-1] in units:
+            size = int(float(value[:-1]) * units[value[-1]])
+        else:
+            size = int(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"invalid size: {value}")
+
+    if size < 1:
+        raise argparse.ArgumentTypeError("size must be at least 1 byte")
+    return size
+
+
+def parse_shard(value: str) -> tuple:
+    """
+    Parses a shard such as 2/4 (the second of four) into (index, count)
+    with a 0 based index
+    """
+    try:
+        index, count = (int(part) for part in value.split("/"))
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"invalid shard: {value}, use I/N")
+
+    if count < 1 or not 1 <= index <= count:
+        raise argparse.ArgumentTypeError(f"invalid shard: {value}, I must be 1 to N")
+    return index - 1, count
+
+
+def build_parser() -> argparse.ArgumentParser:
+    """
+    The parser is only built when the arguments are parsed, so importing
+    this module doesn't parse sys.argv
+    """
+    fmt = lambda prog: CustomHelpFormatter(prog)
+    parser = argparse.ArgumentParser(
+        formatter_class=fmt, description="Command line datfile parser and validator"
+    )
+    parser.add_argument(
+        "path", nargs="?", type=str, help="Path to file or directory", metavar="PATH"
+    )
+    parser.add_argument(
+        "-f",
+        "--file",
+        action="append",
+        help="Path to datfile or a directory of datfiles, can be repeated",
+        metavar="PATH",
+    )
+    parser.add_argument(
+        "-r",
+        "--rename",
+        action="store_true",
+        help="Rename an incorrectly named file with its datfile entry name",
+    )
+    parser.add_argument(
+        "--rename-members",
+        action="store_true",
+        help="With --rename, also rename incorrectly named files inside zip archives",
+    )
+    parser.add_argument(
+        "--dry-run",
+        action="store_true",
+        help="Show what --rename would do without renaming anything",
+    )
+    parser.add_argument(
+        "-c", "--check", action="store_true", help="Validate file or directory of files"
+    )
+    parser.add_argument(
+        "-a",
+        "--algorithm",
+        help="Set hash algorithm [md5,sha1,sha256]",
+        metavar="ALGORITHM",
+    )
+    parser.add_argument(
+        "-s", "--search", help="Search datfile with a keyword", metavar="KEYWORD"
+    )
+    parser.add_argument(
+        "-l",
+        "--live",
+        action="store_true",
+        help="Check operation will use live display",
+    )
+    parser.add_argument(
+        "-R",
+        "--recursive",
+        action="store_true",
+        help="Check files in subdirectories",
+    )
+    parser.add_argument(
+        "--max-depth",
+        type=int,
+        help="Limit how many subdirectories deep a recursive check goes",
+        metavar="N",
+    )
+    parser.add_argument(
+        "--include",
+        action="append",
+        help="Only check files matching a glob pattern, can be repeated",
+        metavar="GLOB",
+    )
+    parser.add_argument(
+        "--exclude",
+        action="append",
+        help="Skip files and directories matching a glob pattern, can be repeated",
+        metavar="GLOB",
+    )
+    parser.add_argument(
+        "--symlinks",
+        choices=SYMLINK_POLICIES,
+        default="files",
+        help="Skip symlinks, follow symlinks to files, or follow all symlinks",
+        metavar="POLICY",
+    )
+    parser.add_argument(
+        "--shard",
+        type=parse_shard,
+        help="Only check shard I of N, so N machines can each check a part",
+        metavar="I/N",
+    )
+    parser.add_argument(
+        "--shard-by",
+        choices=SHARD_METHODS,
+        default="hash",
+        help="Split files by a hash of their path, or into shards of the same size",
+        metavar="METHOD",
+    )
+    parser.add_argument(
+        "-q",
+        "--quick",
+        action="store_true",
+        help="Check files by CRC32 and size, archives are not decompressed",
+    )
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        type=int,
+        default=1,
+        help="Number of files to check in parallel",
+        metavar="N",
+    )
+    parser.add_argument(
+        "--processes",
+        action="store_true",
+        help="Use worker processes instead of threads for --jobs",
+    )
+    parser.add_argument(
+        "--buffer-size",
+        type=parse_size,
+        help="Read buffer size such as 256K or 4M, sized to each file by default",
+        metavar="SIZE",
+    )
+    parser.add_argument(
+        "--mmap",
+        action="store_true",
+        help="Hash files through a memory map instead of reading them",
+    )
+    parser.add_argument(
+        "--prefetch",
+        type=int,
+        default=0,
+        help="Read up to N files ahead on a background thread while hashing",
+        metavar="N",
+    )
+    parser.add_argument(
+        "--prefetch-memory",
+        type=parse_size,
+        default="64M",
+        help="Memory the read ahead files can use, 64M by default",
+        metavar="SIZE",
+    )
+    parser.add_argument(
+        "--cache",
+        help="Path to a hash cache, unchanged files are not hashed again",
+        metavar="PATH",
+    )
+    parser.add_argument(
+        "--rehash",
+        action="store_true",
+        help="Ignore digests in the hash cache and refresh them",
+    )
+    parser.add_argument(
+        "--prune-cache",
+        action="store_true",
+        help="Remove missing files from the hash cache after a check",
+    )
+    parser.add_argument(
+        "--incremental",
+        help="Path to a manifest of the last check, only new, changed or failed files are checked",
+        metavar="PATH",
+    )
+    parser.add_argument(
+        "--watch",
+        action="store_true",
+        help="Keep checking files as they are added or changed after the check",
+    )
+    parser.add_argument(
+        "--watch-interval",
+        type=float,
+        default=2.0,
+        help="Seconds between scans for changed files with --watch",
+        metavar="SECONDS",
+    )
+    parser.add_argument(
+        "--missing",
+        action="store_true",
+        help="Show the games and roms of the datfile which weren't found",
+    )
+    parser.add_argument(
+        "--fixdat",
+        help="Write the missing entries to a datfile, a directory with several datfiles",
+        metavar="PATH",
+    )
+    parser.add_argument(
+        "--output",
+        choices=OUTPUT_FORMATS,
+        help="Write a record for every file as it is checked [ndjson,csv,json]",
+        metavar="FORMAT",
+    )
+    parser.add_argument(
+        "--output-file",
+        help="Path for the --output records",
+        metavar="PATH",
+    )
+    parser.add_argument(
+        "--stats",
+        action="store_true",
+        help="Show phase timings, throughput and the slowest files after a check",
+    )
+    parser.add_argument(
+        "--profile",
+        help="Write phase timings and throughput of a check to a JSON file",
+        metavar="PATH",
+    )
+    parser.add_argument(
+        "--index-dir",
+        help="Directory for compiled datfile indexes",
+        metavar="PATH",
+    )
+    parser.add_argument(
+        "--no-index",
+        action="store_true",
+        help="Always parse the datfile, don't read or write a compiled index",
+    )
+    parser.add_argument(
+        "-d",
+        "--debug",
+        action="store_true",
+        help="Enable debug logging",
+    )
+
+    return parser
 
 
 class ArgHandler:
-    def __init__(self):
+    def __init__(self, argv=None):
+        args = build_parser().parse_args(argv)
         if args.file is not None:
-            self.datfile = abspath(args.file)
+            self.datfiles = [
+                abspath(datfile) for path in args.file for datfile in find_datfiles(path)
+            ]
         else:
-            print("[ERROR] No datfile was provided, use -d or --datfile")
+            print("[ERROR] No datfile was provided, use -f or --file")
             exit()
         self.rename = args.rename
+        self.rename_members = args.rename_members
+        self.dry_run = args.dry_run
         self.check = args.check
         self.debug = args.debug
         self.algorithm = "md5"
         self.search = args.search
         self.live = args.live
+        self.recursive = args.recursive or args.max_depth is not None
+        self.max_depth = args.max_depth
+        self.include = args.include
+        self.exclude = args.exclude
+        self.symlinks = args.symlinks
+        self.shard = args.shard
+        self.shard_by = args.shard_by
+        self.quick = args.quick
+        self.jobs = args.jobs
+        self.processes = args.processes
+        self.buffer_size = args.buffer_size
+        self.mmap = args.mmap
+        self.prefetch = args.prefetch
+        self.prefetch_memory = args.prefetch_memory
+        self.cache = abspath(args.cache) if args.cache else None
+        self.rehash = args.rehash
+        self.prune_cache = args.prune_cache
+        self.incremental = abspath(args.incremental) if args.incremental else None
+        self.watch = args.watch
+        self.watch_interval = args.watch_interval
+        self.missing = args.missing
+        self.fixdat = abspath(args.fixdat) if args.fixdat else None
+        self.output = args.output
+        self.output_file = abspath(args.output_file) if args.output_file else None
+        self.stats = args.stats
+        self.profile = abspath(args.profile) if args.profile else None
+        self.index_dir = abspath(args.index_dir) if args.index_dir else None
+        self.use_index = not args.no_index
         self.path_is_d = False
         self.path_is_f = False
 
-        if args.path:
-            self.path = abspath(args.path)
+        self.path = abspath(args.path) if args.path else None
 
-        self.validate()
+        self.validate(args)
 
-    def validate(self):
+    def validate(self, args):
         # Test for path
         if args.path:
             if isfile(abspath(self.path)):
@@ -95,6 +346,17 @@ class ArgHandler:
                 print("[ERROR] Path is not a valid file or directory\nQuitting ..")
                 exit()
 
+        # Test for datfiles
+        if not self.datfiles:
+            print("[ERROR] No datfiles were found in the given directory\nQuitting ..")
+            exit()
+        for datfile in self.datfiles:
+            if not isfile(datfile):
+                print(f"[ERROR] Datfile not found: {datfile}\nQuitting ..")
+                exit()
+        # A datfile given twice would only shadow its own entries
+        self.datfiles = list(dict.fromkeys(self.datfiles))
+
         # Test for conflicting flags
         if self.check and self.search:
             print(
@@ -102,6 +364,65 @@ class ArgHandler:
             )
             exit()
 
+        if self.max_depth is not None and self.max_depth < 0:
+            print("[ERROR] --max-depth cannot be negative\nQuitting ..")
+            exit()
+
+        # Test for a usable number of workers
+        if self.jobs < 1:
+            print("[ERROR] --jobs must be at least 1\nQuitting ..")
+            exit()
+
+        if bool(self.output) != bool(self.output_file):
+            print(
+                "[ERROR] --output and --output-file must be used together\nQuitting .."
+            )
+            exit()
+
+        if self.shard and not self.path_is_d:
+            print("[ERROR] --shard needs a directory to check\nQuitting ..")
+            exit()
+
+        if self.watch and not (self.check and self.path):
+            print("[ERROR] --watch needs --check and a path\nQuitting ..")
+            exit()
+
+        if (self.missing or self.fixdat) and not (self.check and self.path):
+            print("[ERROR] --missing and --fixdat need --check and a path\nQuitting ..")
+            exit()
+
+        if self.rename and not (self.check and self.path):
+            print("[ERROR] --rename needs --check and a path\nQuitting ..")
+            exit()
+
+        if (self.rename_members or self.dry_run) and not self.rename:
+            print("[ERROR] --rename-members and --dry-run need --rename\nQuitting ..")
+            exit()
+
+        # A shard only sees part of the collection, so every entry in the
+        # other shards would be reported missing
+        if (self.missing or self.fixdat) and self.shard:
+            print(
+                "[ERROR] Cannot use --missing or --fixdat with --shard\nQuitting .."
+            )
+            exit()
+
+        if self.watch_interval <= 0:
+            print("[ERROR] --watch-interval must be greater than 0\nQuitting ..")
+            exit()
+
+        if self.prefetch < 0:
+            print("[ERROR] --prefetch cannot be negative\nQuitting ..")
+            exit()
+
+        # Prefetched files are held in memory by this process, so they can't
+        # be handed to worker processes
+        if self.prefetch and self.processes:
+            print(
+                "[ERROR] Cannot use --prefetch and --processes at the same time\nQuitting .."
+            )
+            exit()
+
         # Test for algorithm other than default
         if args.algorithm:
             if args.algorithm in [
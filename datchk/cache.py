@@ -0,0 +1,164 @@
+"""
+DATCHK
+A command line datfile parser and rom validator written in python.
+
+Written By: Daws
+"""
+
+from pathlib import Path
+import os
+import sqlite3
+
+DIGEST_COLUMNS = ["crc", "md5", "sha1", "sha256"]
+
+# Number of writes between commits, so a large run isn't committing per file
+# but an interrupted run still keeps most of its work
+COMMIT_INTERVAL = 500
+
+
+def get_file_identity(path) -> tuple:
+    """
+    Returns the (device, inode, size, mtime_ns) of a file. A cached digest is
+    only trusted while all of these are unchanged for the same path.
+    """
+    st = os.stat(path)
+    return (st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns)
+
+
+class HashCache:
+    """
+    SQLite store of file digests keyed by path and file identity.
+    Archives store a row per member, plain files use an empty member name.
+    A member skipped without being decompressed has no digests, only its
+    skipped_size. This is only ever used from the main thread, except for
+    a read_only cache which is only used to look files up from another
+    thread, such as the Prefetcher's.
+    """
+
+    def __init__(self, path, read_only: bool = False) -> None:
+        self.path = path
+        self.pending_writes: int = 0
+        if read_only:
+            # The cache has to be opened normally first, so the table exists
+            self.db = sqlite3.connect(
+                f"{Path(path).resolve().as_uri()}?mode=ro",
+                uri=True,
+                check_same_thread=False,
+            )
+            return
+
+        self.db = sqlite3.connect(path)
+        self.db.execute(
+            """
+            CREATE TABLE IF NOT EXISTS digests (
+                path TEXT NOT NULL,
+                member TEXT NOT NULL DEFAULT '',
+                device INTEGER NOT NULL,
+                inode INTEGER NOT NULL,
+                size INTEGER NOT NULL,
+                mtime_ns INTEGER NOT NULL,
+                crc TEXT,
+                md5 TEXT,
+                sha1 TEXT,
+                sha256 TEXT,
+                skipped_size INTEGER,
+                PRIMARY KEY (path, member)
+            )
+            """
+        )
+        # Caches written before members could be skipped don't have the column
+        columns = [row[1] for row in self.db.execute("PRAGMA table_info(digests)")]
+        if "skipped_size" not in columns:
+            self.db.execute("ALTER TABLE digests ADD COLUMN skipped_size INTEGER")
+        self.db.commit()
+
+    def get(self, path, identity: tuple) -> dict:
+        """
+        Returns the cached digests for a file in the form
+        {member:{algo:digest}}, or None if the file is unknown or has changed
+        """
+        rows = self.db.execute(
+            f"""
+            SELECT member, device, inode, size, mtime_ns, {", ".join(DIGEST_COLUMNS)},
+            skipped_size FROM digests WHERE path = ?
+            """,
+            (str(path),),
+        ).fetchall()
+
+        if not rows or any(tuple(row[1:5]) != identity for row in rows):
+            return None
+
+        members = {}
+        for row in rows:
+            if row[-1] is not None:
+                members[row[0]] = {"skipped_size": row[-1]}
+                continue
+            members[row[0]] = {
+                algo: digest
+                for algo, digest in zip(DIGEST_COLUMNS, row[5:])
+                if digest is not None
+            }
+        return members
+
+    def put(self, path, identity: tuple, members: dict) -> None:
+        """
+        Replaces the cached digests for a file, members is in the same
+        {member:{algo:digest}} form returned by get()
+        """
+        self.db.execute("DELETE FROM digests WHERE path = ?", (str(path),))
+        self.db.executemany(
+            "INSERT INTO digests VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            [
+                (str(path), member, *identity)
+                + tuple(digests.get(algo) for algo in DIGEST_COLUMNS)
+                + (digests.get("skipped_size"),)
+                for member, digests in members.items()
+            ],
+        )
+
+        self.pending_writes += 1
+        if self.pending_writes >= COMMIT_INTERVAL:
+            self.commit()
+
+    def rename(self, moves: list) -> None:
+        """
+        Moves the digests of renamed files to their new paths, moves is a
+        list of (old, new) paths. A rename keeps the inode and mtime, so the
+        digests stay valid. Every row is read before any is written back, as
+        files may have swapped names.
+        """
+        rows = []
+        for old, new in moves:
+            rows += [
+                (str(new), *row[1:])
+                for row in self.db.execute(
+                    "SELECT * FROM digests WHERE path = ?", (str(old),)
+                )
+            ]
+        self.db.executemany(
+            "DELETE FROM digests WHERE path = ?", [(str(old),) for old, _ in moves]
+        )
+        self.db.executemany(
+            "INSERT OR REPLACE INTO digests VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            rows,
+        )
+        self.commit()
+
+    def prune(self) -> int:
+        """
+        Removes entries for files which no longer exist, returns the number
+        of files removed from the cache
+        """
+        paths = [row[0] for row in self.db.execute("SELECT DISTINCT path FROM digests")]
+        missing = [(p,) for p in paths if not os.path.isfile(p)]
+        self.db.executemany("DELETE FROM digests WHERE path = ?", missing)
+        self.commit()
+        return len(missing)
+
+    def commit(self) -> None:
+        self.db.commit()
+        self.pending_writes = 0
+
+    def close(self) -> None:
+        self.commit()
+        self.db.close()
@@ -1,12 +1,25 @@
-from .utilities import HashHandler, extract_archive
+from .cache import HashCache, get_file_identity
+from .engine import CheckOptions, RomResult, is_read_needed, iter_results
+from .manifest import Manifest, get_settings
+from .missing import HAVE_CODES, MissingReport, get_entry_key
+from .output import ResultWriter, open_writer
+from .pipeline import Prefetcher
+from .rename import RenamePlan, get_rename
+from .report import Report
+from .stats import CheckStats, format_rate
+from .utilities import HashHandler, scan_path, shard_by_hash, shard_by_size
 
 from collections import Counter
-from os.path import abspath, basename
-from pathlib import Path
+from contextlib import nullcontext
+from os.path import abspath
+from datetime import timedelta
+from time import perf_counter, sleep
 from rich.console import group
 from rich.live import Live
+from rich.markup import escape
 from rich.panel import Panel
 from rich.table import Table, Column
+from rich.tree import Tree
 from rich.align import Align
 from rich.progress import (
     Progress,
@@ -17,42 +30,100 @@ from rich.progress import (
     TimeElapsedColumn,
     SpinnerColumn,
 )
-from tempfile import TemporaryDirectory
 
 import logging
-from rich.logging import RichHandler
+import sqlite3
 
 FORMAT = "%(message)s"
-logging.basicConfig(
-    level="NOTSET", format=FORMAT, datefmt="[%X]", handlers=[RichHandler()]
-)
+
+# Times per second the --live display is redrawn. The display is drawn on
+# its own thread from the counters kept by record(), the check loop never
+# waits for it.
+LIVE_REFRESH_RATE = 10
 
 log = logging.getLogger("rich")
 
 
-class Check:
+def setup_logging() -> None:
+    """
+    Sends the debug log through rich. This only configures the datchk
+    logger, so importing datchk doesn't change logging for anything else.
+    """
+    from rich.logging import RichHandler
+
+    if not log.handlers:
+        handler = RichHandler()
+        handler.setFormatter(logging.Formatter(FORMAT, datefmt="[%X]"))
+        log.addHandler(handler)
+        log.setLevel(logging.NOTSET)
+        log.propagate = False
+
+
+class Check(Report):
     def __init__(self, console, datfile, args):
+        super().__init__(
+            console,
+            datfile.datfiles,
+            base_path=args.path if args.path_is_d else None,
+            # With --output every result is written out as it is decided,
+            # and the per file results are not kept for the report tree
+            keep_results=not args.output,
+        )
         self.args = args
-        self.console = console
         self.dat = datfile
-        self.dat.current_rom_found_match = False
+        if self.args.debug:
+            setup_logging()
         self.roms = self.get_romlist_from_path(
             self.args.path, self.args.path_is_d, self.args.path_is_f
         )
-        self.rom_count = len(self.roms)
-        self.rom_digests = {}
-        self.tmpdir = TemporaryDirectory()
+        # Files are counted in rom_count as the scan streams them into the
+        # check, the total is only known once the scan has finished
+        self.scan_complete: bool = False
         self.hasher = HashHandler()
+        self.options = CheckOptions(
+            algorithm=self.args.algorithm,
+            quick=self.args.quick,
+            buffer_size=self.args.buffer_size,
+            use_mmap=self.args.mmap,
+            profile=bool(self.args.stats or self.args.profile or self.args.output),
+        )
+        self.cache: HashCache = None
+        # Read only connection to the cache for the --prefetch reader thread
+        self.cache_reader: HashCache = None
+        self.cache_hits: int = 0
+        if self.args.cache:
+            self.cache = HashCache(self.args.cache)
+
+        self.manifest: Manifest = None
+        # Files skipped by --incremental and the results they passed with,
+        # these are counted apart as the scan may run on another thread
+        self.unchanged: int = 0
+        self.unchanged_passed: int = 0
+        self.unchanged_dats: Counter = Counter()
+        self.unchanged_have: set = set()
+        if self.args.incremental:
+            settings = get_settings(
+                self.dat.get_key(), self.options.algorithm, self.options.quick
+            )
+            self.manifest = Manifest(self.args.incremental, settings)
 
-        # lookup dicts
-        self.ocode_color_lkup = {
-            "PASS": "green",
-            "FAIL": "red",
-            "CSNA": "yellow",
-            "PBIN": "blue",
-            "NIDF": "magenta",
-        }
+        # (dat, game, name) of every entry found, for --missing and --fixdat
+        self.have: set = None
+        if self.args.missing or self.args.fixdat:
+            self.have = set()
+
+        # Files to give their datfile name with --rename, taken from the PBIN
+        # results so nothing is hashed again
+        self.renames: list = None
+        if self.args.rename:
+            self.renames = []
+
+        self.stats: CheckStats = None
+        if self.args.stats or self.args.profile:
+            self.stats = CheckStats()
+            self.stats.phases["parse"] = self.dat.parse_time
 
+        # lookup dicts
         self.status_color_lkup = {
             "Waiting": "yellow",
             "Processing": "blue",
@@ -60,19 +131,13 @@ class Check:
         }
 
         # Current State
-        # self.current_status = "Waiting"
-        self.md5: str = None
+        # Per-file state lives on the RomResult returned by each check worker,
+        # only the last completed file is kept here for the display
         self.current_rom_filename: str = ""
-        self.current_rom_filesize: int = 0
-        self.is_archive: bool
-        self.archive_filename: str
+        self.files_done: int = 0
+        self.started: float = None
 
-        # Results
-        self.results: dict = {}
-        self.results_passed: int = 0
-        self.results_count: dict = None
-        self.pbin_map: dict = {}
-        self.arc_map: dict = {}
+        self.writer: ResultWriter = None
 
         # Progress Bar
         self.progress: Progress = Progress(
@@ -86,131 +151,119 @@ class Check:
             # expand=True,
         )
         self.task_total = self.progress.add_task(
-            "[green]Total...", total=self.rom_count, filename=""
+            "[green]Total...", total=None, filename=""
         )
 
-    def get_romlist_from_path(self, path: str, is_dir: bool, is_file: bool) -> list:
+    def get_romlist_from_path(self, path: str, is_dir: bool, is_file: bool):
         if is_dir:
-            return [p for p in Path(path).iterdir() if p.is_file()]
+            roms = scan_path(
+                path,
+                recursive=self.args.recursive,
+                include=self.args.include,
+                exclude=self.args.exclude,
+                max_depth=self.args.max_depth,
+                symlinks=self.args.symlinks,
+            )
+            if self.args.shard is None:
+                return roms
+            index, count = self.args.shard
+            if self.args.shard_by == "size":
+                return shard_by_size(roms, index, count, path)
+            return shard_by_hash(roms, index, count, path)
         if is_file:
             return [abspath(path)]
 
-    def update_rom_digests(self) -> None:
-        self.rom_digests = {
-            "md5": self.dat.current_rom.md5,
-            "sha1": self.dat.current_rom.sha1,
-            "sha256": self.dat.current_rom.sha256,
-        }
-
-    def get_node(self, rom) -> None:
+    def count_roms(self, roms):
         """
-        TODO:
-        Currently if a match can't be found from the filename
-        The file MD5 is calculated and then that digest is used to search the
-        datfile. This is fine if the user is using the default MD5
-        for the entire check, but is adding extra computations
-        if SHA1 or SHA256 is being used as it will calculate
-        the digest for both the MD5 and the users chosen algorithm
-
-        A solution will need to be implemented which can either uses
-        another piece of data from the dat file, filesize+CRC or the
-        digest of the chosen algorithm (if available)
+        Passes paths from the scan through to the check while counting them,
+        the progress total is filled in when the scan finishes
         """
-        self.dat.get_rom_node_from_name_exact(self.current_rom_filename)
-
-        if self.dat.current_rom_found_match:
-            if self.args.debug and not self.args.live:
-                log.info(f"\nFOUND_MATCH_W_NAME:{self.current_rom_filename}")
-            self.update_rom_digests()
-            return
-        else:
-            self.md5 = self.hasher.get_digest(rom, "md5")
-            self.dat.get_rom_node_from_md5(self.md5)
-
-        if self.dat.current_rom_found_match:
-            if self.args.debug and not self.args.live:
-                log.info(f"\nFOUND_MATCH_W_DGST:{self.current_rom_filename}")
-            self.update_rom_digests()
-
-            if not self.rom_digests[self.args.algorithm]:
-                return
-            else:
-                """
-                If we find a match based on the MD5 digest and not the name of the file itself,
-                the file is a valid but the filename is not, so we add to self.results with the
-                PBIN ocode (Passed But Incorrect Name) as the value.
-                For PBIN results we also want to suggest the correct name to the user so the
-                filename is added to self.pbin_map dict with the value of the entry-name contained
-                in the datfile.
-                """
-                if self.args.debug and not self.args.live:
-                    log.warn(f"RESULT_PBIN:{rom}")
-
-                if self.is_archive:
-                    self.results[self.archive_filename] = "PBIN"
-                    self.pbin_map[self.archive_filename] = self.dat.current_rom.name
-                else:
-                    self.results[self.current_rom_filename] = "PBIN"
-                    self.pbin_map[self.current_rom_filename] = self.dat.current_rom.name
-                return
-        else:
-            if self.args.debug and not self.args.live:
-                log.info(f"RESULT_NIDF:{rom}")
+        roms = iter(roms)
+        while True:
+            with self.phase("scan"):
+                rom = next(roms, None)
+            if rom is None:
+                break
+            self.rom_count += 1
+            yield rom
+
+        self.scan_complete = True
+        self.progress.update(self.task_total, total=self.rom_count)
+
+    def skip_unchanged(self, roms):
+        """
+        Passes through only the files which are new, have changed or didn't
+        pass the last check, the others are counted as passed again
+        """
+        for rom in roms:
+            entries = self.manifest.get_unchanged(rom)
+            if entries is None:
+                yield rom
+                continue
+            self.unchanged += 1
+            self.unchanged_passed += len(entries)
+            self.unchanged_dats.update(entry[0] for entry in entries)
+            if self.have is not None:
+                self.unchanged_have.update(entries)
+            self.progress.update(self.task_total, advance=1)
+
+    def record(self, result: RomResult) -> None:
+        """
+        Stores the outcome of a single file, this only runs on the main
+        thread as results are gathered from the check workers
+        """
+        self.current_rom_filename = result.filename
+        self.hasher.read_bytes += result.read_bytes
 
-            if self.is_archive:
-                self.results[self.archive_filename] = "NIDF"
-            else:
-                self.results[self.current_rom_filename] = "NIDF"
-            return
+        if self.args.debug and not self.args.live:
+            if result.archive is not None:
+                log.warn(
+                    f"\nARCHIVE_DETECTED: Archive Name:{result.archive}\nCompressed Filename:{result.filename}"
+                )
+            if result.matched_by == "name":
+                log.info(f"\nFOUND_MATCH_W_NAME:{result.filename}")
+            elif result.matched_by is not None:
+                log.info(f"\nFOUND_MATCH_W_DGST:{result.filename}")
 
-    def compare(self, rom, checksum) -> None:
-        # TODO: This needs some refactoring
-        if checksum is not None:
-            if self.md5 and self.args.algorithm == "md5":
-                if self.md5 == checksum:
-                    if self.args.debug and not self.args.live:
-                        log.info(f"RESULT_PASS:{rom}")
-                    self.results_passed += 1
-                else:
-                    if self.args.debug and not self.args.live:
-                        log.info(f"RESULT_FAIL:{rom}")
-                    if self.is_archive:
-                        self.results[self.archive_filename] = "FAIL"
-                    else:
-                        self.results[self.current_rom_filename] = "FAIL"
-                return
-            else:
-                if self.hasher.compare_checksum(rom, checksum, self.args.algorithm):
-                    if self.args.debug and not self.args.live:
-                        log.info(f"RESULT_PASS:{rom}")
-                    self.results_passed += 1
-                else:
-                    if self.args.debug and not self.args.live:
-                        log.info(f"RESULT_FAIL:{rom}")
-                    if self.is_archive:
-                        self.results[self.archive_filename] = "FAIL"
-                    else:
-                        self.results[self.current_rom_filename] = "FAIL"
-                return
-        else:
-            if self.args.debug and not self.args.live:
-                log.info(f"RESULT_CSNA:{rom}")
-            if self.is_archive:
-                self.results[self.archive_filename] = "CSNA"
+            if result.ocode == "PBIN":
+                log.warn(f"RESULT_PBIN:{result.path}")
             else:
-                self.results[self.current_rom_filename] = "CSNA"
-            return
-
-    def validate(self, rom) -> None:
-        self.compare(rom, self.rom_digests[self.args.algorithm])
+                log.info(f"RESULT_{result.ocode}:{result.path}")
+
+        if self.writer is not None:
+            self.writer.write(result)
+        if self.have is not None and result.ocode in HAVE_CODES:
+            self.have.add(get_entry_key(result.rom))
+        if self.renames is not None and result.ocode == "PBIN":
+            self.renames.append(get_rename(result))
+
+        self.add_result(result)
+
+    def record_file(self, file_results: list, identity: tuple = None) -> None:
+        for result in file_results:
+            self.record(result)
+        self.cache_hits += file_results[0].cached
+        if self.manifest is not None:
+            self.manifest.put(file_results, identity)
+        if self.stats is not None:
+            self.stats.add_file(file_results)
+
+    def close_cache(self) -> None:
+        self.console.print(
+            f"[*] {self.cache_hits} files verified from the hash cache..",
+            style="bold yellow",
+        )
+        if self.args.prune_cache:
+            pruned = self.cache.prune()
+            self.console.print(
+                f"[*] Pruned {pruned} missing files from the hash cache..",
+                style="bold yellow",
+            )
+        self.cache.close()
+        if self.cache_reader is not None:
+            self.cache_reader.close()
 
     def build_status_table(self):
-        try:
-            self.results_count = Counter(self.results.values())
-        except TypeError as e:
-            log.error(e)
-            self.console.print(f"Dumping results..\n{self.results}")
-            exit()
         table = Table(show_header=False)
         table.add_column("Result")
         table.add_column("Count", width=5, min_width=5, justify="right")
@@ -237,9 +290,31 @@ class Check:
 
         return Align.center(table)
 
+    def get_throughput(self) -> str:
+        """
+        Read rate and estimated time left so far, the estimate is only known
+        once the scan has counted every file
+        """
+        elapsed = perf_counter() - self.started if self.started else 0
+        if not elapsed:
+            return "Read: [bold blue]-[/bold blue]  ETA: [bold blue]-"
+
+        read_rate = format_rate(self.hasher.read_bytes / elapsed, "B")
+        files_rate = self.files_done / elapsed
+        eta = "-"
+        if self.scan_complete and files_rate:
+            remaining = self.rom_count - self.files_done - self.unchanged
+            eta = str(timedelta(seconds=round(max(remaining, 0) / files_rate)))
+        return (
+            f"Read: [bold blue]{read_rate}[/bold blue]  "
+            f"Files: [bold blue]{files_rate:.1f}/s[/bold blue]  "
+            f"ETA: [bold blue]{eta}"
+        )
+
     def build_progress_panel(self):
         table = Table.grid()
         table.add_row(f"Current File: [bold blue]{self.current_rom_filename}")
+        table.add_row(self.get_throughput())
         table.add_row(self.progress)
 
         return Panel(
@@ -258,161 +333,324 @@ class Check:
             padding=(2, 2),
         )
 
+    def phase(self, name: str):
+        if self.stats is None:
+            return nullcontext()
+        return self.stats.phase(name)
+
+    def prefetch(self, roms):
+        """
+        Wraps the files to check in a Prefetcher when --prefetch is set, so
+        the next files are read while the current one is hashed
+        """
+        if not self.args.prefetch:
+            return nullcontext(roms)
+        return Prefetcher(
+            roms,
+            depth=self.args.prefetch,
+            max_memory=self.args.prefetch_memory,
+            chunk_size=self.args.buffer_size,
+            archives=not self.args.quick,
+            skip=self.get_prefetch_skip(),
+        )
+
+    def get_prefetch_skip(self):
+        """
+        Files which the check won't read, as they are ruled out by size or
+        answered by the hash cache, aren't read ahead either. The cache is
+        looked up through a connection of its own, as the Prefetcher calls
+        this on its reader thread.
+        """
+        if self.cache is not None and not self.args.rehash:
+            self.cache_reader = HashCache(self.args.cache, read_only=True)
+
+        def skip(path: str, size: int) -> bool:
+            cached = None
+            try:
+                if self.cache_reader is not None:
+                    cached = self.cache_reader.get(path, get_file_identity(path))
+            except (OSError, sqlite3.Error):
+                return False
+            return not is_read_needed(self.dat, path, size, self.options, cached)
+
+        return skip
+
     @group()
     def get_panels(self):
         yield self.build_status_table()
         yield self.build_progress_panel()
 
-    def determine_file_or_archive(self, f):
-        return Path(f).suffix in [".zip", ".7z"]
-
     def check(self) -> None:
         self.console.print("[+] Started check operation..", style="bold yellow")
-        self.console.print(f"[*] Found {len(self.roms)} files..", style="bold yellow")
-
-        check_panel = self.build_check_panel()
+        self.console.print(
+            f"[*] Scanning {self.args.path}..", style="bold yellow"
+        )
 
         if self.args.live:
+            # The panel is rebuilt by the refresh thread, so drawing costs the
+            # same however many files have been checked
             display_mgr = Live(
-                check_panel,
-                refresh_per_second=20,
+                get_renderable=self.build_check_panel,
+                refresh_per_second=LIVE_REFRESH_RATE,
                 screen=True,
             )
         else:
             display_mgr = self.progress
 
-        with display_mgr:
-            self.status = "Processing"
+        if self.args.output:
+            self.writer = open_writer(
+                self.args.output, self.args.output_file, self.base_path
+            )
 
-            for rom in self.roms:
-                # Reset the state
-                self.md5 = None
-                self.dat.current_rom_found_match = False
-                self.is_archive = self.determine_file_or_archive(rom)
-
-                # If a zip or 7z archive is detected from file extension
-                # we set rom to the tmp file path
-                if self.is_archive:
-                    self.archive_filename = basename(rom)
-                    self.current_rom_filename = extract_archive(rom, self.tmpdir)
-                    rom = Path(self.tmpdir.name, self.current_rom_filename)
-                    self.arc_map[self.archive_filename] = self.current_rom_filename
-                    if self.args.debug:
-                        log.warn(
-                            f"\nARCHIVE_DETECTED: Archive Name:{self.archive_filename}\nCompressed Filename:{self.current_rom_filename}"
-                        )
-                else:
-                    self.current_rom_filename = basename(rom)
-
-                check_panel = self.build_check_panel()
-                self.progress.update(
-                    self.task_total, filename=self.current_rom_filename
-                )
-                if self.args.live:
-                    display_mgr.update(check_panel)
+        # The collection is snapshot before the check, so files changed
+        # while it runs are picked up by the first scan of --watch
+        snapshot = self.snapshot() if self.args.watch else None
 
-                self.get_node(rom)
+        roms = self.count_roms(self.roms)
+        if self.manifest is not None:
+            roms = self.skip_unchanged(roms)
 
-                if self.dat.current_rom_found_match:
-                    if self.is_archive:
-                        if self.archive_filename not in self.results.keys():
-                            self.validate(rom)
-                        else:
-                            pass
-                    else:
-                        if self.current_rom_filename not in self.results.keys():
-                            self.validate(rom)
-                        else:
-                            pass
-                else:
-                    pass
+        self.started = perf_counter()
+        with display_mgr, self.prefetch(roms) as roms:
+            self.status = "Processing"
 
-                self.progress.update(self.task_total, advance=1)
+            results = iter_results(
+                self.dat,
+                roms,
+                self.options,
+                self.args.jobs,
+                self.args.processes,
+                self.cache,
+                self.args.rehash,
+            )
+            for file_results in results:
+                self.record_file(file_results)
+                self.files_done += 1
 
-                self.tmpdir.cleanup()
+                with self.phase("render"):
+                    self.progress.update(
+                        self.task_total, filename=self.current_rom_filename, advance=1
+                    )
 
             self.progress.update(self.task_total, filename="Complete!")
 
-        self.show_statistics()
-        self.generate_report_tree()
+        if self.manifest is not None:
+            self.results_passed += self.unchanged_passed
+            if self.have is not None:
+                self.have |= self.unchanged_have
+            for datfile, passed in self.unchanged_dats.items():
+                if datfile in self.dat_counts:
+                    self.dat_counts[datfile]["PASS"] += passed
+            self.console.print(
+                f"[*] {self.unchanged} unchanged files skipped..", style="bold yellow"
+            )
+        if self.renames is not None:
+            self.rename_files()
+        if not self.args.watch:
+            self.close()
+
+        with self.phase("render"):
+            self.show_statistics()
+            if self.keep_results:
+                self.generate_report_tree()
+            if self.have is not None:
+                self.show_missing()
+
+        if self.stats is not None:
+            self.show_profile()
+
+        if self.args.watch:
+            try:
+                self.watch(snapshot)
+            finally:
+                self.close()
+
+    def rename_files(self) -> None:
+        """
+        Gives every PBIN file its datfile name in one batch, or only shows
+        the plan with --dry-run. Files found by --watch aren't renamed.
+        """
+        plan = RenamePlan(self.renames, members=self.args.rename_members)
+        self.renames = None
+
+        self.console.rule("Rename")
+        tree = Tree("Rename", hide_root=True)
+        if plan.applied:
+            branch = tree.add("Would Rename" if self.args.dry_run else "Renamed")
+            for rename in plan.applied:
+                label = self.get_rename_label(rename)
+                if rename.in_cycle:
+                    label += " [bold default](cycle)"
+                branch.add(label)
+        if plan.skipped:
+            branch = tree.add("Skipped")
+            for rename in plan.skipped:
+                branch.add(f"{self.get_rename_label(rename)} [bold default]({rename.reason})")
+        self.console.print(tree)
+
+        if plan.cycles:
+            self.console.print(
+                f"[*] {plan.cycles} groups of files swap names, they are renamed through temporary names..",
+                style="bold yellow",
+            )
+        if self.args.dry_run:
+            self.console.print(
+                f"[*] Dry run, {len(plan.applied)} files would be renamed..",
+                style="bold yellow",
+            )
+            return
 
-    def show_statistics(self):
-        self.console.rule("Statistics")
-        self.results_count = Counter(self.results.values())
-        results_table = Table(show_header=False, show_lines=True)
-        results_table.add_column("Result")
-        results_table.add_column("Count")
+        try:
+            moves = plan.apply()
+        except OSError as e:
+            self.console.print(
+                f"[ERROR] Renaming failed, every file was put back: {e}",
+                style="bold red",
+            )
+            return
+        if self.cache is not None:
+            self.cache.rename(moves)
+        for rename in plan.applied:
+            self.add_renamed(rename.source, rename.dat)
+        self.console.print(
+            f"[*] Renamed {len(plan.applied)} files..", style="bold yellow"
+        )
+
+    def get_rename_label(self, rename) -> str:
+        label = escape(self.get_display_name(rename.path))
+        if rename.member is not None:
+            label = f"(A) {label} -> {escape(rename.member)}"
+        return f"[blue]{label}[/blue] to {escape(rename.new_name)}"
+
+    def show_missing(self) -> None:
+        """
+        Shows which entries of the datfile weren't found, and writes them to
+        a fixdat with --fixdat
+        """
+        missing = MissingReport(self.dat, self.have)
+        self.console.rule("Missing")
+        self.console.print(Align.center(missing.build_summary_table()))
+        if self.args.missing:
+            self.console.print(missing.build_tree())
+        if self.args.fixdat:
+            for path in missing.write_fixdats(self.args.fixdat):
+                self.console.print(
+                    f"[*] Wrote fixdat to {path}..", style="bold yellow"
+                )
+
+    def close(self) -> None:
+        if self.cache is not None:
+            self.close_cache()
+        if self.manifest is not None:
+            self.close_manifest()
+        if self.writer is not None:
+            self.close_writer()
+
+    def close_manifest(self) -> None:
+        pruned = self.manifest.prune()
+        if pruned:
+            self.console.print(
+                f"[*] Removed {pruned} missing files from the manifest..",
+                style="bold yellow",
+            )
+        self.manifest.close()
 
-        results_table.add_row("Processed", f"[bold green]{self.rom_count}")
-        results_table.add_row("Passed", f"[bold green]{self.results_passed}")
-        results_table.add_row(
-            "Passed But Incorrect Name", f"[bold green]{self.results_count['PBIN']}"
+    def snapshot(self) -> dict:
+        """
+        Returns {path:identity} for every file the check would scan
+        """
+        files = {}
+        for path in self.get_romlist_from_path(
+            self.args.path, self.args.path_is_d, self.args.path_is_f
+        ):
+            try:
+                files[path] = get_file_identity(path)
+            except OSError:
+                continue
+        return files
+
+    def watch(self, known: dict) -> None:
+        """
+        Scans the collection every --watch-interval seconds and checks files
+        which are new or changed. A file is only checked once it is the same
+        on two scans in a row, so files still being copied are left alone.
+        """
+        self.console.print(
+            f"[+] Watching {self.args.path} for changes, press Ctrl+C to stop..",
+            style="bold yellow",
         )
-        results_table.add_row("Failed", f"[bold green]{self.results_count['FAIL']}")
-        results_table.add_row(
-            "CheckSum N/A", f"[bold green]{self.results_count['CSNA']}"
+        # {path:identity} of changed files waiting to settle
+        pending = {}
+        try:
+            while True:
+                sleep(self.args.watch_interval)
+                current = self.snapshot()
+
+                settled = []
+                for path, identity in current.items():
+                    if pending.get(path) == identity:
+                        settled.append(path)
+                        del pending[path]
+                    elif known.get(path) != identity:
+                        pending[path] = identity
+
+                for path in known.keys() - current.keys():
+                    pending.pop(path, None)
+                    if self.manifest is not None:
+                        self.manifest.remove(path)
+                    self.console.print(
+                        f"[bold default]GONE[/bold default] {self.get_display_name(path)}"
+                    )
+
+                known = current
+                if settled:
+                    self.check_settled(settled, current)
+        except KeyboardInterrupt:
+            self.console.print("[*] Stopped watching..", style="bold yellow")
+
+    def check_settled(self, paths: list, identities: dict) -> None:
+        results = iter_results(
+            self.dat, paths, self.options, 1, False, self.cache, self.args.rehash
         )
-        results_table.add_row(
-            "Not In DatFile", f"[bold green]{self.results_count['NIDF']}"
+        for file_results in results:
+            self.rom_count += 1
+            self.record_file(file_results, identities.get(file_results[0].path))
+            for result in file_results:
+                label = self.get_display_name(result.path)
+                if result.archive is not None:
+                    label += f" -> {result.filename}"
+                color = self.ocode_color_lkup.get(result.ocode, "default")
+                self.console.print(f"[{color}]{result.ocode}[/{color}] {label}")
+        if self.manifest is not None:
+            self.manifest.commit()
+
+    def close_writer(self) -> None:
+        self.writer.close()
+        self.console.print(
+            f"[*] Wrote {self.writer.count} results to {self.args.output_file}..",
+            style="bold yellow",
         )
 
-        self.console.print(Align.center(results_table))
-
-    def generate_report_tree(self):
-        from rich.tree import Tree
-
-        report_tree = Tree("Warnings and Failures", hide_root=True)
-        no_warnings = False
-
-        if self.results_count["FAIL"] > 0:
-            fail_tree = report_tree.add("Failed")
-        if self.results_count["CSNA"] > 0:
-            csna_tree = report_tree.add("Checksum N/A")
-        if self.results_count["NIDF"] > 0:
-            nidf_tree = report_tree.add("Not In DatFile")
-        if self.results_count["PBIN"] > 0:
-            pbin_tree = report_tree.add("Passed But Incorrect Name")
-        if not self.results_count:
-            no_warnings = True
-
-        for rom_name, ocode in self.results.items():
-            match ocode:
-                case "FAIL":
-                    if self.determine_file_or_archive(rom_name):
-                        fail_tree.add(
-                            f"[bold default](A) [/bold default][{self.ocode_color_lkup[ocode]}]{rom_name}[bold default] -> [/bold default][green]{self.arc_map[rom_name]}"
-                        )
-                    else:
-                        fail_tree.add(f"[{self.ocode_color_lkup[ocode]}]{rom_name}")
-                case "CSNA":
-                    if self.determine_file_or_archive(rom_name):
-                        csna_tree.add(
-                            f"[bold default](A) [/bold default][{self.ocode_color_lkup[ocode]}]{rom_name}[bold default] -> [bold default][green]{self.arc_map[rom_name]}"
-                        )
-                    else:
-                        csna_tree.add(f"[{self.ocode_color_lkup[ocode]}]{rom_name}")
-                case "NIDF":
-                    if self.determine_file_or_archive(rom_name):
-                        nidf_tree.add(
-                            f"[bold default](A) [/bold default][{self.ocode_color_lkup[ocode]}]{rom_name}[bold default] -> [bold default][green]{self.arc_map[rom_name]}"
-                        )
-                    else:
-                        nidf_tree.add(f"[{self.ocode_color_lkup[ocode]}]{rom_name}")
-                case "PBIN":
-                    if self.determine_file_or_archive(rom_name):
-                        branch = pbin_tree.add(
-                            f"[bold default](A) [/bold default][{self.ocode_color_lkup[ocode]}]{rom_name}[bold default] -> [bold default][green]{self.arc_map[rom_name]}"
-                        )
-                    else:
-                        branch = pbin_tree.add(
-                            f"[{self.ocode_color_lkup[ocode]}]{rom_name}"
-                        )
-                    branch.add(f"Suggested Name: [green]{self.pbin_map[rom_name]}")
-
-        if no_warnings:
+    def show_profile(self) -> None:
+        self.stats.finish()
+        if self.args.stats:
+            self.console.rule("Profile")
+            self.console.print(Align.center(self.stats.build_throughput_table()))
+            self.console.print(Align.center(self.stats.build_phase_table()))
+            if self.stats.slowest:
+                self.console.print(Align.center(self.stats.build_slowest_table()))
+
+        if self.args.profile:
+            self.stats.save(
+                self.args.profile,
+                datfiles=self.dat.datfiles,
+                dat_entries=self.dat.entries,
+                dat_from_index=self.dat.loaded_from_index,
+                algorithm=self.options.algorithm,
+                quick=self.options.quick,
+                jobs=self.args.jobs,
+            )
             self.console.print(
-                "[bold green] All files passed, no failures or warnings to report.."
+                f"[*] Saved profile to {self.args.profile}..", style="bold yellow"
             )
-        else:
-            self.console.rule("Warnings and Failures")
-            self.console.print(report_tree)
+
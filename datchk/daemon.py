@@ -0,0 +1,528 @@
+"""
+DATCHK
+A command line datfile parser and rom validator written in python.
+
+Written By: Daws
+"""
+
+from .arg_handler import CustomHelpFormatter
+from .utilities import find_datfiles, scan_path
+
+from dataclasses import asdict
+from os.path import abspath, isdir
+from time import perf_counter, time
+import argparse
+import json
+import os
+import socket
+import socketserver
+import stat
+import threading
+
+DEFAULT_RELOAD_INTERVAL = 2.0
+DEFAULT_SEARCH_LIMIT = 50
+ALGORITHMS = ["md5", "sha1", "sha256"]
+
+
+def get_default_socket_path() -> str:
+    runtime_dir = os.environ.get("XDG_RUNTIME_DIR")
+    if runtime_dir:
+        return os.path.join(runtime_dir, "datchk.sock")
+    return f"/tmp/datchk-{os.getuid()}.sock"
+
+
+class DaemonError(Exception):
+    """
+    Raised by the client when the daemon can't be reached or answers a
+    request with an error
+    """
+
+
+class DatStore:
+    """
+    The datfiles loaded by the daemon. A changed datfile is loaded in the
+    background and swapped in once it is ready, requests already running
+    keep using the parser they started with.
+    """
+
+    def __init__(self, datfiles: list, index_dir=None, use_index=True) -> None:
+        self.datfiles = datfiles
+        self.index_dir = index_dir
+        self.use_index = use_index
+        self.dats: dict = {}
+        self.keys: dict = {}
+        self.lock = threading.Lock()
+        for datfile in datfiles:
+            self.load(datfile)
+
+    def load(self, datfile: str) -> None:
+        from .dat_handler import DatParser, get_datfile_key
+
+        key = get_datfile_key(datfile)
+        dat = DatParser(datfile, self.index_dir, self.use_index)
+        # Built before the parser is swapped in, so no request waits for it
+        dat.get_search_index()
+        with self.lock:
+            self.dats[datfile] = dat
+            self.keys[datfile] = key
+
+    def reload_changed(self) -> list:
+        """
+        Loads any datfile which has changed on disk, returns the datfiles
+        which were reloaded
+        """
+        from .dat_handler import DatfileError, get_datfile_key
+
+        reloaded = []
+        for datfile in self.datfiles:
+            try:
+                if get_datfile_key(datfile) == self.keys[datfile]:
+                    continue
+                self.load(datfile)
+            except OSError:
+                # The datfile is being replaced, try again next time
+                continue
+            except DatfileError:
+                # The previous version of a datfile which can't be parsed
+                # stays loaded
+                continue
+            reloaded.append(datfile)
+        return reloaded
+
+    def select(self, name: str = None) -> list:
+        """
+        Returns the parsers to answer a request with, every datfile or the
+        one matching name by path or file name
+        """
+        with self.lock:
+            dats = list(self.dats.items())
+        if name is None:
+            return dats
+
+        selected = [
+            (datfile, dat)
+            for datfile, dat in dats
+            if name in (datfile, os.path.basename(datfile))
+            or abspath(name) == datfile
+        ]
+        if not selected:
+            raise ValueError(f"unknown datfile: {name}")
+        return selected
+
+
+class Daemon:
+    """
+    Answers check, lookup and search requests from the loaded datfiles.
+    Every handler only reads the parsers, so requests are safe to run on
+    several threads at once.
+    """
+
+    def __init__(self, store: DatStore) -> None:
+        self.store = store
+        self.started = time()
+        # Requests are counted from every handler thread
+        self.requests: int = 0
+        self.requests_lock = threading.Lock()
+
+    def handle(self, request: dict) -> dict:
+        op = request.get("op")
+        handler = getattr(self, f"op_{op}", None)
+        if handler is None:
+            raise ValueError(f"unknown op: {op}")
+        with self.requests_lock:
+            self.requests += 1
+        return handler(request)
+
+    def op_status(self, request: dict) -> dict:
+        return {
+            "pid": os.getpid(),
+            "uptime": time() - self.started,
+            "requests": self.requests,
+            "dats": [
+                {
+                    "datfile": datfile,
+                    "entries": dat.entries,
+                    "roms": len(dat.roms),
+                    "load_time": dat.parse_time,
+                    "from_index": dat.loaded_from_index,
+                }
+                for datfile, dat in self.store.select()
+            ],
+        }
+
+    def op_reload(self, request: dict) -> dict:
+        return {"reloaded": self.store.reload_changed()}
+
+    def op_lookup(self, request: dict) -> list:
+        """
+        Finds entries by name or digest, digests are matched against the
+        algorithm given as algo, crc matches every entry with that CRC32
+        """
+        name = request.get("name")
+        digest = request.get("digest")
+        algo = request.get("algo", "md5")
+        if name is None and digest is None:
+            raise ValueError("lookup needs a name or a digest")
+        if not all(isinstance(value, (str, type(None))) for value in (name, digest)):
+            raise ValueError("name and digest must be strings")
+        if digest is not None and algo not in ALGORITHMS + ["crc"]:
+            raise ValueError(f"unknown algorithm: {algo}")
+
+        entries = []
+        for datfile, dat in self.store.select(request.get("dat")):
+            if name is not None:
+                roms = [dat.find_rom_by_name(name)]
+            elif algo == "crc":
+                roms = dat.get_rom_nodes_from_crc(digest)
+            else:
+                roms = [dat.find_rom_by_digest(digest, algo, request.get("size"))]
+            entries += [asdict(rom) | {"dat": datfile} for rom in roms if rom]
+        return entries
+
+    def op_search(self, request: dict) -> list:
+        query = request.get("query")
+        if not query:
+            raise ValueError("search needs a query")
+        limit = request.get("limit", DEFAULT_SEARCH_LIMIT)
+        # bool is a subclass of int, but true isn't a limit
+        if not isinstance(limit, int) or isinstance(limit, bool) or limit < 0:
+            raise ValueError("limit must be a whole number")
+
+        results = []
+        for datfile, dat in self.store.select(request.get("dat")):
+            positions = dat.get_search_index().search(query, dat.roms)
+            results += [asdict(dat.roms[pos]) | {"dat": datfile} for pos in positions]
+        return results[:limit]
+
+    def op_check(self, request: dict) -> list:
+        """
+        Checks files and directories against every selected datfile. A file
+        is only hashed once, the digests from the first datfile are reused
+        for the others.
+        """
+        from .engine import CheckOptions, check_rom
+        from .output import get_record
+
+        algorithm = request.get("algorithm", "md5")
+        if algorithm not in ALGORITHMS:
+            raise ValueError(f"unknown algorithm: {algorithm}")
+        options = CheckOptions(
+            algorithm=algorithm,
+            quick=bool(request.get("quick")),
+            profile=True,
+        )
+        dats = self.store.select(request.get("dat"))
+
+        records = []
+        for rom_path in self.get_paths(request):
+            known = {}
+            for datfile, dat in dats:
+                results = check_rom(dat, rom_path, options, known)
+                for result in results:
+                    member = result.filename if result.archive is not None else ""
+                    if result.digests:
+                        known[member] = known.get(member, {}) | result.digests
+                    records.append(get_record(result) | {"dat": datfile})
+        return records
+
+    def get_paths(self, request: dict) -> list:
+        paths = request.get("paths")
+        if paths is None:
+            paths = [request.get("path")]
+        if (
+            not isinstance(paths, list)
+            or not paths
+            or not all(isinstance(path, str) for path in paths)
+        ):
+            raise ValueError("check needs a path or a list of paths")
+
+        rom_paths = []
+        for path in paths:
+            # The daemon runs in a different directory to the client, so a
+            # relative path would be looked up in the wrong place
+            if not os.path.isabs(path):
+                raise ValueError(f"path must be absolute: {path}")
+            if isdir(path):
+                rom_paths += scan_path(path, recursive=bool(request.get("recursive")))
+            elif os.path.isfile(path):
+                rom_paths.append(path)
+            else:
+                raise ValueError(f"not a file or directory: {path}")
+        return rom_paths
+
+
+class RequestHandler(socketserver.StreamRequestHandler):
+    """
+    Requests and responses are single lines of JSON, a connection can send
+    any number of requests one after another
+    """
+
+    def handle(self) -> None:
+        for line in self.rfile:
+            if not line.strip():
+                continue
+            response = self.server.answer(line)
+            self.wfile.write(json.dumps(response).encode() + b"\n")
+            self.wfile.flush()
+
+
+class DaemonServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, socket_path: str, daemon: Daemon) -> None:
+        self.daemon = daemon
+        super().__init__(socket_path, RequestHandler)
+
+    def answer(self, line: bytes) -> dict:
+        start = perf_counter()
+        try:
+            request = json.loads(line)
+            if not isinstance(request, dict):
+                raise ValueError("request must be a JSON object")
+        except ValueError as e:
+            return {"ok": False, "error": f"bad request: {e}"}
+
+        response = {"id": request.get("id")}
+        try:
+            response |= {"ok": True, "result": self.daemon.handle(request)}
+        except (ValueError, OSError) as e:
+            response |= {"ok": False, "error": str(e)}
+        except Exception as e:
+            # Any other failure is answered too, so the handler thread and
+            # the client's connection carry on with the next request
+            response |= {"ok": False, "error": f"{type(e).__name__}: {e}"}
+        response["time"] = perf_counter() - start
+        return response
+
+
+def claim_socket(socket_path: str) -> None:
+    """
+    Removes a socket left behind by a daemon which didn't shut down
+    cleanly, but never one which is still answering
+    """
+    try:
+        mode = os.lstat(socket_path).st_mode
+    except FileNotFoundError:
+        return
+    # Anything else at the path is never removed, it isn't ours
+    if not stat.S_ISSOCK(mode):
+        print(
+            f"[ERROR] --socket path exists and is not a socket: {socket_path}\nQuitting .."
+        )
+        exit()
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as s:
+        try:
+            s.connect(socket_path)
+        except OSError:
+            os.unlink(socket_path)
+            return
+    print(f"[ERROR] A daemon is already listening on {socket_path}\nQuitting ..")
+    exit()
+
+
+def watch(store: DatStore, interval: float, stopped: threading.Event, console):
+    while not stopped.wait(interval):
+        for datfile in store.reload_changed():
+            console.print(f"[*] Reloaded {datfile}..", style="bold yellow")
+
+
+def build_serve_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(
+        prog="datchk serve",
+        formatter_class=CustomHelpFormatter,
+        description="Keep datfiles loaded and answer requests on a Unix socket",
+    )
+    parser.add_argument(
+        "-f",
+        "--file",
+        action="append",
+        required=True,
+        help="Path to datfile or a directory of datfiles, can be repeated",
+        metavar="PATH",
+    )
+    parser.add_argument(
+        "--socket",
+        default=get_default_socket_path(),
+        help="Path of the Unix socket to listen on",
+        metavar="PATH",
+    )
+    parser.add_argument(
+        "--reload-interval",
+        type=float,
+        default=DEFAULT_RELOAD_INTERVAL,
+        help="Seconds between checks for changed datfiles, 0 to disable",
+        metavar="SECONDS",
+    )
+    parser.add_argument(
+        "--index-dir",
+        help="Directory for compiled datfile indexes",
+        metavar="PATH",
+    )
+    parser.add_argument(
+        "--no-index",
+        action="store_true",
+        help="Always parse the datfiles, don't read or write compiled indexes",
+    )
+    return parser
+
+
+def serve_main(argv=None) -> None:
+    from rich.console import Console
+
+    args = build_serve_parser().parse_args(argv)
+    console = Console()
+    datfiles = list(
+        dict.fromkeys(
+            abspath(datfile) for path in args.file for datfile in find_datfiles(path)
+        )
+    )
+    if not datfiles:
+        print("[ERROR] No datfiles were found in the given directory\nQuitting ..")
+        exit()
+    for datfile in datfiles:
+        if not os.path.isfile(datfile):
+            print(f"[ERROR] Datfile not found: {datfile}\nQuitting ..")
+            exit()
+
+    from .dat_handler import DatfileError
+
+    claim_socket(args.socket)
+    index_dir = abspath(args.index_dir) if args.index_dir else None
+    try:
+        store = DatStore(datfiles, index_dir, not args.no_index)
+    except DatfileError as e:
+        print(f"[ERROR] {e}\nQuitting ..")
+        exit()
+    for datfile, dat in store.select():
+        dat.print_load_stats()
+
+    stopped = threading.Event()
+    if args.reload_interval > 0:
+        threading.Thread(
+            target=watch,
+            args=(store, args.reload_interval, stopped, console),
+            daemon=True,
+        ).start()
+
+    server = DaemonServer(args.socket, Daemon(store))
+    console.print(f"[+] Listening on {args.socket}..", style="bold yellow")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        stopped.set()
+        server.server_close()
+        if os.path.exists(args.socket):
+            os.unlink(args.socket)
+
+
+class Client:
+    """
+    Thin client for the daemon, keeps one connection open for any number
+    of requests
+    """
+
+    def __init__(self, socket_path: str = None) -> None:
+        self.socket_path = socket_path or get_default_socket_path()
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            self.sock.connect(self.socket_path)
+        except OSError as e:
+            self.sock.close()
+            raise DaemonError(f"can't connect to {self.socket_path}: {e}")
+        self.rfile = self.sock.makefile("rb")
+        self.next_id: int = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.close()
+
+    def request(self, op: str, **params):
+        self.next_id += 1
+        request = {"id": self.next_id, "op": op} | params
+        self.sock.sendall(json.dumps(request).encode() + b"\n")
+        line = self.rfile.readline()
+        if not line:
+            raise DaemonError("the daemon closed the connection")
+
+        response = json.loads(line)
+        if not response.get("ok"):
+            raise DaemonError(response.get("error"))
+        return response["result"]
+
+    def check(self, paths: list, **params) -> list:
+        # Relative paths are relative to the client, not the daemon
+        return self.request("check", paths=[abspath(path) for path in paths], **params)
+
+    def lookup(self, **params) -> list:
+        return self.request("lookup", **params)
+
+    def search(self, query: str, **params) -> list:
+        return self.request("search", query=query, **params)
+
+    def close(self) -> None:
+        self.rfile.close()
+        self.sock.close()
+
+
+def build_client_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(
+        prog="datchk client",
+        formatter_class=CustomHelpFormatter,
+        description="Send a request to a running datchk daemon",
+    )
+    parser.add_argument(
+        "--socket",
+        default=get_default_socket_path(),
+        help="Path of the daemon's Unix socket",
+        metavar="PATH",
+    )
+    parser.add_argument(
+        "--dat", help="Only use the datfile with this path or name", metavar="NAME"
+    )
+    ops = parser.add_subparsers(dest="op", required=True, metavar="OP")
+
+    check = ops.add_parser("check", help="Check files or directories")
+    check.add_argument("paths", nargs="+", metavar="PATH")
+    check.add_argument("-a", "--algorithm", default="md5", choices=ALGORITHMS)
+    check.add_argument("-q", "--quick", action="store_true")
+    check.add_argument("-R", "--recursive", action="store_true")
+
+    lookup = ops.add_parser("lookup", help="Find entries by name or digest")
+    lookup.add_argument("--name", metavar="NAME")
+    lookup.add_argument("--digest", metavar="DIGEST")
+    lookup.add_argument("-a", "--algo", default="md5", choices=ALGORITHMS + ["crc"])
+
+    search = ops.add_parser("search", help="Search entry names with keywords")
+    search.add_argument("query", metavar="KEYWORDS")
+    search.add_argument("--limit", type=int, default=DEFAULT_SEARCH_LIMIT)
+
+    ops.add_parser("status", help="Show the loaded datfiles")
+    ops.add_parser("reload", help="Reload datfiles which have changed")
+    return parser
+
+
+def client_main(argv=None) -> None:
+    """
+    Prints the result of a request as JSON, one line per record for
+    requests which return a list
+    """
+    args = build_client_parser().parse_args(argv)
+    params = {k: v for k, v in vars(args).items() if k not in ("socket", "op")}
+    params = {k: v for k, v in params.items() if v is not None}
+
+    try:
+        with Client(args.socket) as client:
+            if args.op == "check":
+                result = client.check(params.pop("paths"), **params)
+            else:
+                result = client.request(args.op, **params)
+    except DaemonError as e:
+        print(f"[ERROR] {e}\nQuitting ..")
+        exit(1)
+
+    for record in result if isinstance(result, list) else [result]:
+        print(json.dumps(record))
@@ -5,14 +5,22 @@ A command line datfile parser and rom validator written in python.
 Written By: Daws
 """
 
-from dataclasses import dataclass
+from .search_index import SearchIndex
+
+from dataclasses import dataclass, fields
+from itertools import islice
 from pathlib import Path
-from rich.console import Console
-from rich.table import Table
+from time import perf_counter
+import gc
+import hashlib
+import marshal
+import mmap
+import os
+import sys
 import xml.etree.ElementTree as xml
 
 
-@dataclass
+@dataclass(slots=True)
 class Rom:
     name: str
     size: str
@@ -22,91 +30,490 @@ class Rom:
     sha256: str
     serial: str
     status: str
+    game: str = None
+    # Path of the datfile the entry came from, it isn't stored in the
+    # compiled index as it is the same for every entry
+    dat: str = None
+
+
+# Attributes of a Rom saved in the compiled index, in order
+INDEX_FIELDS = [f.name for f in fields(Rom) if f.name != "dat"]
+
+
+# Rom attributes which are indexed by DatParser.add_to_indexes(). Digests are
+# unique enough to map to a single entry, crc and size can be shared by
+# several entries so they map to a list of entries.
+UNIQUE_KEYS = ["md5", "sha1", "sha256"]
+SHARED_KEYS = ["crc", "size"]
+
+
+def lower_or_none(value: str) -> str:
+    return value.lower() if value else None
+
+
+def intern_or_none(value: str) -> str:
+    """
+    Used for attributes which are repeated across a datfile (status), so
+    each distinct value is only stored once
+    """
+    return sys.intern(value) if value else None
+
+
+def get_peak_memory() -> int:
+    """
+    Returns the peak resident set size of the process in bytes, or None
+    where the resource module is unavailable (Windows)
+    """
+    try:
+        import resource
+    except ImportError:
+        return None
+
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is reported in bytes on macOS and kilobytes elsewhere
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+# Compiled index files start with this magic, the length of a small marshal
+# header and the header itself, followed by a marshal dump of the tables. The
+# version is bumped whenever the layout of the file changes.
+INDEX_MAGIC = b"DATCHKIX"
+INDEX_VERSION = 2
+INDEX_HEADER_START = len(INDEX_MAGIC) + 4
+
+
+def get_default_index_dir() -> Path:
+    cache_home = os.environ.get("XDG_CACHE_HOME") or Path.home() / ".cache"
+    return Path(cache_home, "datchk")
+
+
+def get_index_path(datfile, index_dir=None) -> Path:
+    """
+    Compiled indexes are named after the datfile and a hash of its absolute
+    path, so datfiles with the same name in different folders don't clash
+    """
+    datfile = Path(datfile).resolve()
+    path_hash = hashlib.sha1(str(datfile).encode()).hexdigest()[:12]
+    return Path(index_dir or get_default_index_dir(), f"{datfile.stem}-{path_hash}.idx")
+
+
+def get_set_index_path(datfiles: list, index_dir=None) -> Path:
+    """
+    Indexes of a DatSet are named after a hash of the paths of its datfiles
+    """
+    paths = "\n".join(str(Path(datfile).resolve()) for datfile in datfiles)
+    path_hash = hashlib.sha1(paths.encode()).hexdigest()[:12]
+    return Path(index_dir or get_default_index_dir(), f"datset-{path_hash}.idx")
+
+
+def read_index_header(path) -> dict:
+    """
+    Reads only the header of a compiled index, which has the version and the
+    key of each datfile it was built from. Returns None for a file which
+    isn't a compiled index of this version.
+    """
+    try:
+        with open(path, "rb") as f:
+            start = f.read(INDEX_HEADER_START)
+            if len(start) != INDEX_HEADER_START or not start.startswith(INDEX_MAGIC):
+                return None
+            length = int.from_bytes(start[len(INDEX_MAGIC) :], "little")
+            header = marshal.loads(f.read(length))
+    except (OSError, ValueError, EOFError, TypeError):
+        return None
+    if not isinstance(header, dict) or header.get("version") != INDEX_VERSION:
+        return None
+    return header
+
+
+def is_index_stale(path) -> bool:
+    """
+    An index is stale once any of its datfiles is gone or has changed, or
+    it was written by another version
+    """
+    header = read_index_header(path)
+    if header is None:
+        return True
+    for key in header["datfiles"]:
+        try:
+            if get_datfile_key(key[0]) != tuple(key):
+                return True
+        except OSError:
+            return True
+    return False
+
+
+def prune_index_dir(index_dir, keep) -> None:
+    """
+    Removes stale compiled indexes and their search indexes, so the index
+    directory doesn't keep an index for every datfile ever loaded. A datfile
+    on a drive which isn't mounted loses its index too, it is simply parsed
+    again next time.
+    """
+    try:
+        paths = list(Path(index_dir).glob("*.idx"))
+    except OSError:
+        return
+    for path in paths:
+        if path == keep or not is_index_stale(path):
+            continue
+        path.unlink(missing_ok=True)
+        path.with_suffix(".sidx").unlink(missing_ok=True)
+
+
+class DatfileError(Exception):
+    """
+    Raised when a datfile can't be parsed
+    """
+
+
+def get_datfile_key(datfile) -> tuple:
+    st = os.stat(datfile)
+    return (str(Path(datfile).resolve()), st.st_size, st.st_mtime_ns)
 
 
 class DatParser(object):
-    def __init__(self, infile):
+    def __init__(self, infile, index_dir=None, use_index=True):
         self.datfile = infile
+        self.datfiles: list = [infile]
+        self.header: dict = {}
+        self.roms: list = []
+        self.entries: int = 0
+
+        # Lookup tables map a key to the position of the entry in self.roms
+        self.game_index: dict = {}
+        self.name_index: dict = {}
+        self.index: dict = {k: {} for k in UNIQUE_KEYS + SHARED_KEYS}
+
+        self.parse_time: float = 0.0
+        self.peak_memory: int = None
+        self.index_path: Path = None
+        self.loaded_from_index: bool = False
+        self.search_index: SearchIndex = None
+
+        if use_index:
+            self.index_path = get_index_path(self.datfile, index_dir)
+
+        start = perf_counter()
+        # Loading only allocates objects which live as long as the parser,
+        # so the cyclic GC repeatedly scanning them is wasted time
+        gc.disable()
         try:
-            self.tree = xml.parse(self.datfile)
-            self.root = self.tree.getroot()
-        except xml.ParseError as e:
-            print("[ERROR] Failed to parse datfile\nQuitting ..")
-            exit()
+            if self.index_path is not None:
+                self.loaded_from_index = self.load_index()
 
-        self.header = self.root.findall("header")
-        self.games = self.root.findall("game")
-        self.entries = len(self.games)
+            if not self.loaded_from_index:
+                try:
+                    self.load()
+                except xml.ParseError as e:
+                    raise DatfileError(
+                        f"Failed to parse datfile {self.datfile}: {e}"
+                    ) from e
+                if self.index_path is not None:
+                    self.save_index()
+        finally:
+            gc.enable()
+        self.parse_time = perf_counter() - start
 
-        self.current_rom = Rom
+        # Entries without a size can't be ruled out by size, has_size()
+        # only rules out a size when every entry has one
+        self.unsized_entries: int = len(self.roms) - sum(
+            map(len, self.index["size"].values())
+        )
+        self.peak_memory = get_peak_memory()
+
+        self.current_rom: Rom = None
         self.current_rom_found_match = False
-        self.console = Console()
+
+    @property
+    def console(self):
+        # Created on first use, so a parser which never prints anything
+        # (such as one loaded through datchk.api) doesn't import rich
+        if "_console" not in self.__dict__:
+            from rich.console import Console
+
+            self._console = Console()
+        return self._console
+
+    def __getstate__(self) -> dict:
+        # The console can't be pickled, it is recreated when the parser is
+        # sent to a check worker process
+        state = self.__dict__.copy()
+        state.pop("_console", None)
+        return state
+
+    def load(self) -> None:
+        """
+        Streams the datfile with iterparse, converting each <game> element
+        into Rom records as soon as it has been read. The element is cleared
+        from the tree afterwards, so only the compact records are kept in
+        memory instead of the whole ElementTree.
+        """
+        root = None
+        for event, elem in xml.iterparse(self.datfile, events=("start", "end")):
+            if event == "start":
+                if root is None:
+                    root = elem
+                continue
+
+            if elem.tag == "game":
+                self.parse_game(elem)
+                root.clear()
+            elif elem.tag == "header":
+                self.header = {t.tag: t.text for t in elem}
+                root.clear()
+
+    def load_index(self) -> bool:
+        """
+        Loads the records and lookup tables from a compiled index, returns
+        False if there is no index or it was built from a different version
+        of the datfile, in which case the datfile needs to be parsed again
+        """
+        try:
+            with open(self.index_path, "rb") as f, mmap.mmap(
+                f.fileno(), 0, access=mmap.ACCESS_READ
+            ) as m:
+                if m[: len(INDEX_MAGIC)] != INDEX_MAGIC:
+                    return False
+                length = int.from_bytes(m[len(INDEX_MAGIC) : INDEX_HEADER_START], "little")
+                header = marshal.loads(m[INDEX_HEADER_START : INDEX_HEADER_START + length])
+                if (
+                    not isinstance(header, dict)
+                    or header.get("version") != INDEX_VERSION
+                    or header.get("datfile") != self.get_key()
+                ):
+                    return False
+                # Unmarshal straight from the mapping without copying it
+                with memoryview(m) as view, view[INDEX_HEADER_START + length :] as dump:
+                    data = marshal.loads(dump)
+        except (OSError, ValueError, EOFError, TypeError):
+            return False
+
+        if not isinstance(data, dict):
+            return False
+
+        self.header = data["header"]
+        self.entries = data["entries"]
+        self.roms = self.load_roms(data)
+        self.game_index = data["game_index"]
+        self.name_index = data["name_index"]
+        self.index = data["index"]
+        return True
+
+    def load_roms(self, data: dict) -> list:
+        return [Rom(*fields, dat=self.datfile) for fields in data["roms"]]
+
+    def save_index(self, **extra) -> None:
+        """
+        Writes the records and lookup tables to a compiled index, the file is
+        written to a temporary name first so a reader never sees a partial
+        index. Failing to write the index isn't fatal, the datfile is simply
+        parsed again next time. Stale indexes are removed from the index
+        directory once the new one is written.
+        """
+        header = marshal.dumps(
+            {
+                "version": INDEX_VERSION,
+                "datfile": self.get_key(),
+                "datfiles": [get_datfile_key(datfile) for datfile in self.datfiles],
+            }
+        )
+        data = {
+            "header": self.header,
+            "entries": self.entries,
+            "roms": [
+                tuple(getattr(rom, name) for name in INDEX_FIELDS) for rom in self.roms
+            ],
+            "game_index": self.game_index,
+            "name_index": self.name_index,
+            "index": self.index,
+        } | extra
+
+        tmp_path = self.index_path.with_suffix(f".{os.getpid()}.tmp")
+        try:
+            self.index_path.parent.mkdir(parents=True, exist_ok=True)
+            with open(tmp_path, "wb") as f:
+                f.write(INDEX_MAGIC)
+                f.write(len(header).to_bytes(4, "little"))
+                f.write(header)
+                f.write(marshal.dumps(data))
+            os.replace(tmp_path, self.index_path)
+        except OSError:
+            tmp_path.unlink(missing_ok=True)
+            return
+        prune_index_dir(self.index_path.parent, self.index_path)
+
+    def parse_game(self, game) -> None:
+        game_name = game.get("name")
+        self.entries += 1
+
+        for rom_data in game.iterfind("rom"):
+            attrs = rom_data.attrib
+            if attrs.get("name") is None:
+                continue
+
+            # Digests are stored lowercase to match hexdigest() output, this
+            # also lets the lookup tables share the same string objects
+            rom = Rom(
+                name=attrs.get("name"),
+                size=attrs.get("size"),
+                crc=lower_or_none(attrs.get("crc")),
+                md5=lower_or_none(attrs.get("md5")),
+                sha1=lower_or_none(attrs.get("sha1")),
+                sha256=lower_or_none(attrs.get("sha256")),
+                serial=attrs.get("serial"),
+                status=intern_or_none(attrs.get("status")),
+                game=game_name,
+                dat=self.datfile,
+            )
+
+            self.roms.append(rom)
+            self.add_to_indexes(rom, len(self.roms) - 1)
+
+    def add_to_indexes(self, rom: Rom, pos: int) -> None:
+        """
+        Adds a record to the lookup tables used by the get_* methods, so a
+        lookup is a dict access instead of a scan over the whole datfile.
+        The first entry wins for names and digests, which matches the
+        previous behaviour of returning the first XPath match.
+        """
+        if rom.game is not None:
+            self.game_index.setdefault(rom.game, pos)
+        self.name_index.setdefault(rom.name, pos)
+
+        for key in UNIQUE_KEYS:
+            value = getattr(rom, key)
+            if value:
+                self.index[key].setdefault(value, pos)
+
+        for key in SHARED_KEYS:
+            value = getattr(rom, key)
+            if value:
+                self.index[key].setdefault(value, []).append(pos)
+
+    def get_key(self) -> tuple:
+        """
+        Identifies the version of the datfile the parser was loaded from
+        """
+        return get_datfile_key(self.datfile)
 
     def get_dat_header(self):
-        return [t.tag for t in self.header[0]]
+        return list(self.header)
+
+    def print_load_stats(self):
+        peak = "N/A"
+        if self.peak_memory is not None:
+            peak = f"{self.peak_memory / (1024 * 1024):.1f} MiB"
+
+        source = "compiled index" if self.loaded_from_index else "datfile"
+        self.console.print(
+            f"[*] Loaded {self.entries} entries ({len(self.roms)} roms) "
+            f"from {source} in {self.parse_time:.2f}s, peak memory {peak}",
+            style="bold yellow",
+        )
+
+    def get_search_index(self) -> SearchIndex:
+        """
+        The search index is only needed for searches, so it is built on the
+        first search and saved next to the compiled index for later runs
+        """
+        if self.search_index is not None:
+            return self.search_index
+
+        path = None
+        datfile_key = self.get_key()
+        # As with loading the datfile, the GC has nothing to collect here
+        gc.disable()
+        try:
+            if self.index_path is not None:
+                path = self.index_path.with_suffix(".sidx")
+                self.search_index = SearchIndex.load(path, datfile_key)
+
+            if self.search_index is None:
+                self.search_index = SearchIndex.build(self)
+                if path is not None:
+                    self.search_index.save(path, datfile_key)
+        finally:
+            gc.enable()
+
+        return self.search_index
 
     def search_rom_names_w_str(self, search_key: str) -> dict:
         """
         Generates a dict containing items in the form {index:name}
-        from the results of searching for matching strings in a datfile
-        """
-        entry_idx = 0
-        results = {}
-        for game in self.games:
-            if "name" in game.find("rom").attrib:
-                game_name = game.find("rom").get("name")
-            else:
-                print("[ERROR] datfile entry does not contain attribute 'name'")
-                exit()
-
-            if (
-                search_key.casefold() in game_name.casefold()
-                or search_key.casefold() == game_name.casefold()
-            ):
-                if game_name not in results.values():
-                    results[entry_idx] = game_name
-                    entry_idx += 1
-                else:
-                    pass
-            else:
-                pass
+        from the results of searching for matching strings in a datfile.
+        Every keyword has to match, in any order, best matches first.
+        """
+        positions = self.get_search_index().search(search_key, self.roms)
+        return {idx: self.roms[pos].name for idx, pos in enumerate(positions)}
+
+    def find_rom_by_name(self, rom_name: str) -> Rom:
+        """
+        Stateless lookups, these don't touch current_rom so they are safe to
+        call from several check workers at once
+        """
+        pos = self.game_index.get(Path(rom_name).stem)
+        if pos is None:
+            # Roms of a game with several roms (tracks, cue sheets) aren't
+            # named after the game, these are found by their exact name
+            pos = self.name_index.get(rom_name)
+        if pos is not None:
+            return self.roms[pos]
+
+    def find_rom_by_digest(self, digest: str, algo: str, size: int = None) -> Rom:
+        """
+        When the size of the file is given, an entry with a matching size is
+        preferred over the first entry with the digest
+        """
+        pos = self.index[algo].get(digest.lower())
+        if pos is None:
+            return None
+
+        rom = self.roms[pos]
+        if size is None or rom.size in (None, str(size)):
+            return rom
+
+        for candidate in self.get_rom_nodes_from_size(size):
+            if getattr(candidate, algo) == digest.lower():
+                return candidate
+        return rom
 
-        return results
+    def has_size(self, size: int) -> bool:
+        """
+        Returns False only when no entry in the datfile can have this size,
+        a file of that size can't be in the datfile and doesn't need hashing
+        """
+        return self.unsized_entries > 0 or str(size) in self.index["size"]
 
     def get_rom_node_from_name_exact(self, rom_name: str):
-        for e in self.root.findall(f'game[@name="{Path(rom_name).stem}"]'):
-            for rom_data in e.findall(f"rom"):
-                if rom_data.get("name") is not None:
-                    self.current_rom_found_match = True
-                    self.parse_game_node(rom_data)
-                    return
+        rom = self.find_rom_by_name(rom_name)
+        if rom is not None:
+            self.current_rom_found_match = True
+            self.parse_game_node(rom)
+
+    def get_rom_node_from_digest(self, digest: str, algo: str):
+        rom = self.find_rom_by_digest(digest, algo)
+        if rom is not None:
+            self.current_rom_found_match = True
+            self.parse_game_node(rom)
 
     def get_rom_node_from_md5(self, digest: str):
-        for e in self.root.iterfind(f'game/rom[@md5="{digest}"]'):
-            if e.get("md5") is not None:
-                self.current_rom_found_match = True
-                self.parse_game_node(e)
-                return
+        self.get_rom_node_from_digest(digest, "md5")
 
-    def get_md5_from_name_exact(self, rom_name: str):
-        for e in self.root.findall(f'game/rom[@name="{rom_name}"]'):
-            return e.get("md5")
+    def get_rom_nodes_from_crc(self, crc: str) -> list:
+        return [self.roms[pos] for pos in self.index["crc"].get(crc.lower(), [])]
 
-    def parse_game_node(self, game_node):
-        if game_node is not None:
-            try:
-                self.current_rom.name = game_node.get("name")
-                self.current_rom.size = game_node.get("size")
-                self.current_rom.crc = game_node.get("crc")
-                self.current_rom.md5 = game_node.get("md5")
-                self.current_rom.sha1 = game_node.get("sha1")
-                self.current_rom.sha256 = game_node.get("sha256")
-                self.current_rom.serial = game_node.get("serial")
-                self.current_rom.status = game_node.get("status")
-
-            except AttributeError as e:
-                print("[ERROR] Problem processing with the provided information")
+    def get_rom_nodes_from_size(self, size: int) -> list:
+        return [self.roms[pos] for pos in self.index["size"].get(str(size), [])]
+
+    def get_md5_from_name_exact(self, rom_name: str):
+        pos = self.name_index.get(rom_name)
+        if pos is not None:
+            return self.roms[pos].md5
 
+    def parse_game_node(self, rom: Rom):
+        if rom is not None:
+            self.current_rom = rom
         else:
             print(
                 "[NO DATA] There was an issue parsing rom data with the supplied flags"
@@ -114,6 +521,8 @@ class DatParser(object):
             pass
 
     def print_current_rom_data(self):
+        from rich.table import Table
+
         self.console.rule(self.current_rom.name)
 
         table = Table(show_lines=True)
@@ -130,3 +539,118 @@ class DatParser(object):
         table.add_row("Status", self.current_rom.status)
 
         self.console.print(table)
+
+
+class DatSet(DatParser):
+    """
+    Several datfiles merged into one set of lookup tables, so every file is
+    hashed once and matched against all of them. Each entry keeps the path
+    of its datfile in Rom.dat. When datfiles share a game name or digest,
+    the entry from the datfile given first is found.
+    """
+
+    def __init__(self, datfiles: list, index_dir=None, use_index=True):
+        self.datfile = None
+        self.datfiles = list(datfiles)
+        self.header = {}
+        self.roms = []
+        self.entries = 0
+        self.game_index = {}
+        self.name_index = {}
+        self.index = {k: {} for k in UNIQUE_KEYS + SHARED_KEYS}
+        # Number of entries from each datfile, they are kept in order in roms
+        self.dat_sizes: list = []
+        self.parse_time = 0.0
+        self.index_path = None
+        self.loaded_from_index = False
+        self.search_index = None
+
+        if use_index:
+            self.index_path = get_set_index_path(self.datfiles, index_dir)
+
+        start = perf_counter()
+        # The merged tables are saved as an index of their own, so the
+        # datfiles are only merged again when one of them changes
+        if self.index_path is not None:
+            gc.disable()
+            try:
+                self.loaded_from_index = self.load_index()
+            finally:
+                gc.enable()
+
+        if not self.loaded_from_index:
+            # Each datfile is loaded on its own, from its compiled index where
+            # possible, and merged in before the next one is loaded
+            for datfile in self.datfiles:
+                dat = DatParser(datfile, index_dir, use_index)
+                gc.disable()
+                try:
+                    self.merge(dat)
+                finally:
+                    gc.enable()
+            if self.index_path is not None:
+                self.save_index(dat_sizes=self.dat_sizes)
+        self.parse_time = perf_counter() - start
+
+        self.unsized_entries = len(self.roms) - sum(
+            map(len, self.index["size"].values())
+        )
+        self.peak_memory = get_peak_memory()
+
+        self.current_rom = None
+        self.current_rom_found_match = False
+
+    def load_roms(self, data: dict) -> list:
+        self.dat_sizes = data["dat_sizes"]
+        rows = iter(data["roms"])
+        roms = []
+        for datfile, size in zip(self.datfiles, self.dat_sizes):
+            roms += [Rom(*fields, dat=datfile) for fields in islice(rows, size)]
+        return roms
+
+    def merge(self, dat: DatParser) -> None:
+        offset = len(self.roms)
+        self.entries += dat.entries
+        self.dat_sizes.append(len(dat.roms))
+
+        if not offset:
+            # The first datfile's tables are taken over as they are
+            self.roms = dat.roms
+            self.game_index = dat.game_index
+            self.name_index = dat.name_index
+            self.index = dat.index
+            return
+
+        self.roms += dat.roms
+
+        def merge_unique(merged: dict, table: dict) -> dict:
+            # Entries already merged win, they are added over the new ones
+            table = {value: pos + offset for value, pos in table.items()}
+            table.update(merged)
+            return table
+
+        self.game_index = merge_unique(self.game_index, dat.game_index)
+        self.name_index = merge_unique(self.name_index, dat.name_index)
+        for key in UNIQUE_KEYS:
+            self.index[key] = merge_unique(self.index[key], dat.index[key])
+
+        for key in SHARED_KEYS:
+            merged = self.index[key]
+            for value, positions in dat.index[key].items():
+                positions = [pos + offset for pos in positions]
+                if value in merged:
+                    merged[value].extend(positions)
+                else:
+                    merged[value] = positions
+
+    def get_key(self) -> tuple:
+        return tuple(get_datfile_key(datfile) for datfile in self.datfiles)
+
+
+def load_dats(datfiles: list, index_dir=None, use_index=True) -> DatParser:
+    """
+    Returns a DatParser for a single datfile, or a DatSet for several
+    """
+    if len(datfiles) == 1:
+        return DatParser(datfiles[0], index_dir, use_index)
+    return DatSet(datfiles, index_dir, use_index)
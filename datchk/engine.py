@@ -0,0 +1,504 @@
+"""
+DATCHK
+A command line datfile parser and rom validator written in python.
+
+Written By: Daws
+"""
+
+from .cache import HashCache, get_file_identity
+from .dat_handler import DatParser, Rom
+from .stats import get_file_timings
+from .utilities import SKIPPED_SIZE, HashHandler, get_source_path, is_archive
+
+from concurrent.futures import (
+    FIRST_COMPLETED,
+    ProcessPoolExecutor,
+    ThreadPoolExecutor,
+    wait,
+)
+from dataclasses import dataclass, field
+from functools import partial
+from os.path import basename
+from time import perf_counter
+import os
+
+
+@dataclass(slots=True)
+class RomResult:
+    """
+    Everything decided about a single file during a check. Results are
+    created by the check workers and handed back to the main thread, so no
+    per-file state is shared between workers.
+    """
+
+    path: str
+    filename: str
+    archive: str = None
+    ocode: str = None
+    rom: Rom = None
+    matched_by: str = None
+    digests: dict = field(default_factory=dict)
+    size: int = None
+    read_bytes: int = 0
+    cached: bool = False
+    timings: dict = None
+
+    @property
+    def key(self) -> str:
+        # Results are keyed by the full path so files with the same name in
+        # different folders don't collide, archive members add the member name
+        if self.archive is not None:
+            return f"{self.path}/{self.filename}"
+        return self.path
+
+
+@dataclass(slots=True)
+class CheckOptions:
+    """
+    Settings shared by every file in a check, passed to each worker.
+    buffer_size None lets HashHandler size its read buffer to each file.
+    With profile, the first result of each file carries its phase timings.
+    """
+
+    algorithm: str = "md5"
+    quick: bool = False
+    buffer_size: int = None
+    use_mmap: bool = False
+    profile: bool = False
+
+    def new_hasher(self) -> HashHandler:
+        return HashHandler(self.buffer_size, self.use_mmap)
+
+
+def get_lookup_algorithms(algorithm: str) -> list:
+    """
+    Digests used to locate an entry when the filename doesn't match.
+    The chosen algorithm is tried first so its digest can be reused for
+    validation, MD5 is kept as a fallback since every datfile has it.
+    """
+    return list(dict.fromkeys([algorithm, "md5"]))
+
+
+def update_digests(result: RomResult, rom_path, algos, hasher) -> None:
+    """
+    Hashes the file for any of algos which aren't already known, digests
+    restored from the hash cache are used without reading the file
+    """
+    missing = [algo for algo in algos if algo not in result.digests]
+    if missing:
+        result.digests.update(hasher.get_digests(rom_path, missing))
+
+
+def find_entry(dat: DatParser, result: RomResult, rom_path, algorithm, hasher):
+    """
+    Locates the datfile entry for a file, first from the filename and
+    then from the file digests if the name doesn't match.
+    When hashing is needed, every digest used for the lookup and for
+    validation is calculated in a single read of the file.
+    """
+    result.rom = dat.find_rom_by_name(result.filename)
+    if result.rom is not None:
+        result.matched_by = "name"
+        return
+
+    # A file with a size no entry has can't be in the datfile
+    if result.size is not None and not dat.has_size(result.size):
+        result.ocode = "NIDF"
+        return
+
+    algos = get_lookup_algorithms(algorithm)
+    update_digests(result, rom_path, algos, hasher)
+    for algo in algos:
+        result.rom = dat.find_rom_by_digest(result.digests[algo], algo, result.size)
+        if result.rom is not None:
+            result.matched_by = algo
+            break
+
+    if result.rom is None:
+        result.ocode = "NIDF"
+    elif getattr(result.rom, algorithm):
+        """
+        If we find a match based on the digest and not the name of the file itself,
+        the file is a valid but the filename is not, so the result gets the
+        PBIN ocode (Passed But Incorrect Name). The entry is kept on the result
+        so the correct name can be suggested to the user.
+        """
+        result.ocode = "PBIN"
+
+
+def validate(result: RomResult, rom_path, algorithm, hasher) -> None:
+    checksum = getattr(result.rom, algorithm)
+    if checksum is None:
+        result.ocode = "CSNA"
+        return
+
+    # The digest can't match when the size doesn't, so there is no need
+    # to read the file
+    if result.size is not None and result.rom.size not in (None, str(result.size)):
+        result.ocode = "FAIL"
+        return
+
+    update_digests(result, rom_path, [algorithm], hasher)
+
+    if result.digests[algorithm] == checksum:
+        result.ocode = "PASS"
+    else:
+        result.ocode = "FAIL"
+
+
+def is_skipped(digests: dict) -> bool:
+    return digests is not None and SKIPPED_SIZE in digests
+
+
+def has_digests(dat: DatParser, members: dict, algos) -> bool:
+    """
+    A member which was skipped by name and size only counts while the
+    datfile still has no entry with its name or size, it is hashed again
+    once the datfile has one
+    """
+    if not members:
+        return False
+    for member, digests in members.items():
+        if digests is None:
+            return False
+        if is_skipped(digests):
+            if dat.find_rom_by_name(member) is not None or dat.has_size(
+                digests[SKIPPED_SIZE]
+            ):
+                return False
+        elif not all(algo in digests for algo in algos):
+            return False
+    return True
+
+
+def is_read_needed(
+    dat: DatParser, rom_path, size: int, options: CheckOptions, cached: dict = None
+) -> bool:
+    """
+    Tells ahead of the check whether it will read a plain file, so the
+    Prefetcher doesn't read files the check won't. A file isn't read when
+    neither its name nor its size is in the datfile, or when cached has
+    every digest the check needs. Archives are always read.
+    """
+    if is_archive(rom_path):
+        return True
+    if dat.find_rom_by_name(basename(rom_path)) is None and not dat.has_size(size):
+        return False
+    algos = ["crc"] if options.quick else get_lookup_algorithms(options.algorithm)
+    return not (cached and has_digests(dat, cached, algos))
+
+
+def check_member(
+    dat: DatParser, rom_path, member: str, digests: dict, algorithm: str
+) -> RomResult:
+    """
+    Checks a single archive member from digests calculated while streaming
+    the archive, a member without digests could not be decompressed
+    """
+    result = RomResult(
+        path=str(rom_path), filename=member, archive=basename(rom_path)
+    )
+
+    if is_skipped(digests):
+        # Neither the name nor the size of the member is in the datfile. The
+        # marker is kept as its digests so the hash cache can store it.
+        result.digests = dict(digests)
+        result.size = digests[SKIPPED_SIZE]
+        result.ocode = "NIDF"
+        return result
+
+    if digests is None:
+        result.rom = dat.find_rom_by_name(member)
+        if result.rom is not None:
+            result.matched_by = "name"
+            result.ocode = "FAIL"
+        else:
+            result.ocode = "NIDF"
+        return result
+
+    result.digests = dict(digests)
+    find_entry(dat, result, None, algorithm, None)
+    if result.ocode is None:
+        validate(result, None, algorithm, None)
+
+    return result
+
+
+def get_empty_archive_result(rom_path) -> RomResult:
+    return RomResult(
+        path=str(rom_path),
+        filename=basename(rom_path),
+        archive=basename(rom_path),
+        ocode="NIDF",
+    )
+
+
+def compare_quick(dat: DatParser, result: RomResult, crc: str, size: int) -> None:
+    """
+    Checks a file or archive member from its CRC32 and size alone. The entry
+    is located from the name first, then from the CRC32 of entries with the
+    same size.
+    """
+    result.size = size
+    result.rom = dat.find_rom_by_name(result.filename)
+    if result.rom is not None:
+        result.matched_by = "name"
+    else:
+        for rom in dat.get_rom_nodes_from_crc(crc):
+            if rom.size in (None, str(size)):
+                result.rom = rom
+                result.matched_by = "crc"
+                result.ocode = "PBIN"
+                return
+        result.ocode = "NIDF"
+        return
+
+    if result.rom.crc is None:
+        result.ocode = "CSNA"
+    elif result.rom.crc == crc and result.rom.size in (None, str(size)):
+        result.ocode = "PASS"
+    else:
+        result.ocode = "FAIL"
+
+
+def check_rom_quick(
+    dat: DatParser, rom, options: CheckOptions, cached: dict = None, hasher=None
+) -> list:
+    """
+    Quick check using CRC32 and size instead of a full digest. Archive
+    members are checked from the CRC32 and size stored in the archive
+    headers, so only a few KB of each archive is read. Plain files still
+    need to be read to calculate the CRC32.
+    Returns None for an archive which doesn't store the CRC32 of every
+    member, these need the full check.
+    """
+    hasher = hasher or options.new_hasher()
+    rom_path = get_source_path(rom)
+
+    if is_archive(rom_path):
+        members = hasher.get_archive_info(rom)
+        if members is None or any(crc is None for crc, size in members.values()):
+            return None
+
+        results = []
+        for member, (crc, size) in members.items():
+            result = RomResult(
+                path=str(rom_path), filename=member, archive=basename(rom_path)
+            )
+            result.digests["crc"] = crc
+            compare_quick(dat, result, crc, size)
+            results.append(result)
+
+        return results or [get_empty_archive_result(rom_path)]
+
+    result = RomResult(path=str(rom_path), filename=basename(rom_path))
+    size = os.stat(rom_path).st_size
+    # As with archive members, a file with a size no entry has can't be in
+    # the datfile unless its name matches, so it isn't read at all
+    if dat.find_rom_by_name(result.filename) is None and not dat.has_size(size):
+        result.size = size
+        result.ocode = "NIDF"
+        return [result]
+
+    if cached:
+        result.digests.update(cached.get("", {}))
+        result.cached = "crc" in result.digests
+
+    update_digests(result, rom, ["crc"], hasher)
+    compare_quick(dat, result, result.digests["crc"], size)
+    result.read_bytes = hasher.get_read_bytes()
+    return [result]
+
+
+def check_rom(
+    dat: DatParser, rom, options: CheckOptions = None, cached: dict = None
+) -> list:
+    """
+    Runs the full check for a single file: look up, hash and compare.
+    Returns a list of RomResult, one for a plain file or one for each
+    member of an archive. Only local state is used so it can run in any
+    worker.
+
+    cached is None when no hash cache is in use, otherwise it holds the
+    cached {member:{algo:digest}} for the file (empty on a cache miss).
+    When it has every digest the check needs, the file isn't read at all.
+    On a miss every lookup digest is calculated up front so the cache can
+    answer both the lookup and validation next time.
+
+    With options.quick the file is checked by CRC32 and size, see
+    check_rom_quick()
+
+    rom is either a path or a PrefetchedFile, a prefetched file is always
+    closed afterwards so its memory is handed back even if it wasn't read
+    """
+    options = options or CheckOptions()
+    hasher = options.new_hasher()
+    start = perf_counter()
+    try:
+        results = check_source(dat, rom, options, cached, hasher)
+    finally:
+        if not isinstance(rom, (str, os.PathLike)):
+            rom.close()
+
+    if options.profile:
+        results[0].timings = get_file_timings(hasher, perf_counter() - start)
+    return results
+
+
+def check_source(
+    dat: DatParser, rom, options: CheckOptions, cached: dict, hasher: HashHandler
+) -> list:
+    if options.quick:
+        results = check_rom_quick(dat, rom, options, cached, hasher)
+        if results is not None:
+            return results
+
+    rom_path = get_source_path(rom)
+    algorithm = options.algorithm
+    algos = get_lookup_algorithms(algorithm)
+    from_cache = cached is not None and has_digests(dat, cached, algos)
+
+    if is_archive(rom_path):
+        # Archive members are always hashed for every lookup digest while
+        # they are streamed, so each archive is only decompressed once
+        if from_cache:
+            members = cached
+        else:
+            # Members whose name and size aren't in the datfile are reported
+            # as NIDF without being decompressed, see check_member()
+            members = hasher.get_archive_digests(
+                rom,
+                algos,
+                skip=lambda member, size: dat.find_rom_by_name(member) is None
+                and not dat.has_size(size),
+            )
+            for member, digests in members.items():
+                previous = cached.get(member) if cached else None
+                if digests is None or is_skipped(digests) or is_skipped(previous):
+                    continue
+                if previous:
+                    # Keep any digests cached for other algorithms
+                    members[member] = previous | digests
+
+        results = [
+            check_member(dat, rom_path, member, digests, algorithm)
+            for member, digests in members.items()
+        ]
+        if not results:
+            results = [get_empty_archive_result(rom_path)]
+    else:
+        result = RomResult(path=str(rom_path), filename=basename(rom_path))
+        result.size = os.stat(rom_path).st_size
+        if cached is not None:
+            # Keep any digests cached for other algorithms, a file which can't
+            # be in the datfile by size isn't hashed for the cache
+            result.digests.update(cached.get("", {}))
+            if dat.has_size(result.size):
+                update_digests(result, rom, algos, hasher)
+
+        find_entry(dat, result, rom, algorithm, hasher)
+        if result.ocode is None:
+            validate(result, rom, algorithm, hasher)
+        results = [result]
+
+    for result in results:
+        result.cached = from_cache
+    # Bytes read are reported once for the whole file
+    results[0].read_bytes = hasher.get_read_bytes()
+    return results
+
+
+# Datfile used by check_rom_in_worker(), only set inside worker processes
+_worker_dat: DatParser = None
+
+
+def init_worker(dat: DatParser) -> None:
+    global _worker_dat
+    _worker_dat = dat
+
+
+def check_rom_in_worker(rom, options: CheckOptions = None, cached: dict = None) -> list:
+    return check_rom(_worker_dat, rom, options, cached)
+
+
+def iter_results(
+    dat: DatParser,
+    roms,
+    options: CheckOptions = None,
+    jobs=1,
+    processes=False,
+    cache: HashCache = None,
+    rehash=False,
+):
+    """
+    Yields the list of RomResult for every file in roms, in the order they
+    complete.
+    With jobs > 1 the files are checked by a pool of threads, hashlib and
+    zlib release the GIL while hashing so this scales for plain files.
+    Processes can be used instead for CPU bound 7z/LZMA decompression.
+    Only a few files per worker are queued at once to keep memory flat.
+
+    The hash cache is only read and written here, on the calling thread.
+    With rehash the cached digests are ignored but still refreshed.
+
+    roms can yield paths or PrefetchedFile from a Prefetcher, prefetched
+    files can't be sent to worker processes.
+    """
+    options = options or CheckOptions()
+    identities = {}
+
+    def get_cached(rom) -> dict:
+        if cache is None:
+            return None
+        rom_path = get_source_path(rom)
+        identities[rom_path] = get_file_identity(rom_path)
+        if rehash:
+            return {}
+        return cache.get(rom_path, identities[rom_path]) or {}
+
+    def store(results: list) -> list:
+        if cache is None:
+            return results
+
+        identity = identities.pop(results[0].path)
+        members = {
+            result.filename if result.archive is not None else "": result.digests
+            for result in results
+        }
+        # Archives which couldn't be fully read are left out of the cache, as
+        # are quick checks of archives since the header CRC32 wasn't verified.
+        # Members skipped by name and size keep their marker, so they count.
+        if (
+            not results[0].cached
+            and all(members.values())
+            and not (options.quick and results[0].archive is not None)
+        ):
+            cache.put(results[0].path, identity, members)
+        return results
+
+    if jobs <= 1:
+        for rom in roms:
+            cached = get_cached(rom)
+            yield store(check_rom(dat, rom, options, cached))
+        return
+
+    if processes:
+        executor = ProcessPoolExecutor(jobs, initializer=init_worker, initargs=(dat,))
+        task = partial(check_rom_in_worker, options=options)
+    else:
+        executor = ThreadPoolExecutor(jobs)
+        task = partial(check_rom, dat, options=options)
+
+    with executor:
+        pending = set()
+        for rom in roms:
+            pending.add(executor.submit(task, rom, cached=get_cached(rom)))
+            if len(pending) >= jobs * 2:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    yield store(future.result())
+
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                yield store(future.result())
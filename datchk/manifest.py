@@ -0,0 +1,158 @@
+"""
+DATCHK
+A command line datfile parser and rom validator written in python.
+
+Written By: Daws
+"""
+
+from .cache import COMMIT_INTERVAL, get_file_identity
+from .missing import get_entry_key
+
+import json
+import os
+import sqlite3
+
+
+def get_settings(dat_key: tuple, algorithm: str, quick: bool) -> str:
+    """
+    The datfile and options a result was decided with, a file is checked
+    again whenever these differ from the last run
+    """
+    return json.dumps([list(dat_key), algorithm, quick])
+
+
+class Manifest:
+    """
+    SQLite record of the last check of every file, its identity and the
+    result of each of its members. With --incremental, files which haven't
+    changed and passed last time are not checked again.
+    The known files are read into memory when the manifest is opened, so
+    they can be looked up from the scan while it runs on another thread.
+    Writes only happen on the main thread.
+    """
+
+    def __init__(self, path, settings: str) -> None:
+        self.path = path
+        self.settings = settings
+        self.db = sqlite3.connect(path)
+        self.db.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS files (
+                path TEXT PRIMARY KEY,
+                device INTEGER NOT NULL,
+                inode INTEGER NOT NULL,
+                size INTEGER NOT NULL,
+                mtime_ns INTEGER NOT NULL,
+                settings TEXT NOT NULL,
+                passed INTEGER NOT NULL,
+                results INTEGER NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS results (
+                path TEXT NOT NULL,
+                member TEXT NOT NULL DEFAULT '',
+                status TEXT NOT NULL,
+                game TEXT,
+                name TEXT,
+                dat TEXT,
+                PRIMARY KEY (path, member)
+            );
+            """
+        )
+        self.db.commit()
+        self.pending_writes: int = 0
+
+        # {path:(identity, entries)} of files which passed with the same
+        # settings, entries has the (dat, game, name) of each result
+        self.passed: dict = {}
+        for row in self.db.execute(
+            """
+            SELECT path, device, inode, size, mtime_ns, dat, game, name
+            FROM files JOIN results USING (path)
+            WHERE settings = ? AND passed = 1
+            """,
+            (settings,),
+        ):
+            self.passed.setdefault(row[0], (tuple(row[1:5]), []))[1].append(row[5:8])
+
+    def get_unchanged(self, path) -> list:
+        """
+        Returns the (dat, game, name) entry of each result of a file which
+        passed last time and hasn't changed since, or None if it has to be
+        checked
+        """
+        known = self.passed.get(str(path))
+        if known is None:
+            return None
+        try:
+            identity = get_file_identity(path)
+        except OSError:
+            return None
+        if identity != known[0]:
+            return None
+        return known[1]
+
+    def put(self, file_results: list, identity: tuple = None) -> None:
+        """
+        Replaces the record of a file with the results of its latest check
+        """
+        path = file_results[0].path
+        if identity is None:
+            try:
+                identity = get_file_identity(path)
+            except OSError:
+                self.remove(path)
+                return
+
+        passed = all(result.ocode == "PASS" for result in file_results)
+        self.db.execute(
+            "INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+            (path, *identity, self.settings, passed, len(file_results)),
+        )
+        self.db.execute("DELETE FROM results WHERE path = ?", (path,))
+        self.db.executemany(
+            "INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?, ?, ?)",
+            [
+                (
+                    path,
+                    result.filename if result.archive is not None else "",
+                    result.ocode,
+                    result.rom.game if result.rom is not None else None,
+                    result.rom.name if result.rom is not None else None,
+                    result.rom.dat if result.rom is not None else None,
+                )
+                for result in file_results
+            ],
+        )
+        if passed:
+            entries = [get_entry_key(result.rom) for result in file_results]
+            self.passed[path] = (identity, entries)
+        else:
+            self.passed.pop(path, None)
+
+        self.pending_writes += 1
+        if self.pending_writes >= COMMIT_INTERVAL:
+            self.commit()
+
+    def remove(self, path) -> None:
+        self.db.execute("DELETE FROM files WHERE path = ?", (str(path),))
+        self.db.execute("DELETE FROM results WHERE path = ?", (str(path),))
+        self.passed.pop(str(path), None)
+
+    def prune(self) -> int:
+        """
+        Removes files which no longer exist, returns the number removed
+        """
+        paths = [row[0] for row in self.db.execute("SELECT path FROM files")]
+        missing = [p for p in paths if not os.path.isfile(p)]
+        for path in missing:
+            self.remove(path)
+        self.commit()
+        return len(missing)
+
+    def commit(self) -> None:
+        self.db.commit()
+        self.pending_writes = 0
+
+    def close(self) -> None:
+        self.commit()
+        self.db.close()
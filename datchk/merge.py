@@ -0,0 +1,114 @@
+"""
+DATCHK
+A command line datfile parser and rom validator written in python.
+
+Written By: Daws
+"""
+
+from .arg_handler import CustomHelpFormatter
+from .output import OUTPUT_FORMATS
+
+from os.path import abspath, commonpath, dirname, isabs, isfile
+import argparse
+
+
+def build_merge_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(
+        prog="datchk merge",
+        formatter_class=CustomHelpFormatter,
+        description="Combine the --output files of several checks into one report",
+    )
+    parser.add_argument(
+        "files", nargs="+", help="Result files from --output", metavar="PATH"
+    )
+    parser.add_argument(
+        "--output",
+        choices=OUTPUT_FORMATS,
+        help="Also write the combined records [ndjson,csv,json]",
+        metavar="FORMAT",
+    )
+    parser.add_argument(
+        "--output-file",
+        help="Path for the combined --output records",
+        metavar="PATH",
+    )
+    return parser
+
+
+def merge_main(argv=None) -> None:
+    args = build_merge_parser().parse_args(argv)
+    if bool(args.output) != bool(args.output_file):
+        print("[ERROR] --output and --output-file must be used together\nQuitting ..")
+        exit()
+    for path in args.files:
+        if not isfile(path):
+            print(f"[ERROR] Result file not found: {path}\nQuitting ..")
+            exit()
+
+    from .output import get_result, open_writer, read_records
+    from .report import Report
+    from rich.console import Console
+
+    console = Console()
+    report = Report(console, [])
+    writer = None
+    if args.output:
+        writer = open_writer(args.output, abspath(args.output_file))
+
+    # A file is counted once however many archive members it has, and a
+    # result found in more than one file (overlapping shards) only once.
+    # Files are told apart by their path relative to the checked directory,
+    # the same key --shard splits on, so shards checked on machines with the
+    # collection mounted in different places agree on it.
+    files = set()
+    seen = set()
+    duplicates = 0
+    base = None
+    try:
+        for path in args.files:
+            console.print(f"[*] Reading {path}..", style="bold yellow")
+            try:
+                for record in read_records(path):
+                    result = get_result(record)
+                    if record.get("relpath") is not None:
+                        result.path = record["relpath"]
+                    if result.key in seen:
+                        duplicates += 1
+                        continue
+                    seen.add(result.key)
+                    if result.path not in files:
+                        files.add(result.path)
+                        # Results of a single file check only have the
+                        # absolute path, these are shown relative to the
+                        # folder they share
+                        if isabs(result.path):
+                            folder = dirname(result.path)
+                            base = folder if base is None else commonpath([base, folder])
+                    report.add_result(result)
+                    if writer is not None:
+                        # Written as read, with the path on its own machine
+                        writer.add(record)
+            except (ValueError, KeyError, TypeError) as e:
+                print(f"[ERROR] Failed to read results from {path}: {e}\nQuitting ..")
+                exit()
+    finally:
+        if writer is not None:
+            writer.close()
+
+    if duplicates:
+        console.print(
+            f"[*] Skipped {duplicates} results found in more than one file..",
+            style="bold yellow",
+        )
+    if writer is not None:
+        console.print(
+            f"[*] Wrote {writer.count} results to {args.output_file}..",
+            style="bold yellow",
+        )
+
+    # Files are shown relative to the checked directory, or to the folder
+    # they all share, like a check of that folder
+    report.rom_count = len(files)
+    report.base_path = base
+    report.show_statistics()
+    report.generate_report_tree()
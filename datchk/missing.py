@@ -0,0 +1,206 @@
+"""
+DATCHK
+A command line datfile parser and rom validator written in python.
+
+Written By: Daws
+"""
+
+from pathlib import Path
+import os
+
+# Results which show an entry is in the collection. A PBIN file has the
+# right data under the wrong name, so it only needs renaming.
+HAVE_CODES = ["PASS", "PBIN"]
+
+# Attributes of a Rom written to a fixdat, in the order of a datfile
+FIXDAT_ATTRS = ["name", "size", "crc", "md5", "sha1", "sha256", "serial", "status"]
+
+# Games listed in each branch of the missing report, the rest are counted.
+# The fixdat always has every missing entry.
+MISSING_SHOWN = 100
+
+
+def get_entry_key(rom) -> tuple:
+    """
+    Identifies an entry across processes, Rom objects sent back from worker
+    processes are copies so they can't be compared by identity
+    """
+    return (rom.dat, rom.game, rom.name)
+
+
+class GameStatus:
+    def __init__(self, dat: str, name: str) -> None:
+        self.dat = dat
+        self.name = name
+        self.total: int = 0
+        self.missing: list = []
+
+    @property
+    def have(self) -> int:
+        return self.total - len(self.missing)
+
+
+class MissingReport:
+    """
+    Compares the entries found by a check with every entry of the datfile,
+    in a single pass over DatParser.roms. The roms of a game are always
+    next to each other, so games are counted as they are passed.
+    Entries marked nodump can't be checked and are left out.
+    """
+
+    def __init__(self, dat, have: set) -> None:
+        self.dat = dat
+        # Every game with at least one entry missing
+        self.games: list = []
+        self.total_games: int = 0
+        self.total_roms: int = 0
+        self.missing_roms: int = 0
+
+        game = None
+        for rom in dat.roms:
+            if rom.status == "nodump":
+                continue
+            if game is None or (rom.dat, rom.game) != (game.dat, game.name):
+                self.add_game(game)
+                game = GameStatus(rom.dat, rom.game)
+            game.total += 1
+            if get_entry_key(rom) not in have:
+                game.missing.append(rom)
+        self.add_game(game)
+
+    def add_game(self, game: GameStatus) -> None:
+        if game is None:
+            return
+        self.total_games += 1
+        self.total_roms += game.total
+        if game.missing:
+            self.games.append(game)
+            self.missing_roms += len(game.missing)
+
+    @property
+    def missing_games(self) -> list:
+        return [game for game in self.games if not game.have]
+
+    @property
+    def incomplete_games(self) -> list:
+        return [game for game in self.games if game.have]
+
+    def build_summary_table(self):
+        from rich.table import Table
+
+        missing = len(self.missing_games)
+        complete = self.total_games - len(self.games)
+        table = Table("", "Complete", "Incomplete", "Missing", "Total", show_lines=True)
+        table.add_row(
+            "Games",
+            f"[bold green]{complete}",
+            f"[bold yellow]{len(self.games) - missing}",
+            f"[bold red]{missing}",
+            str(self.total_games),
+        )
+        table.add_row(
+            "Roms",
+            f"[bold green]{self.total_roms - self.missing_roms}",
+            "",
+            f"[bold red]{self.missing_roms}",
+            str(self.total_roms),
+        )
+        return table
+
+    def build_tree(self):
+        from rich.markup import escape
+        from rich.tree import Tree
+
+        tree = Tree("Missing", hide_root=True)
+        incomplete = self.incomplete_games
+        if incomplete:
+            branch = tree.add("Incomplete Games")
+            for game in incomplete[:MISSING_SHOWN]:
+                node = branch.add(f"[yellow]{escape(game.name or '')}[/yellow] ({game.have}/{game.total})")
+                for rom in game.missing:
+                    node.add(f"[red]{escape(rom.name)}")
+            self.add_more(branch, len(incomplete))
+
+        missing = self.missing_games
+        if missing:
+            branch = tree.add("Missing Games")
+            for game in missing[:MISSING_SHOWN]:
+                branch.add(f"[red]{escape(game.name or '')}[/red] (0/{game.total})")
+            self.add_more(branch, len(missing))
+        return tree
+
+    def add_more(self, branch, count: int) -> None:
+        if count > MISSING_SHOWN:
+            branch.add(f"[bold default]... and {count - MISSING_SHOWN} more")
+
+    def write_fixdats(self, path) -> list:
+        """
+        Writes the missing entries as a datfile which DatParser can read.
+        With several datfiles, path is a directory and each datfile gets a
+        fixdat of its own. Returns the paths written.
+        """
+        if len(self.dat.datfiles) == 1:
+            write_fixdat(path, self.dat.datfiles[0], self.games, self.dat.header)
+            return [path]
+
+        os.makedirs(path, exist_ok=True)
+        dat_games = {datfile: [] for datfile in self.dat.datfiles}
+        for game in self.games:
+            dat_games[game.dat].append(game)
+        written = []
+        for datfile, games in dat_games.items():
+            fixdat = Path(path, f"{Path(datfile).stem} (fixdat).dat")
+            write_fixdat(fixdat, datfile, games)
+            written.append(fixdat)
+        return written
+
+
+def escape_xml(value: str) -> str:
+    """
+    Escapes fixdat text and attribute values, chained replaces are several
+    times quicker than xml.sax.saxutils for a few hundred thousand roms
+    """
+    return (
+        value.replace("&", "&amp;")
+        .replace("<", "&lt;")
+        .replace(">", "&gt;")
+        .replace('"', "&quot;")
+    )
+
+
+def write_fixdat(path, datfile: str, games: list, header: dict = None) -> None:
+    """
+    Writes games with only their missing roms, one game per line. The file
+    is written to a temporary name first, like the compiled index.
+    """
+    header = header or {}
+    name = header.get("name") or Path(datfile).stem
+    description = escape_xml(header.get("description") or name)
+    name = escape_xml(name)
+
+    path = Path(path)
+    tmp_path = path.with_name(f"{path.name}.{os.getpid()}.tmp")
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        f.write('<?xml version="1.0"?>\n<datafile>\n')
+        f.write(
+            f"<header><name>{name} (fixdat)</name>"
+            f"<description>{description} (fixdat)</description></header>\n"
+        )
+        for game in games:
+            game_name = escape_xml(game.name or "")
+            roms = "".join(
+                "<rom "
+                + " ".join(
+                    f'{attr}="{escape_xml(value)}"'
+                    for attr in FIXDAT_ATTRS
+                    if (value := getattr(rom, attr)) is not None
+                )
+                + "/>"
+                for rom in game.missing
+            )
+            f.write(
+                f'<game name="{game_name}"><description>{game_name}</description>'
+                f"{roms}</game>\n"
+            )
+        f.write("</datafile>\n")
+    os.replace(tmp_path, path)
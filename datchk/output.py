@@ -0,0 +1,225 @@
+"""
+DATCHK
+A command line datfile parser and rom validator written in python.
+
+Written By: Daws
+"""
+
+from .stats import FILE_PHASES
+from .utilities import get_shard_key
+
+from abc import ABC, abstractmethod
+from os.path import basename
+import csv
+import json
+
+OUTPUT_FORMATS = ["ndjson", "csv", "json"]
+
+DIGEST_KEYS = ["crc", "md5", "sha1", "sha256"]
+
+
+def get_record(result, base=None) -> dict:
+    """
+    Flattens a RomResult into plain types, timings are only set on the first
+    result of each file and are None for the other members of an archive.
+    With base, the checked directory, relpath is the path relative to it.
+    """
+    entry = None
+    if result.rom is not None:
+        entry = {"game": result.rom.game, "name": result.rom.name}
+
+    return {
+        "path": result.path,
+        "relpath": get_shard_key(result.path, base) if base is not None else None,
+        "dat": result.rom.dat if result.rom is not None else None,
+        "member": result.filename if result.archive is not None else None,
+        "status": result.ocode,
+        "matched_by": result.matched_by,
+        "entry": entry,
+        "size": result.size,
+        "digests": {k: result.digests[k] for k in DIGEST_KEYS if k in result.digests},
+        "cached": bool(result.cached),
+        "timings": result.timings,
+    }
+
+
+class ResultWriter(ABC):
+    """
+    Writes one record per result as soon as it is decided, nothing is kept
+    in memory. Files are line buffered so other tools can read the output
+    while a check is still running.
+    """
+
+    def __init__(self, path, base=None) -> None:
+        self.path = path
+        self.base = base
+        self.f = open(path, "w", encoding="utf-8", newline="", buffering=1)
+        self.count: int = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.close()
+
+    def write(self, result) -> None:
+        self.add(get_record(result, self.base))
+
+    def add(self, record: dict) -> None:
+        self.write_record(record)
+        self.count += 1
+
+    @abstractmethod
+    def write_record(self, record: dict) -> None:
+        pass
+
+    def close(self) -> None:
+        self.f.close()
+
+
+class NdjsonWriter(ResultWriter):
+    def write_record(self, record: dict) -> None:
+        self.f.write(json.dumps(record) + "\n")
+
+
+class JsonWriter(ResultWriter):
+    """
+    Writes a single JSON array, it is only valid JSON once the check has
+    finished. Use ndjson to read results during a check.
+    """
+
+    def __init__(self, path, base=None) -> None:
+        super().__init__(path, base)
+        self.f.write("[")
+
+    def write_record(self, record: dict) -> None:
+        self.f.write(("," if self.count else "") + "\n  " + json.dumps(record))
+
+    def close(self) -> None:
+        if not self.f.closed:
+            self.f.write("\n]\n")
+        super().close()
+
+
+class CsvWriter(ResultWriter):
+    COLUMNS = (
+        ["path", "relpath", "member", "status", "matched_by", "dat", "game", "entry", "size"]
+        + DIGEST_KEYS
+        + ["cached", "time_total"]
+        + [f"time_{name}" for name in FILE_PHASES]
+    )
+
+    def __init__(self, path, base=None) -> None:
+        super().__init__(path, base)
+        self.writer = csv.DictWriter(self.f, fieldnames=self.COLUMNS)
+        self.writer.writeheader()
+
+    def write_record(self, record: dict) -> None:
+        entry = record.pop("entry") or {}
+        digests = record.pop("digests")
+        timings = record.pop("timings") or {}
+        record["game"] = entry.get("game")
+        record["entry"] = entry.get("name")
+        record.update(digests)
+        record["time_total"] = timings.get("total")
+        for name in FILE_PHASES:
+            record[f"time_{name}"] = timings.get(name)
+        self.writer.writerow(record)
+
+
+def open_writer(output_format: str, path, base=None) -> ResultWriter:
+    writers = {"ndjson": NdjsonWriter, "csv": CsvWriter, "json": JsonWriter}
+    return writers[output_format](path, base)
+
+
+def get_result(record: dict):
+    """
+    Rebuilds a RomResult from a record written by get_record(), the entry
+    only has the attributes kept in the record
+    """
+    from .dat_handler import Rom
+    from .engine import RomResult
+
+    rom = None
+    if record.get("entry") is not None:
+        entry = record["entry"]
+        rom = Rom(
+            name=entry["name"],
+            size=None,
+            crc=None,
+            md5=None,
+            sha1=None,
+            sha256=None,
+            serial=None,
+            status=None,
+            game=entry["game"],
+            dat=record.get("dat"),
+        )
+
+    member = record.get("member")
+    return RomResult(
+        path=record["path"],
+        filename=member if member is not None else basename(record["path"]),
+        archive=basename(record["path"]) if member is not None else None,
+        ocode=record["status"],
+        rom=rom,
+        matched_by=record.get("matched_by"),
+        digests=record.get("digests") or {},
+        size=record.get("size"),
+        cached=bool(record.get("cached")),
+        timings=record.get("timings"),
+    )
+
+
+def read_csv_record(row: dict) -> dict:
+    """
+    Turns a row written by CsvWriter back into the record it was made from
+    """
+    empty = lambda value: value if value != "" else None
+    entry = None
+    if empty(row["entry"]) is not None:
+        entry = {"game": empty(row["game"]), "name": row["entry"]}
+
+    timings = None
+    if empty(row["time_total"]) is not None:
+        timings = {"total": float(row["time_total"])}
+        for name in FILE_PHASES:
+            if empty(row[f"time_{name}"]) is not None:
+                timings[name] = float(row[f"time_{name}"])
+
+    return {
+        "path": row["path"],
+        # Files written before relpath was added don't have the column
+        "relpath": empty(row.get("relpath", "")),
+        "dat": empty(row["dat"]),
+        "member": empty(row["member"]),
+        "status": row["status"],
+        "matched_by": empty(row["matched_by"]),
+        "entry": entry,
+        "size": int(row["size"]) if empty(row["size"]) is not None else None,
+        "digests": {k: row[k] for k in DIGEST_KEYS if empty(row[k]) is not None},
+        "cached": row["cached"] == "True",
+        "timings": timings,
+    }
+
+
+def read_records(path):
+    """
+    Yields the records of a file written with --output in any format, the
+    format is told from the first character of the file
+    """
+    with open(path, encoding="utf-8", newline="") as f:
+        first = f.read(1)
+        while first.isspace():
+            first = f.read(1)
+        f.seek(0)
+
+        if first == "[":
+            yield from json.load(f)
+        elif first == "{":
+            for line in f:
+                if line.strip():
+                    yield json.loads(line)
+        elif first:
+            for row in csv.DictReader(f):
+                yield read_csv_record(row)
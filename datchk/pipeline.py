@@ -0,0 +1,260 @@
+"""
+DATCHK
+A command line datfile parser and rom validator written in python.
+
+Written By: Daws
+"""
+
+from .utilities import advise_sequential, get_buffer_size, is_archive
+
+from collections import deque
+from io import BytesIO
+import os
+import queue
+import threading
+
+DEFAULT_PREFETCH_MEMORY = 64 * 1024 * 1024
+
+
+class PrefetchedFile:
+    """
+    A file which is being read ahead by the Prefetcher. The first call to
+    open() returns a stream over the chunks read so far, blocking until the
+    reader catches up. Any later call, or a file the reader skipped, is
+    read from disk as normal.
+    Archives need random access, so they are read into memory whole.
+    """
+
+    def __init__(
+        self, path: str, size: int, budget: threading.Semaphore, skipped: bool = False
+    ) -> None:
+        self.path = path
+        self.size = size
+        self.is_archive = is_archive(path)
+        self.budget = budget
+        self.skipped = skipped
+        self.chunks: deque = deque()
+        self.ready = threading.Condition()
+        self.done: bool = False
+        self.closed: bool = False
+        self.opened: bool = False
+        self.error: OSError = None
+
+    # Reader side
+
+    def add_chunk(self, chunk, slots: int = 1) -> bool:
+        with self.ready:
+            if self.closed:
+                return False
+            self.chunks.append((chunk, slots))
+            self.ready.notify()
+        return True
+
+    def finish(self, error: OSError = None) -> None:
+        with self.ready:
+            self.done = True
+            self.error = error
+            self.ready.notify()
+
+    # Consumer side
+
+    def next_chunk(self):
+        """
+        Returns the next chunk read for this file, or None at the end of the
+        file. The memory used by the chunk is handed back to the reader.
+        A read error on the reader thread is raised here, so a partly read
+        file is never hashed as if it were complete.
+        """
+        with self.ready:
+            while not self.chunks and not self.done:
+                self.ready.wait()
+            if not self.chunks:
+                if self.error is not None:
+                    raise self.error
+                return None
+            chunk, slots = self.chunks.popleft()
+        self.budget.release(slots)
+        return chunk
+
+    def open(self):
+        if self.opened or self.skipped:
+            return open(self.path, "rb")
+        self.opened = True
+
+        if self.is_archive:
+            chunk = self.next_chunk()
+            if chunk is None:
+                # The archive was too large to be prefetched
+                return open(self.path, "rb")
+            return BytesIO(chunk)
+        return PrefetchStream(self)
+
+    def close(self) -> None:
+        """
+        Stops the reader filling this file and hands back any memory held
+        by chunks which were never consumed
+        """
+        with self.ready:
+            self.closed = True
+            slots = sum(slots for chunk, slots in self.chunks)
+            self.chunks.clear()
+            self.ready.notify()
+        if slots:
+            self.budget.release(slots)
+
+
+class PrefetchStream:
+    """
+    Binary stream over the chunks of a PrefetchedFile, provides the
+    readinto() used by HashHandler.get_stream_digests()
+    """
+
+    def __init__(self, prefetched: PrefetchedFile) -> None:
+        self.prefetched = prefetched
+        self.chunk = None
+        self.offset: int = 0
+
+    def readinto(self, buf) -> int:
+        if self.chunk is None or self.offset >= len(self.chunk):
+            self.chunk = self.prefetched.next_chunk()
+            self.offset = 0
+            if self.chunk is None:
+                return 0
+
+        n = min(len(buf), len(self.chunk) - self.offset)
+        buf[:n] = self.chunk[self.offset : self.offset + n]
+        self.offset += n
+        return n
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.close()
+
+    def close(self) -> None:
+        self.prefetched.close()
+
+
+class Prefetcher:
+    """
+    Reads upcoming files on a background thread while earlier files are
+    being hashed, so the disk isn't idle while hashing and the hashers
+    aren't idle while reading.
+    depth is the number of files handed out ahead of the reader, and
+    max_memory caps the bytes held in read but unhashed chunks. Files are
+    read one at a time in order, which suits spinning disks and network
+    mounts.
+    With archives False, archives are handed out without being read, for
+    quick checks which only need the archive headers.
+    skip is an optional callable taking the path and size of a file, files
+    it returns True for won't be read by the check (ruled out by size, or
+    answered by the hash cache) and are handed out without being read.
+    It is called on the reader thread.
+    """
+
+    def __init__(
+        self,
+        roms,
+        depth: int = 4,
+        max_memory: int = DEFAULT_PREFETCH_MEMORY,
+        chunk_size: int = None,
+        archives: bool = True,
+        skip=None,
+    ) -> None:
+        self.roms = roms
+        self.archives = archives
+        self.skip = skip or (lambda path, size: False)
+        self.chunk_size = min(chunk_size or get_buffer_size(), max_memory)
+        self.max_slots = max(1, max_memory // self.chunk_size)
+        self.budget = threading.Semaphore(self.max_slots)
+        self.files: queue.Queue = queue.Queue(maxsize=max(1, depth))
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.stop()
+
+    def __iter__(self):
+        while (prefetched := self.files.get()) is not None:
+            yield prefetched
+
+    def stop(self) -> None:
+        self.stopped.set()
+        # Unblock the reader if it is waiting for room in the queue
+        try:
+            while True:
+                self.files.get_nowait()
+        except queue.Empty:
+            pass
+
+    def acquire(self, slots: int) -> bool:
+        for _ in range(slots):
+            while not self.budget.acquire(timeout=0.1):
+                if self.stopped.is_set():
+                    return False
+        return True
+
+    def put(self, item) -> bool:
+        while not self.stopped.is_set():
+            try:
+                self.files.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def run(self) -> None:
+        try:
+            for rom in self.roms:
+                if self.stopped.is_set():
+                    return
+                try:
+                    size = os.stat(rom).st_size
+                except OSError:
+                    size = None
+
+                skipped = size is not None and self.skip(str(rom), size)
+                prefetched = PrefetchedFile(str(rom), size, self.budget, skipped)
+                if not self.put(prefetched):
+                    return
+                if skipped:
+                    prefetched.finish()
+                else:
+                    self.read(prefetched)
+        finally:
+            self.put(None)
+
+    def read(self, prefetched: PrefetchedFile) -> None:
+        error = None
+        try:
+            with open(prefetched.path, "rb", buffering=0) as f:
+                advise_sequential(f.fileno())
+
+                if prefetched.is_archive:
+                    # Archives larger than the whole budget are left unread and
+                    # read from disk by the consumer
+                    if prefetched.size is None or not self.archives:
+                        return
+                    slots = max(1, -(-prefetched.size // self.chunk_size))
+                    if slots <= self.max_slots and self.acquire(slots):
+                        if not prefetched.add_chunk(f.read(), slots):
+                            self.budget.release(slots)
+                    return
+
+                while not prefetched.closed:
+                    if not self.acquire(1):
+                        return
+                    chunk = f.read(self.chunk_size)
+                    if not chunk or not prefetched.add_chunk(chunk):
+                        self.budget.release(1)
+                        return
+        except OSError as e:
+            # Raised to the consumer once it reaches the missing data
+            error = e
+        finally:
+            prefetched.finish(error)
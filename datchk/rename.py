@@ -0,0 +1,261 @@
+"""
+DATCHK
+A command line datfile parser and rom validator written in python.
+
+Written By: Daws
+"""
+
+from collections import Counter
+from dataclasses import dataclass
+from os.path import basename, dirname, join, lexists
+import os
+import shutil
+
+# Names which can't be used as a file name in the same folder
+UNSAFE_NAMES = ["", ".", ".."]
+
+
+@dataclass(slots=True)
+class Rename:
+    """
+    A file or zip member to be given the name of its datfile entry, from
+    the datfile dat. reason is set when the rename has to be skipped.
+    """
+
+    path: str
+    new_name: str
+    member: str = None
+    dat: str = None
+    reason: str = None
+    in_cycle: bool = False
+
+    @property
+    def source(self) -> str:
+        if self.member is not None:
+            return f"{self.path}/{self.member}"
+        return self.path
+
+    @property
+    def target(self) -> str:
+        if self.member is not None:
+            return f"{self.path}/{self.new_name}"
+        return join(dirname(self.path), self.new_name)
+
+
+def get_rename(result) -> Rename:
+    """
+    Returns the Rename of a PBIN result, from the digests the check already
+    matched with
+    """
+    if result.archive is not None:
+        return Rename(
+            result.path, result.rom.name, member=result.filename, dat=result.rom.dat
+        )
+    return Rename(result.path, result.rom.name, dat=result.rom.dat)
+
+
+def get_temp_path(path, index: int) -> str:
+    # Kept in the same folder so every rename stays on one filesystem
+    return join(dirname(path), f".{basename(path)}.{os.getpid()}.{index}.tmp")
+
+
+class RenamePlan:
+    """
+    Every rename of a check, worked out before anything is renamed. A rename
+    is skipped when its new name is taken by a file which isn't renamed
+    itself, or another file would get the same name. Renames which swap
+    names with each other (cycles) are fine, apply() moves every file to a
+    temporary name before giving any file its new name.
+    """
+
+    def __init__(self, renames: list, members: bool = False) -> None:
+        self.renames = renames
+        self.members = members
+        # {archive:member names} of every zip with a member to rename
+        self.archive_names: dict = {}
+        self.cycles: int = 0
+
+        self.check_names()
+        self.check_targets()
+        self.find_cycles()
+
+    @property
+    def applied(self) -> list:
+        return [rename for rename in self.renames if rename.reason is None]
+
+    @property
+    def skipped(self) -> list:
+        return [rename for rename in self.renames if rename.reason is not None]
+
+    def check_names(self) -> None:
+        # A file which already has its datfile name isn't renamed at all,
+        # it would otherwise count as a cycle of one
+        self.renames = [r for r in self.renames if r.target != r.source]
+        for rename in self.renames:
+            name = rename.new_name
+            if name in UNSAFE_NAMES or "/" in name or "\\" in name:
+                rename.reason = "the datfile name isn't a plain file name"
+            elif rename.member is None:
+                continue
+            elif not self.members:
+                rename.reason = "inside an archive, use --rename-members"
+            elif not rename.path.endswith(".zip"):
+                rename.reason = "only zip members can be renamed"
+            else:
+                self.read_archive(rename)
+
+    def read_archive(self, rename: Rename) -> None:
+        """
+        Reads the member names of the archive once, archives with encrypted
+        members are left alone
+        """
+        from zipfile import BadZipFile, ZipFile
+
+        if rename.path not in self.archive_names:
+            try:
+                with ZipFile(rename.path) as archive:
+                    infos = archive.infolist()
+            except (OSError, BadZipFile):
+                self.archive_names[rename.path] = None
+            else:
+                if any(info.flag_bits & 0x1 for info in infos):
+                    self.archive_names[rename.path] = None
+                else:
+                    self.archive_names[rename.path] = {
+                        info.filename for info in infos
+                    }
+        if self.archive_names[rename.path] is None:
+            rename.reason = "the archive can't be rewritten"
+
+    def target_exists(self, rename: Rename) -> bool:
+        if rename.member is not None:
+            return rename.new_name in self.archive_names[rename.path]
+        return lexists(rename.target)
+
+    def check_targets(self) -> None:
+        targets = Counter(r.target for r in self.renames if r.reason is None)
+        for rename in self.renames:
+            if rename.reason is None and targets[rename.target] > 1:
+                rename.reason = "another file would get the same name"
+
+        # A name is only free if the file holding it is renamed too. When a
+        # rename is skipped its file keeps its name, so the rename waiting
+        # for that name is checked again.
+        sources = {r.source: r for r in self.renames if r.reason is None}
+        by_target = {r.target: r for r in sources.values()}
+        waiting = list(sources.values())
+        while waiting:
+            rename = waiting.pop()
+            if rename.reason is not None:
+                continue
+            if rename.target in sources or not self.target_exists(rename):
+                continue
+            rename.reason = "a file with the new name already exists"
+            del sources[rename.source]
+            blocked = by_target.get(rename.source)
+            if blocked is not None and blocked.reason is None:
+                waiting.append(blocked)
+
+    def find_cycles(self) -> None:
+        """
+        Marks renames which form a cycle. Targets are unique, so following
+        each source to its target only ever meets a chain or a loop.
+        """
+        sources = {r.source: r for r in self.applied}
+        visited = set()
+        for rename in sources.values():
+            # {source:position} of the renames followed from this one
+            chain = {}
+            while rename is not None and rename.source not in visited:
+                visited.add(rename.source)
+                chain[rename.source] = len(chain)
+                rename = sources.get(rename.target)
+            if rename is not None and rename.source in chain:
+                self.cycles += 1
+                for source in list(chain)[chain[rename.source]:]:
+                    sources[source].in_cycle = True
+
+    def apply(self) -> list:
+        """
+        Renames everything in the plan as one batch. Rewritten zips are
+        written next to the originals first, then every file is moved to a
+        temporary name and only then to its new name. If anything fails,
+        each step is undone in reverse so nothing is left half renamed.
+        Returns the (old, new) path of every file renamed.
+        """
+        files = [rename for rename in self.applied if rename.member is None]
+        archives = {}
+        for rename in self.applied:
+            if rename.member is not None:
+                archives.setdefault(rename.path, {})[rename.member] = rename.new_name
+
+        # (current, original) path of every step, for undoing them
+        journal = []
+        staged = []
+        try:
+            for index, (path, names) in enumerate(archives.items()):
+                staged_path = rewrite_zip(path, names, get_temp_path(path, index))
+                staged.append((path, staged_path))
+
+            temp_paths = []
+            for index, rename in enumerate(files):
+                temp_path = get_temp_path(rename.path, len(archives) + index)
+                os.rename(rename.path, temp_path)
+                journal.append((temp_path, rename.path))
+                temp_paths.append(temp_path)
+            for rename, temp_path in zip(files, temp_paths):
+                if lexists(rename.target):
+                    raise FileExistsError(f"{rename.target} was created while renaming")
+                os.rename(temp_path, rename.target)
+                journal.append((rename.target, temp_path))
+
+            backups = []
+            for index, (path, staged_path) in enumerate(staged):
+                backup = get_temp_path(path, len(archives) + len(files) + index)
+                os.rename(path, backup)
+                journal.append((backup, path))
+                os.rename(staged_path, path)
+                journal.append((path, staged_path))
+                backups.append(backup)
+        except BaseException:
+            for current, original in reversed(journal):
+                os.rename(current, original)
+            for _, staged_path in staged:
+                os.remove(staged_path)
+            raise
+
+        for backup in backups:
+            os.remove(backup)
+        return [(rename.path, rename.target) for rename in files]
+
+
+def rewrite_zip(path, names: dict, new_path) -> str:
+    """
+    Copies a zip to new_path with members renamed by names {old:new}. The
+    data is copied as it is decompressed, nothing is hashed again.
+    """
+    from zipfile import ZipFile, ZipInfo, ZIP64_LIMIT
+
+    try:
+        with ZipFile(path) as src, ZipFile(new_path, "w") as dst:
+            dst.comment = src.comment
+            for info in src.infolist():
+                name = names.get(info.filename, info.filename)
+                new_info = ZipInfo(name, info.date_time)
+                new_info.compress_type = info.compress_type
+                new_info.external_attr = info.external_attr
+                new_info.create_system = info.create_system
+                new_info.comment = info.comment
+                new_info.file_size = info.file_size
+                if info.is_dir():
+                    dst.writestr(new_info, b"")
+                    continue
+                with src.open(info) as fsrc, dst.open(
+                    new_info, "w", force_zip64=info.file_size > ZIP64_LIMIT
+                ) as fdst:
+                    shutil.copyfileobj(fsrc, fdst, 1024 * 1024)
+    except BaseException:
+        if lexists(new_path):
+            os.remove(new_path)
+        raise
+    return new_path
@@ -0,0 +1,189 @@
+"""
+DATCHK
+A command line datfile parser and rom validator written in python.
+
+Written By: Daws
+"""
+
+from collections import Counter
+from os.path import basename, isabs, relpath
+from rich.align import Align
+from rich.table import Table
+
+# Output codes counted per datfile, NIDF results don't belong to a datfile
+REPORT_CODES = ["PASS", "PBIN", "FAIL", "CSNA"]
+
+
+class Report:
+    """
+    The result counts of a check and the statistics and warnings shown
+    from them at the end. Results are added by a running check, or by
+    `datchk merge` from the --output files of several checks.
+    """
+
+    def __init__(self, console, datfiles: list, base_path=None, keep_results=True):
+        self.console = console
+        # Files are shown relative to base_path when it is set
+        self.base_path = base_path
+        self.rom_count: int = 0
+
+        self.ocode_color_lkup = {
+            "PASS": "green",
+            "FAIL": "red",
+            "CSNA": "yellow",
+            "PBIN": "blue",
+            "NIDF": "magenta",
+        }
+
+        # Results
+        self.results: dict = {}
+        self.results_passed: int = 0
+        self.results_count: Counter = Counter()
+        self.pbin_map: dict = {}
+        self.arc_map: dict = {}
+        # With several datfiles, results are counted and reported per datfile
+        self.datfiles: list = list(datfiles)
+        self.dat_counts: dict = {datfile: Counter() for datfile in self.datfiles}
+        self.dat_map: dict = {}
+
+        # Without keep_results only the counts are kept, the per file
+        # results above aren't for the report tree
+        self.keep_results: bool = keep_results
+
+    def add_result(self, result) -> None:
+        if result.rom is not None:
+            if result.rom.dat not in self.dat_counts:
+                self.datfiles.append(result.rom.dat)
+                self.dat_counts[result.rom.dat] = Counter()
+            self.dat_counts[result.rom.dat][result.ocode] += 1
+
+        if result.ocode == "PASS":
+            self.results_passed += 1
+            return
+
+        self.results_count[result.ocode] += 1
+        if not self.keep_results:
+            return
+
+        if result.archive is not None:
+            self.arc_map[result.key] = (result.path, result.filename)
+        if result.rom is not None:
+            self.dat_map[result.key] = result.rom.dat
+        self.results[result.key] = result.ocode
+        if result.ocode == "PBIN":
+            self.pbin_map[result.key] = result.rom.name
+
+    def add_renamed(self, key: str, dat: str) -> None:
+        """
+        A PBIN result whose file was given its datfile name by --rename now
+        passes, it is listed by the rename report instead of the report tree
+        """
+        self.results_count["PBIN"] -= 1
+        # An empty Counter means there are no warnings, so drop a count of 0
+        self.results_count = +self.results_count
+        self.results_passed += 1
+        if dat in self.dat_counts:
+            self.dat_counts[dat]["PBIN"] -= 1
+            self.dat_counts[dat]["PASS"] += 1
+
+        for results in (self.results, self.pbin_map, self.arc_map, self.dat_map):
+            results.pop(key, None)
+
+    def get_display_name(self, path: str) -> str:
+        # Files are shown relative to the checked directory, so files with
+        # the same name in different subdirectories can be told apart.
+        # Results merged from several checks already are.
+        if not isabs(path):
+            return path
+        if self.base_path is not None:
+            return relpath(path, self.base_path)
+        return basename(path)
+
+    def show_statistics(self):
+        self.console.rule("Statistics")
+        results_table = Table(show_header=False, show_lines=True)
+        results_table.add_column("Result")
+        results_table.add_column("Count")
+
+        results_table.add_row("Processed", f"[bold green]{self.rom_count}")
+        results_table.add_row("Passed", f"[bold green]{self.results_passed}")
+        results_table.add_row(
+            "Passed But Incorrect Name", f"[bold green]{self.results_count['PBIN']}"
+        )
+        results_table.add_row("Failed", f"[bold green]{self.results_count['FAIL']}")
+        results_table.add_row(
+            "CheckSum N/A", f"[bold green]{self.results_count['CSNA']}"
+        )
+        results_table.add_row(
+            "Not In DatFile", f"[bold green]{self.results_count['NIDF']}"
+        )
+
+        self.console.print(Align.center(results_table))
+        if len(self.datfiles) > 1:
+            self.console.print(Align.center(self.build_dat_table()))
+
+    def build_dat_table(self):
+        table = Table("Datfile", "Passed", "PBIN", "Failed", "CSNA", show_lines=True)
+        for datfile, counts in self.dat_counts.items():
+            table.add_row(
+                basename(datfile),
+                *[f"[bold green]{counts[ocode]}" for ocode in REPORT_CODES],
+            )
+        return table
+
+    def generate_report_tree(self):
+        from rich.tree import Tree
+
+        report_tree = Tree("Warnings and Failures", hide_root=True)
+        no_warnings = not self.results_count
+
+        if len(self.datfiles) == 1:
+            self.add_report_branches(report_tree, self.results)
+        else:
+            # Files which matched an entry are grouped under its datfile,
+            # files in none of the datfiles are listed after them
+            groups = {datfile: {} for datfile in self.datfiles + [None]}
+            for rom_name, ocode in self.results.items():
+                groups[self.dat_map.get(rom_name)][rom_name] = ocode
+            for datfile, results in groups.items():
+                if results:
+                    label = basename(datfile) if datfile else "No Datfile"
+                    self.add_report_branches(report_tree.add(f"[bold]{label}"), results)
+
+        if no_warnings:
+            self.console.print(
+                "[bold green] All files passed, no failures or warnings to report.."
+            )
+        else:
+            self.console.rule("Warnings and Failures")
+            self.console.print(report_tree)
+
+    def add_report_branches(self, report_tree, results: dict) -> None:
+        ocodes = set(results.values())
+        if "FAIL" in ocodes:
+            fail_tree = report_tree.add("Failed")
+        if "CSNA" in ocodes:
+            csna_tree = report_tree.add("Checksum N/A")
+        if "NIDF" in ocodes:
+            nidf_tree = report_tree.add("Not In DatFile")
+        if "PBIN" in ocodes:
+            pbin_tree = report_tree.add("Passed But Incorrect Name")
+
+        for rom_name, ocode in results.items():
+            if rom_name in self.arc_map:
+                archive, member = self.arc_map[rom_name]
+                archive = self.get_display_name(archive)
+                label = f"[bold default](A) [/bold default][{self.ocode_color_lkup[ocode]}]{archive}[bold default] -> [/bold default][green]{member}"
+            else:
+                label = f"[{self.ocode_color_lkup[ocode]}]{self.get_display_name(rom_name)}"
+
+            match ocode:
+                case "FAIL":
+                    fail_tree.add(label)
+                case "CSNA":
+                    csna_tree.add(label)
+                case "NIDF":
+                    nidf_tree.add(label)
+                case "PBIN":
+                    branch = pbin_tree.add(label)
+                    branch.add(f"Suggested Name: [green]{self.pbin_map[rom_name]}")
@@ -0,0 +1,208 @@
+"""
+DATCHK
+A command line datfile parser and rom validator written in python.
+
+Written By: Daws
+"""
+
+from bisect import bisect_left
+from pathlib import Path
+import marshal
+import os
+import re
+
+SEARCH_MAGIC = b"DATCHKSX"
+SEARCH_VERSION = 1
+
+# Tags are the bracketed parts of a name, such as (USA, Europe), (En,Fr)
+# or [b], and are indexed apart from the title
+TAG_RE = re.compile(r"[\(\[]([^\)\]]*)[\)\]]")
+TOKEN_RE = re.compile(r"[^\W_]+")
+
+# Scores for a query term matching a title token exactly, as a prefix or
+# inside it. Tags only count when they match exactly or as a prefix.
+EXACT_SCORE = 4
+PREFIX_SCORE = 3
+SUBSTRING_SCORE = 1
+TAG_SCORE = 2
+# Bonus when the query terms appear in the title in the same order
+ORDER_BONUS = 2
+
+
+def tokenize(text: str) -> list:
+    return TOKEN_RE.findall(text.casefold())
+
+
+def split_name(name: str) -> tuple:
+    """
+    Splits a game name into its title tokens and its tags, so
+    "Super Mario Bros. (USA, Europe) (Rev 1)" gives
+    (["super", "mario", "bros"], ["usa", "europe", "rev 1"])
+    """
+    tags = [
+        " ".join(tokenize(tag))
+        for group in TAG_RE.findall(name)
+        for tag in group.split(",")
+        if tokenize(tag)
+    ]
+    return tokenize(TAG_RE.sub(" ", name)), tags
+
+
+def add_posting(postings: dict, key: str, doc: int) -> None:
+    docs = postings.setdefault(key, [])
+    # Documents are added in order, so a repeated token is always last
+    if not docs or docs[-1] != doc:
+        docs.append(doc)
+
+
+class SearchIndex:
+    """
+    Inverted index over the game names of a datfile. Every game is a
+    document, its title tokens and its tags are indexed separately so a
+    region or language can be searched for without matching titles.
+    A query matches games which contain every query term in any order,
+    each term matching a token exactly, as a prefix or as a substring.
+    Results are ranked by how well each term matched.
+    """
+
+    def __init__(self) -> None:
+        # Position in DatParser.roms of the first rom of each game
+        self.docs: list = []
+        self.titles: dict = {}
+        self.tags: dict = {}
+        self.vocabulary: list = []
+        self.tag_vocabulary: list = []
+
+    @classmethod
+    def build(cls, dat) -> "SearchIndex":
+        index = cls()
+        for doc, pos in enumerate(dat.game_index.values()):
+            index.docs.append(pos)
+            title, tags = split_name(dat.roms[pos].game or dat.roms[pos].name)
+            for token in title:
+                add_posting(index.titles, token, doc)
+            for tag in tags:
+                add_posting(index.tags, tag, doc)
+                # Multi word tags such as "rev 1" are found by each word too
+                for token in tag.split()[1:]:
+                    add_posting(index.tags, token, doc)
+
+        index.vocabulary = sorted(index.titles)
+        index.tag_vocabulary = sorted(index.tags)
+        return index
+
+    @classmethod
+    def load(cls, path, datfile_key: tuple) -> "SearchIndex":
+        """
+        Returns the index saved at path, or None if it is missing or was
+        built from a different version of the datfile
+        """
+        try:
+            with open(path, "rb") as f:
+                if f.read(len(SEARCH_MAGIC)) != SEARCH_MAGIC:
+                    return None
+                # marshal.load() reads a file in small pieces, reading it
+                # whole first is many times faster
+                data = marshal.loads(f.read())
+        except (OSError, ValueError, EOFError, TypeError):
+            return None
+
+        if (
+            not isinstance(data, dict)
+            or data.get("version") != SEARCH_VERSION
+            or data.get("datfile") != datfile_key
+        ):
+            return None
+
+        index = cls()
+        index.docs = data["docs"]
+        index.titles = data["titles"]
+        index.tags = data["tags"]
+        index.vocabulary = sorted(index.titles)
+        index.tag_vocabulary = sorted(index.tags)
+        return index
+
+    def save(self, path, datfile_key: tuple) -> None:
+        data = {
+            "version": SEARCH_VERSION,
+            "datfile": datfile_key,
+            "docs": self.docs,
+            "titles": self.titles,
+            "tags": self.tags,
+        }
+
+        path = Path(path)
+        tmp_path = path.with_suffix(f".{os.getpid()}.tmp")
+        try:
+            path.parent.mkdir(parents=True, exist_ok=True)
+            with open(tmp_path, "wb") as f:
+                f.write(SEARCH_MAGIC)
+                f.write(marshal.dumps(data))
+            os.replace(tmp_path, path)
+        except OSError:
+            tmp_path.unlink(missing_ok=True)
+
+    def match_prefix(self, vocabulary: list, term: str):
+        start = bisect_left(vocabulary, term)
+        for token in vocabulary[start:]:
+            if not token.startswith(term):
+                break
+            yield token
+
+    def match_term(self, term: str) -> dict:
+        """
+        Returns {doc:score} for every game matched by a single query term,
+        keeping the best score when a game matches it more than once
+        """
+        scores = {}
+
+        def add(postings: list, score: int) -> None:
+            for doc in postings:
+                if scores.get(doc, 0) < score:
+                    scores[doc] = score
+
+        for token in self.match_prefix(self.vocabulary, term):
+            add(self.titles[token], EXACT_SCORE if token == term else PREFIX_SCORE)
+        for token in self.match_prefix(self.tag_vocabulary, term):
+            add(self.tags[token], TAG_SCORE)
+
+        # Substring matches need a scan of the vocabulary, which is far
+        # smaller than the number of games
+        if len(term) > 1:
+            for token in self.vocabulary:
+                if term in token and not token.startswith(term):
+                    add(self.titles[token], SUBSTRING_SCORE)
+
+        return scores
+
+    def search(self, query: str, roms: list) -> list:
+        """
+        Returns the positions in roms (DatParser.roms) of every game matching
+        all of the terms in query, best match first. Games with the terms in
+        the same order as the query rank higher, ties go to the shorter name.
+        """
+        terms = list(dict.fromkeys(tokenize(query)))
+        if not terms:
+            return []
+
+        # Start from the rarest term, so fewer scores are carried forward
+        matches = sorted((self.match_term(term) for term in terms), key=len)
+        scores = matches[0]
+        for term_scores in matches[1:]:
+            scores = {
+                doc: score + term_scores[doc]
+                for doc, score in scores.items()
+                if doc in term_scores
+            }
+
+        phrase = " ".join(tokenize(query))
+        ranked = []
+        for doc, score in scores.items():
+            pos = self.docs[doc]
+            name = roms[pos].name
+            if len(terms) > 1 and phrase in " ".join(tokenize(name)):
+                score += ORDER_BONUS
+            ranked.append((-score, len(name), name, pos))
+
+        ranked.sort()
+        return [pos for score, length, name, pos in ranked]
@@ -0,0 +1,179 @@
+"""
+DATCHK
+A command line datfile parser and rom validator written in python.
+
+Written By: Daws
+"""
+
+from contextlib import contextmanager
+from time import perf_counter
+import heapq
+import json
+
+# Phases of a check, in the order they happen to a file.
+# lookup covers everything for a file which isn't reading, decompressing or
+# hashing it: datfile lookups, comparing digests and result bookkeeping.
+PHASES = ["parse", "scan", "lookup", "read", "extract", "hash", "render"]
+FILE_PHASES = ["lookup", "read", "extract", "hash"]
+
+SLOWEST_FILES = 10
+
+
+def get_file_timings(hasher, elapsed: float) -> dict:
+    """
+    Splits the time taken to check one file into its phases from the
+    counters kept by its HashHandler
+    """
+    timings = {
+        "read": hasher.read_time,
+        "extract": hasher.extract_time,
+        "hash": hasher.hash_time,
+    }
+    timings["lookup"] = max(0.0, elapsed - sum(timings.values()))
+    timings["total"] = elapsed
+    return timings
+
+
+def format_rate(value: float, unit: str = "") -> str:
+    for prefix in ["", "K", "M", "G"]:
+        if value < 1024 or prefix == "G":
+            break
+        value /= 1024
+    return f"{value:.1f} {prefix}{unit}/s"
+
+
+class CheckStats:
+    """
+    Phase timings and throughput for a check. Phases run on the main
+    thread (parse, scan, render) are wall clock times, the per file phases
+    are summed over every file so with --jobs they can add up to more than
+    the wall time.
+    """
+
+    def __init__(self, slowest: int = SLOWEST_FILES) -> None:
+        self.phases: dict = dict.fromkeys(PHASES, 0.0)
+        self.files: int = 0
+        # One result per plain file and per archive member
+        self.results: int = 0
+        self.read_bytes: int = 0
+        self.cache_hits: int = 0
+        self.wall_time: float = 0.0
+        self.max_slowest = slowest
+        # Min heap of (seconds, order, path, timings), so the fastest of the
+        # slowest files is the one replaced
+        self.slowest: list = []
+        self.start = perf_counter()
+
+    @contextmanager
+    def phase(self, name: str):
+        start = perf_counter()
+        try:
+            yield
+        finally:
+            self.phases[name] += perf_counter() - start
+
+    def add_file(self, results: list) -> None:
+        self.files += 1
+        self.results += len(results)
+        self.read_bytes += results[0].read_bytes
+        self.cache_hits += results[0].cached
+
+        timings = results[0].timings
+        if timings is None:
+            return
+        for name in FILE_PHASES:
+            self.phases[name] += timings[name]
+
+        item = (timings["total"], self.files, results[0].path, timings)
+        if len(self.slowest) < self.max_slowest:
+            heapq.heappush(self.slowest, item)
+        elif item > self.slowest[0]:
+            heapq.heapreplace(self.slowest, item)
+
+    def finish(self) -> None:
+        self.wall_time = perf_counter() - self.start
+
+    def get_slowest(self) -> list:
+        return [
+            {"path": path, "seconds": seconds}
+            | {name: timings[name] for name in FILE_PHASES}
+            for seconds, order, path, timings in sorted(self.slowest, reverse=True)
+        ]
+
+    def to_dict(self) -> dict:
+        wall_time = self.wall_time or 1e-9
+        return {
+            "wall_time": self.wall_time,
+            "files": self.files,
+            "results": self.results,
+            "cache_hits": self.cache_hits,
+            "read_bytes": self.read_bytes,
+            "bytes_per_second": self.read_bytes / wall_time,
+            "files_per_second": self.files / wall_time,
+            "phases": dict(self.phases),
+            "phases_per_file": {
+                name: self.phases[name] / self.files if self.files else 0.0
+                for name in FILE_PHASES
+            },
+            "slowest": self.get_slowest(),
+        }
+
+    def save(self, path, **extra) -> None:
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(extra | self.to_dict(), f, indent=2)
+
+    def build_throughput_table(self):
+        from rich.table import Table
+
+        data = self.to_dict()
+        table = Table(title="Throughput", show_header=False, show_lines=True)
+        table.add_column("Counter")
+        table.add_column("Value", justify="right")
+
+        table.add_row("Wall Time", f"{self.wall_time:.3f}s")
+        table.add_row("Files", str(self.files))
+        table.add_row("Results", str(self.results))
+        table.add_row("Cache Hits", str(self.cache_hits))
+        table.add_row("Bytes Read", f"{self.read_bytes:,}")
+        table.add_row("Read Rate", format_rate(data["bytes_per_second"], "B"))
+        table.add_row("File Rate", f"{data['files_per_second']:.1f} files/s")
+        return table
+
+    def build_phase_table(self):
+        from rich.table import Table
+
+        table = Table(title="Phases", show_lines=True)
+        table.add_column("Phase")
+        table.add_column("Total", justify="right")
+        table.add_column("Per File", justify="right")
+        table.add_column("Share", justify="right")
+
+        total = sum(self.phases.values()) or 1e-9
+        for name in PHASES:
+            per_file = ""
+            if name in FILE_PHASES and self.files:
+                per_file = f"{self.phases[name] / self.files * 1000:.2f}ms"
+            table.add_row(
+                name.capitalize(),
+                f"{self.phases[name]:.3f}s",
+                per_file,
+                f"{self.phases[name] / total:.1%}",
+            )
+        return table
+
+    def build_slowest_table(self):
+        from rich.table import Table
+
+        table = Table(title="Slowest Files", show_lines=True)
+        table.add_column("File")
+        table.add_column("Total", justify="right")
+        for name in FILE_PHASES:
+            table.add_column(name.capitalize(), justify="right")
+
+        for item in self.get_slowest():
+            table.add_row(
+                item["path"],
+                f"{item['seconds']:.3f}s",
+                *[f"{item[name]:.3f}s" for name in FILE_PHASES],
+            )
+        return table
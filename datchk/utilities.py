@@ -6,45 +6,546 @@ Written By: Daws
 """
 
 import hashlib
-from pathlib import Path
-from py7zr import SevenZipFile
-from zipfile import ZipFile
+import heapq
+import lzma
+import mmap
+import os
+import threading
+import zlib
+from contextlib import contextmanager
+from fnmatch import fnmatch
+from pathlib import Path, PurePath
+from time import perf_counter
 
-CHUNK_SIZE = 16 * 1024
+# Files in a directory given with --file which are loaded as datfiles
+DATFILE_SUFFIXES = [".dat", ".xml"]
 
+# Read buffers are sized between these limits from the size of the file
+# being read, unless a fixed buffer size is given to HashHandler
+MIN_BUFFER_SIZE = 64 * 1024
+MAX_BUFFER_SIZE = 4 * 1024 * 1024
 
-def extract_archive(rom_path, tmpdir) -> str:
-    if Path(rom_path).suffix == ".zip":
-        with ZipFile(rom_path, "r") as z:
-            rom_name = z.namelist()[0]
-            z.extract(rom_name, tmpdir.name)
+# Each thread keeps one read buffer which is reused for every file it reads
+_buffers = threading.local()
 
-    elif Path(rom_path).suffix == ".7z":
-        with SevenZipFile(rom_path, "r") as z:
-            rom_name = z.files.files_list[0]["filename"]
-            z.extract(path=tmpdir.name)
 
-    return rom_name
+def get_buffer_size(file_size: int = None) -> int:
+    """
+    Adaptive buffer size, small files are read in a single call and large
+    files with a buffer of MAX_BUFFER_SIZE. The size is rounded up to a
+    multiple of MIN_BUFFER_SIZE so thread buffers are rarely reallocated.
+    """
+    if file_size is None:
+        return MAX_BUFFER_SIZE
+    size = max(MIN_BUFFER_SIZE, min(file_size, MAX_BUFFER_SIZE))
+    return -(-size // MIN_BUFFER_SIZE) * MIN_BUFFER_SIZE
 
 
-class HashHandler:
+def get_read_buffer(size: int) -> memoryview:
+    """
+    Returns a view of this thread's read buffer, which is only reallocated
+    when a larger buffer than before is needed
+    """
+    buf = getattr(_buffers, "buf", None)
+    if buf is None or len(buf) < size:
+        buf = _buffers.buf = bytearray(size)
+    return memoryview(buf)[:size]
+
+
+def advise_sequential(fd: int) -> None:
+    # Tells the kernel the whole file will be read in order so it can read
+    # ahead more aggressively, this is only available on POSIX systems
+    if hasattr(os, "posix_fadvise"):
+        try:
+            os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_SEQUENTIAL)
+        except OSError:
+            pass
+
+
+SYMLINK_POLICIES = ["skip", "files", "follow"]
+
+ARCHIVE_SUFFIXES = [".zip", ".7z"]
+
+# Digests of an archive member which was skipped without decompressing it
+# hold only its uncompressed size under this key
+SKIPPED_SIZE = "skipped_size"
+
+
+def is_archive(rom_path) -> bool:
+    return Path(rom_path).suffix in ARCHIVE_SUFFIXES
+
+
+def find_datfiles(path) -> list:
+    """
+    Returns path if it is a file, or every datfile directly inside it if it
+    is a directory, sorted by name
+    """
+    if not os.path.isdir(path):
+        return [path]
+    return sorted(
+        entry.path
+        for entry in os.scandir(path)
+        if entry.is_file() and Path(entry.name).suffix.lower() in DATFILE_SUFFIXES
+    )
+
+
+def get_source_path(rom) -> str:
+    """
+    Files are passed around either as a path or as a source with a path
+    attribute and an open() method, such as a prefetched file
+    """
+    if isinstance(rom, (str, os.PathLike)):
+        return str(rom)
+    return rom.path
+
+
+def open_source(rom, buffering: int = -1):
+    if isinstance(rom, (str, os.PathLike)):
+        return open(rom, "rb", buffering=buffering)
+    return rom.open()
+
+
+# Raised by the decompressors for corrupt compressed data, zip and 7z members
+# can both be deflate or LZMA compressed
+DECOMPRESS_ERRORS = (zlib.error, lzma.LZMAError, EOFError, OSError)
+
+
+def get_archive_errors(suffix: str) -> tuple:
+    """
+    Exceptions raised for an archive which can't be read. The archive
+    modules are only imported once an archive is seen, py7zr in particular
+    is slow to import.
+    """
+    if suffix == ".7z":
+        from py7zr.exceptions import (
+            ArchiveError,
+            Bad7zFile,
+            CrcError,
+            PasswordRequired,
+        )
+
+        return DECOMPRESS_ERRORS + (ArchiveError, Bad7zFile, CrcError, PasswordRequired)
+
+    from zipfile import BadZipFile
+
+    return DECOMPRESS_ERRORS + (BadZipFile,)
+
+
+def matches_any(name: str, rel_path: str, patterns) -> bool:
+    # Patterns are matched against both the name and the path relative to
+    # the scanned directory, so "*.bin" and "Disc 1/*" both work
+    return any(fnmatch(name, p) or fnmatch(rel_path, p) for p in patterns)
+
+
+def scan_path(
+    path,
+    recursive: bool = False,
+    include: list = None,
+    exclude: list = None,
+    max_depth: int = None,
+    symlinks: str = "files",
+):
+    """
+    Yields the absolute path of every file in a directory as soon as it is
+    found, so checking can start before the whole tree has been scanned.
+    include/exclude are lists of glob patterns, excluded directories are
+    not descended into. max_depth limits recursion, 0 is only the files in
+    path itself. symlinks is one of SYMLINK_POLICIES: skip every symlink,
+    follow symlinks to files only (the default), or follow directory
+    symlinks as well.
+    """
+    root = os.path.abspath(path)
+    if not recursive:
+        max_depth = 0
+    # Directories already scanned, in case followed symlinks form a loop
+    visited = set()
+    stack = [(root, 0)]
+
+    while stack:
+        directory, depth = stack.pop()
+        try:
+            st = os.stat(directory)
+            if (st.st_dev, st.st_ino) in visited:
+                continue
+            visited.add((st.st_dev, st.st_ino))
+            with os.scandir(directory) as it:
+                entries = sorted(it, key=lambda e: e.name)
+        except OSError:
+            continue
+
+        subdirs = []
+        for entry in entries:
+            rel_path = PurePath(os.path.relpath(entry.path, root)).as_posix()
+            try:
+                is_link = entry.is_symlink()
+                if is_link and symlinks == "skip":
+                    continue
+
+                if entry.is_dir(follow_symlinks=symlinks == "follow"):
+                    if max_depth is None or depth < max_depth:
+                        if not (exclude and matches_any(entry.name, rel_path, exclude)):
+                            subdirs.append((entry.path, depth + 1))
+                    continue
+
+                if not entry.is_file():
+                    continue
+            except OSError:
+                continue
+
+            if include and not matches_any(entry.name, rel_path, include):
+                continue
+            if exclude and matches_any(entry.name, rel_path, exclude):
+                continue
+            yield entry.path
+
+        # Reversed so directories are visited in name order
+        stack.extend(reversed(subdirs))
+
+
+SHARD_METHODS = ["hash", "size"]
+
+
+def get_shard_key(path, base) -> str:
+    """
+    Files are assigned to shards by their path relative to the checked
+    directory, so machines with the collection mounted in different places
+    agree on the split
+    """
+    return PurePath(os.path.relpath(path, base)).as_posix()
+
+
+def shard_by_hash(paths, index: int, count: int, base):
+    """
+    Yields the paths in shard index (0 based) of count, each path belongs to
+    the shard picked by a hash of its key. The scan keeps streaming, but the
+    shards are only as even as the number of files in each.
+    """
+    for path in paths:
+        digest = hashlib.sha1(get_shard_key(path, base).encode()).digest()
+        if int.from_bytes(digest[:8], "big") % count == index:
+            yield path
+
+
+def shard_by_size(paths, index: int, count: int, base):
+    """
+    Yields the paths in shard index (0 based) of count, splitting the files
+    so each shard has close to the same number of bytes. Every file has to
+    be scanned before the first is yielded. Largest files are placed first,
+    each in the shard with the fewest bytes so far.
+    """
+    files = []
+    for path in paths:
+        try:
+            size = os.stat(path).st_size
+        except OSError:
+            size = 0
+        files.append((-size, get_shard_key(path, base), path))
+    files.sort()
+
+    totals = [(0, shard) for shard in range(count)]
+    for size, key, path in files:
+        total, shard = heapq.heappop(totals)
+        heapq.heappush(totals, (total - size, shard))
+        if shard == index:
+            yield path
+
+
+class Crc32:
+    """
+    Wraps zlib.crc32 in the same interface as the hashlib objects so it
+    can be fed alongside them in HashHandler.get_digests()
+    """
+
     def __init__(self) -> None:
+        self.value: int = 0
+
+    def update(self, data) -> None:
+        self.value = zlib.crc32(data, self.value)
+
+    def hexdigest(self) -> str:
+        return f"{self.value:08x}"
+
+
+def new_hasher(algo: str):
+    # "crc" follows the attribute name used in datfiles
+    if algo == "crc":
+        return Crc32()
+    return hashlib.new(algo)
+
+
+def new_hashers(algos) -> dict:
+    return {algo: new_hasher(algo) for algo in algos}
+
+
+def get_hexdigests(hashers: dict) -> dict:
+    return {algo: h.hexdigest() for algo, h in hashers.items()}
+
+
+class DigestWriter:
+    """
+    Receives the decompressed data of a 7z member from py7zr and feeds it
+    straight to the hashers, nothing is kept in memory or written to disk.
+    This provides the methods py7zr expects of a Py7zIO object.
+    """
+
+    def __init__(self, handler, algos) -> None:
+        self.handler = handler
+        self.hashers: dict = new_hashers(algos)
+        self.written: int = 0
+
+    def write(self, s) -> int:
+        self.handler.update(self.hashers, s)
+        self.written += len(s)
+        return len(s)
+
+    def read(self, size=None) -> bytes:
+        return b""
+
+    def seek(self, offset, whence=0) -> int:
+        return 0
+
+    def flush(self) -> None:
+        pass
+
+    def close(self) -> None:
+        pass
+
+    def size(self) -> int:
+        return self.written
+
+
+class DigestWriterFactory:
+    """
+    Creates a DigestWriter for each member py7zr decompresses
+    """
+
+    def __init__(self, handler, algos) -> None:
+        self.handler = handler
+        self.algos = algos
+        self.writers: dict = {}
+
+    def create(self, filename: str) -> DigestWriter:
+        writer = DigestWriter(self.handler, self.algos)
+        self.writers[filename] = writer
+        return writer
+
+
+class HashHandler:
+    def __init__(self, buffer_size: int = None, use_mmap: bool = False) -> None:
         self.read_bytes: int = 0
         self.status: str = ""
+        self.buffer_size: int = buffer_size
+        self.use_mmap: bool = use_mmap
+        # Seconds spent in each phase, see timed()
+        self.hash_time: float = 0.0
+        self.read_time: float = 0.0
+        self.extract_time: float = 0.0
         # self.tmp_dir = tmpdir
         # self.progress = pbar
         # self.task = task
 
+    def update(self, hashers: dict, chunk) -> None:
+        start = perf_counter()
+        for h in hashers.values():
+            h.update(chunk)
+        self.hash_time += perf_counter() - start
+        self.read_bytes += len(chunk)
+
+    @contextmanager
+    def timed(self, counter: str):
+        """
+        Adds the time spent in the block to counter, less any time spent
+        hashing, so reading a file and decompressing an archive are timed
+        apart from the hashers they feed
+        """
+        start, hashed = perf_counter(), self.hash_time
+        try:
+            yield
+        finally:
+            elapsed = perf_counter() - start - (self.hash_time - hashed)
+            setattr(self, counter, getattr(self, counter) + elapsed)
+
     def get_digest(self, rom, algo) -> str:
-        h = hashlib.new(algo)
+        return self.get_digests(rom, [algo])[algo]
+
+    def get_digests(self, rom, algos) -> dict:
+        """
+        Reads the file once and feeds every chunk to a hasher for each of
+        the requested algorithms (any of crc, md5, sha1, sha256).
+        Returns a dict in the form {algo:hexdigest}
+        """
         # self.progress.update(self.task, completed=0)
+        with self.timed("read_time"), open_source(rom, buffering=0) as f:
+            if not hasattr(f, "fileno"):
+                return self.get_stream_digests(f, algos, getattr(rom, "size", None))
+
+            file_size = os.fstat(f.fileno()).st_size
+            advise_sequential(f.fileno())
+            if self.use_mmap and file_size > 0:
+                return self.get_mmap_digests(f, algos, file_size)
+            return self.get_stream_digests(f, algos, file_size)
+
+    def get_stream_digests(self, f, algos, file_size: int = None) -> dict:
+        """
+        Reads with readinto() into the thread's reusable buffer, so no new
+        bytes object is allocated per chunk. Works with any binary stream,
+        including archive members opened with ZipFile.open().
+        """
+        hashers = new_hashers(algos)
+        buf = get_read_buffer(self.buffer_size or get_buffer_size(file_size))
+        while n := f.readinto(buf):
+            self.update(hashers, buf[:n])
+
+        return get_hexdigests(hashers)
+
+    def get_mmap_digests(self, f, algos, file_size: int) -> dict:
+        """
+        Maps the file into memory and hashes it in place, the data is fed to
+        the hashers in buffer sized slices so each slice is still in the CPU
+        cache when the next hasher reads it
+        """
+        hashers = new_hashers(algos)
+        step = self.buffer_size or get_buffer_size(file_size)
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+            if hasattr(m, "madvise"):
+                m.madvise(mmap.MADV_SEQUENTIAL)
+            with memoryview(m) as view:
+                for offset in range(0, file_size, step):
+                    with view[offset : offset + step] as chunk:
+                        self.update(hashers, chunk)
+
+        return get_hexdigests(hashers)
+
+    def get_archive_digests(self, rom, algos, skip=None) -> dict:
+        """
+        Decompresses every member of a zip or 7z archive straight into the
+        hashers without extracting anything to disk.
+        Returns a dict in the form {member:{algo:hexdigest}}, a member which
+        could not be decompressed (bad CRC, truncated data) maps to None.
+        skip is an optional callable taking the member name and uncompressed
+        size, members it returns True for are not decompressed and map to
+        {SKIPPED_SIZE:size}.
+        """
+        skip = skip or (lambda name, size: False)
+        path = Path(get_source_path(rom))
+        errors = get_archive_errors(path.suffix)
+        try:
+            with self.timed("extract_time"), open_source(rom) as f:
+                if path.suffix == ".zip":
+                    return self.get_zip_digests(f, algos, skip)
+                elif path.suffix == ".7z":
+                    return self.get_7z_digests(f, algos, skip)
+        except errors:
+            # The archive itself can't be read, it is reported under its own name
+            return {path.name: None}
+
+        return {}
+
+    def get_zip_digests(self, archive, algos, skip) -> dict:
+        from zipfile import BadZipFile, ZipFile
+
+        members = {}
+        with ZipFile(archive, "r") as z:
+            for info in z.infolist():
+                if info.is_dir():
+                    continue
+                if skip(info.filename, info.file_size):
+                    members[info.filename] = {SKIPPED_SIZE: info.file_size}
+                    continue
+                try:
+                    with z.open(info) as f:
+                        members[info.filename] = self.get_stream_digests(f, algos)
+                except DECOMPRESS_ERRORS + (
+                    BadZipFile,
+                    RuntimeError,
+                    NotImplementedError,
+                ):
+                    members[info.filename] = None
+
+        return members
+
+    def get_7z_digests(self, archive, algos, skip) -> dict:
+        # py7zr decompresses every member in a single call, so a failure
+        # part way through leaves all of the members without a result
+        from py7zr import SevenZipFile
+        from py7zr.exceptions import (
+            ArchiveError,
+            Bad7zFile,
+            CrcError,
+            PasswordRequired,
+        )
+
+        factory = DigestWriterFactory(self, algos)
+        with SevenZipFile(archive, "r") as z:
+            files = [f for f in z.list() if not f.is_directory]
+            names = [f.filename for f in files]
+            skipped = {
+                f.filename: f.uncompressed
+                for f in files
+                if skip(f.filename, f.uncompressed)
+            }
+            targets = [name for name in names if name not in skipped]
+            try:
+                if targets:
+                    z.extract(targets=targets, factory=factory)
+            except DECOMPRESS_ERRORS + (
+                ArchiveError,
+                Bad7zFile,
+                CrcError,
+                PasswordRequired,
+            ):
+                return {name: None for name in names}
+
+        members = {}
+        for name in names:
+            writer = factory.writers.get(name)
+            if name in skipped:
+                members[name] = {SKIPPED_SIZE: skipped[name]}
+            else:
+                members[name] = get_hexdigests(writer.hashers) if writer else None
+
+        return members
+
+    def get_archive_info(self, rom) -> dict:
+        """
+        Reads the CRC32 and uncompressed size of every member from the
+        archive headers (the zip central directory or the 7z header) without
+        decompressing anything.
+        Returns a dict in the form {member:(crc, size)}, crc is None where
+        the archive doesn't store one, or None if the archive can't be read.
+        """
+        members = {}
+        suffix = Path(get_source_path(rom)).suffix
+        errors = get_archive_errors(suffix)
+        try:
+            with self.timed("extract_time"), open_source(rom) as f:
+                if suffix == ".zip":
+                    from zipfile import ZipFile
+
+                    with ZipFile(f, "r") as z:
+                        for info in z.infolist():
+                            if not info.is_dir():
+                                members[info.filename] = (
+                                    f"{info.CRC:08x}",
+                                    info.file_size,
+                                )
+
+                elif suffix == ".7z":
+                    from py7zr import SevenZipFile
 
-        with open(rom, "rb") as f:
-            while chunk := f.read(CHUNK_SIZE):
-                h.update(chunk)
-                self.read_bytes += len(chunk)
+                    with SevenZipFile(f, "r") as z:
+                        for info in z.list():
+                            if not info.is_directory:
+                                crc = (
+                                    f"{info.crc32:08x}"
+                                    if info.crc32 is not None
+                                    else None
+                                )
+                                members[info.filename] = (crc, info.uncompressed)
+        except errors:
+            return None
 
-        return h.hexdigest()
+        return members
 
     def compare_checksum(self, rom, digest, algo) -> bool:
         return self.get_digest(rom, algo) == digest
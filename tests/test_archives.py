@@ -0,0 +1,81 @@
+"""
+DATCHK
+A command line datfile parser and rom validator written in python.
+
+Written By: Daws
+"""
+
+from datchk import Checker, load_dat
+from datchk.utilities import HashHandler
+
+import hashlib
+import zipfile
+
+import py7zr
+import pytest
+
+# Incompressible data, so the compressed stream is far bigger than the headers
+DATA = b"".join(hashlib.sha256(str(i).encode()).digest() for i in range(8192))
+MD5 = hashlib.md5(DATA).hexdigest()
+
+
+def corrupt(path, start: int) -> None:
+    # Flips bytes of the compressed stream, the archive headers stay readable
+    data = bytearray(path.read_bytes())
+    for i in range(start, start + 64):
+        data[i] ^= 0x5A
+    path.write_bytes(data)
+
+
+def make_archive(path, corrupted: bool = False):
+    if path.suffix == ".zip":
+        with zipfile.ZipFile(path, "w", zipfile.ZIP_DEFLATED) as z:
+            z.writestr("Game.bin", DATA)
+        # The deflate stream follows the 30 byte local header and the member
+        # name, damaging its first block raises zlib.error
+        start = 30 + len("Game.bin")
+    else:
+        with py7zr.SevenZipFile(path, "w") as z:
+            z.writestr(DATA, "Game.bin")
+        # The packed stream follows the 32 byte signature header, damaging
+        # its start raises LZMAError
+        start = 32
+    if corrupted:
+        corrupt(path, start)
+    return path
+
+
+@pytest.fixture
+def datfile(tmp_path):
+    path = tmp_path / "test.dat"
+    path.write_text(
+        '<?xml version="1.0"?>\n<datafile><header><name>Test</name></header>'
+        f'<game name="Game"><description>Game</description><rom name="Game.bin" '
+        f'size="{len(DATA)}" md5="{MD5}"/></game></datafile>\n'
+    )
+    return path
+
+
+@pytest.mark.parametrize("suffix", [".zip", ".7z"])
+def test_archive_digests(tmp_path, suffix):
+    archive = make_archive(tmp_path / f"Game{suffix}")
+    assert HashHandler().get_archive_digests(archive, ["md5"]) == {
+        "Game.bin": {"md5": MD5}
+    }
+
+
+@pytest.mark.parametrize("suffix", [".zip", ".7z"])
+def test_corrupt_member_maps_to_none(tmp_path, suffix):
+    archive = make_archive(tmp_path / f"Game{suffix}", corrupted=True)
+    assert HashHandler().get_archive_digests(archive, ["md5"]) == {"Game.bin": None}
+
+
+@pytest.mark.parametrize("suffix", [".zip", ".7z"])
+def test_corrupt_archive_doesnt_stop_check(tmp_path, datfile, suffix):
+    good = make_archive(tmp_path / f"Good{suffix}")
+    bad = make_archive(tmp_path / f"Bad{suffix}", corrupted=True)
+    dat = load_dat(datfile, use_index=False)
+    with Checker(dat) as checker:
+        results = {result.path: result.ocode for result in checker.check([bad, good])}
+    assert results[str(good)] == "PASS"
+    assert results[str(bad)] != "PASS"
@@ -0,0 +1,83 @@
+"""
+DATCHK
+A command line datfile parser and rom validator written in python.
+
+Written By: Daws
+"""
+
+from datchk import Checker, load_dat
+
+import hashlib
+import zipfile
+
+import py7zr
+import pytest
+
+GAME = b"game data"
+README = b"not in the datfile"
+
+
+@pytest.fixture
+def datfile(tmp_path):
+    path = tmp_path / "test.dat"
+    path.write_text(
+        '<?xml version="1.0"?>\n<datafile><header><name>Test</name></header>'
+        '<game name="Game"><description>Game</description><rom name="Game.bin" '
+        f'size="{len(GAME)}" md5="{hashlib.md5(GAME).hexdigest()}"/></game></datafile>\n'
+    )
+    return path
+
+
+def make_archive(path):
+    # An extra member whose name and size aren't in the datfile
+    if path.suffix == ".zip":
+        with zipfile.ZipFile(path, "w") as z:
+            z.writestr("Game.bin", GAME)
+            z.writestr("readme.txt", README)
+    else:
+        with py7zr.SevenZipFile(path, "w") as z:
+            z.writestr(GAME, "Game.bin")
+            z.writestr(README, "readme.txt")
+    return path
+
+
+def check(dat, path, cache) -> dict:
+    with Checker(dat, cache=cache) as checker:
+        results = checker.check_file(path)
+    return {r.filename: (r.ocode, r.cached) for r in results}
+
+
+@pytest.mark.parametrize("suffix", [".zip", ".7z"])
+def test_archive_with_skipped_member_is_cached(tmp_path, datfile, suffix):
+    archive = make_archive(tmp_path / f"Game{suffix}")
+    dat = load_dat(datfile, use_index=False)
+    cache = tmp_path / "hashes.db"
+
+    assert check(dat, archive, cache) == {
+        "Game.bin": ("PASS", False),
+        "readme.txt": ("NIDF", False),
+    }
+    assert check(dat, archive, cache) == {
+        "Game.bin": ("PASS", True),
+        "readme.txt": ("NIDF", True),
+    }
+
+
+def test_skipped_member_is_hashed_once_datfile_has_its_size(tmp_path, datfile):
+    archive = make_archive(tmp_path / "Game.zip")
+    cache = tmp_path / "hashes.db"
+    check(load_dat(datfile, use_index=False), archive, cache)
+
+    # The readme now has the size of an entry, so the cached marker can't
+    # answer for it any more
+    datfile.write_text(
+        datfile.read_text().replace(
+            "</datafile>",
+            f'<game name="Other"><description>Other</description><rom name="Other.bin" '
+            f'size="{len(README)}" md5="{hashlib.md5(README).hexdigest()}"/></game></datafile>',
+        )
+    )
+    assert check(load_dat(datfile, use_index=False), archive, cache) == {
+        "Game.bin": ("PASS", False),
+        "readme.txt": ("PBIN", False),
+    }
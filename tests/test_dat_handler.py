@@ -0,0 +1,113 @@
+"""
+DATCHK
+A command line datfile parser and rom validator written in python.
+
+Written By: Daws
+"""
+
+from datchk import DatParser, DatSet
+from datchk.__main__ import main
+from datchk.dat_handler import is_index_stale
+
+import hashlib
+import json
+
+import pytest
+
+TRACKS = {"Disc (Track 1).bin": b"track one", "Disc (Track 2).bin": b"track two"}
+
+
+def write_dat(path, games: dict) -> None:
+    """
+    Writes a datfile from {game:{rom name:data}}
+    """
+    body = "".join(
+        f'<game name="{game}"><description>{game}</description>'
+        + "".join(
+            f'<rom name="{name}" size="{len(data)}" md5="{hashlib.md5(data).hexdigest()}"/>'
+            for name, data in roms.items()
+        )
+        + "</game>"
+        for game, roms in games.items()
+    )
+    path.write_text(
+        '<?xml version="1.0"?>\n<datafile><header><name>Test</name></header>'
+        f"{body}</datafile>\n"
+    )
+
+
+def test_rom_of_multi_rom_game_passes_check(tmp_path):
+    write_dat(tmp_path / "test.dat", {"Disc": TRACKS})
+    roms = tmp_path / "roms"
+    roms.mkdir()
+    for name, data in TRACKS.items():
+        (roms / name).write_bytes(data)
+
+    output = tmp_path / "results.ndjson"
+    main(
+        ["-f", str(tmp_path / "test.dat"), "-c", str(roms), "--no-index"]
+        + ["--output", "ndjson", "--output-file", str(output)]
+    )
+    records = [json.loads(line) for line in output.read_text().splitlines()]
+    assert sorted((r["status"], r["matched_by"]) for r in records) == [
+        ("PASS", "name")
+    ] * 2
+
+
+@pytest.mark.parametrize("use_index", [False, True])
+def test_datset_finds_entry_of_first_datfile(tmp_path, use_index):
+    first, second = tmp_path / "first.dat", tmp_path / "second.dat"
+    write_dat(first, {"Shared": {"Shared.bin": b"first"}, "A": {"A.bin": b"same"}})
+    write_dat(second, {"Shared": {"Shared.bin": b"second"}, "B": {"B.bin": b"same"}})
+    same = hashlib.md5(b"same").hexdigest()
+
+    # The second load of each set is read from the merged index
+    for _ in range(2 if use_index else 1):
+        dats = DatSet([first, second], tmp_path / "index", use_index)
+        assert dats.find_rom_by_name("Shared.bin").dat == first
+        assert dats.find_rom_by_name("B.bin").dat == second
+        assert dats.find_rom_by_digest(same, "md5").name == "A.bin"
+        assert len(dats.get_rom_nodes_from_size(4)) == 2
+        assert dats.entries == 4
+    assert dats.loaded_from_index == use_index
+
+    dats = DatSet([second, first], tmp_path / "index", use_index)
+    assert dats.find_rom_by_name("Shared.bin").dat == second
+    assert dats.find_rom_by_digest(same, "md5").name == "B.bin"
+
+
+def test_index_is_stale_once_its_datfile_changes(tmp_path):
+    datfile = tmp_path / "test.dat"
+    write_dat(datfile, {"Game": {"Game.bin": b"game"}})
+    dat = DatParser(datfile, tmp_path / "index")
+    assert not is_index_stale(dat.index_path)
+    assert DatParser(datfile, tmp_path / "index").loaded_from_index
+
+    write_dat(datfile, {"Game": {"Game.bin": b"game"}, "New": {"New.bin": b"new"}})
+    assert is_index_stale(dat.index_path)
+    assert not DatParser(datfile, tmp_path / "index").loaded_from_index
+    assert not is_index_stale(dat.index_path)
+
+    datfile.unlink()
+    assert is_index_stale(dat.index_path)
+    (tmp_path / "junk.idx").write_bytes(b"not an index")
+    assert is_index_stale(tmp_path / "junk.idx")
+
+
+def test_saving_an_index_prunes_stale_ones(tmp_path):
+    index_dir = tmp_path / "index"
+    kept, removed = tmp_path / "kept.dat", tmp_path / "removed.dat"
+    for datfile in [kept, removed]:
+        write_dat(datfile, {"Game": {"Game.bin": b"game"}})
+    kept_index = DatParser(kept, index_dir).index_path
+    removed_index = DatParser(removed, index_dir).index_path
+    removed_index.with_suffix(".sidx").write_bytes(b"")
+    (index_dir / "junk.idx").write_bytes(b"not an index")
+    (index_dir / "notes.txt").write_text("not ours")
+
+    removed.unlink()
+    write_dat(tmp_path / "new.dat", {"New": {"New.bin": b"new"}})
+    new_index = DatParser(tmp_path / "new.dat", index_dir).index_path
+    assert sorted(p.name for p in index_dir.iterdir()) == sorted(
+        [kept_index.name, new_index.name, "notes.txt"]
+    )
@@ -0,0 +1,73 @@
+"""
+DATCHK
+A command line datfile parser and rom validator written in python.
+
+Written By: Daws
+"""
+
+from datchk import Rom, RomResult
+from datchk.manifest import Manifest, get_settings
+
+import os
+
+import pytest
+
+SETTINGS = get_settings((("test.dat", 1, 2),), "md5", False)
+
+
+@pytest.fixture
+def rom_file(tmp_path):
+    path = tmp_path / "Game.bin"
+    path.write_bytes(b"game")
+    return path
+
+
+def get_result(path, ocode: str) -> RomResult:
+    rom = Rom("Game.bin", "4", None, None, None, None, None, None, "Game", "test.dat")
+    return RomResult(str(path), path.name, ocode=ocode, rom=rom)
+
+
+def test_passed_file_is_kept_until_it_changes(tmp_path, rom_file):
+    manifest = Manifest(tmp_path / "manifest.db", SETTINGS)
+    manifest.put([get_result(rom_file, "PASS")])
+    entries = [("test.dat", "Game", "Game.bin")]
+    assert manifest.get_unchanged(rom_file) == entries
+    manifest.close()
+
+    manifest = Manifest(tmp_path / "manifest.db", SETTINGS)
+    assert manifest.get_unchanged(rom_file) == entries
+    st = rom_file.stat()
+    os.utime(rom_file, ns=(st.st_atime_ns, st.st_mtime_ns + 1_000_000_000))
+    assert manifest.get_unchanged(rom_file) is None
+    manifest.close()
+
+
+def test_other_settings_check_every_file_again(tmp_path, rom_file):
+    manifest = Manifest(tmp_path / "manifest.db", SETTINGS)
+    manifest.put([get_result(rom_file, "PASS")])
+    manifest.close()
+
+    for settings in [
+        get_settings((("test.dat", 1, 3),), "md5", False),
+        get_settings((("test.dat", 1, 2),), "sha1", False),
+        get_settings((("test.dat", 1, 2),), "md5", True),
+    ]:
+        manifest = Manifest(tmp_path / "manifest.db", settings)
+        assert manifest.get_unchanged(rom_file) is None
+        manifest.close()
+
+
+def test_failed_and_missing_files_are_checked_again(tmp_path, rom_file):
+    manifest = Manifest(tmp_path / "manifest.db", SETTINGS)
+    manifest.put([get_result(rom_file, "PASS")])
+    manifest.put([get_result(rom_file, "FAIL")])
+    assert manifest.get_unchanged(rom_file) is None
+    manifest.close()
+
+    manifest = Manifest(tmp_path / "manifest.db", SETTINGS)
+    assert manifest.get_unchanged(rom_file) is None
+    manifest.put([get_result(rom_file, "PASS")])
+    rom_file.unlink()
+    assert manifest.get_unchanged(rom_file) is None
+    assert manifest.prune() == 1
+    manifest.close()
@@ -0,0 +1,46 @@
+"""
+DATCHK
+A command line datfile parser and rom validator written in python.
+
+Written By: Daws
+"""
+
+from datchk.__main__ import main
+from datchk.pipeline import Prefetcher
+
+import hashlib
+from os.path import basename
+
+GAME = b"game data"
+
+
+def test_prefetch_skips_files_the_check_wont_read(tmp_path, monkeypatch):
+    (tmp_path / "test.dat").write_text(
+        '<?xml version="1.0"?>\n<datafile><header><name>Test</name></header>'
+        '<game name="Game"><description>Game</description><rom name="Game.bin" '
+        f'size="{len(GAME)}" md5="{hashlib.md5(GAME).hexdigest()}"/></game></datafile>\n'
+    )
+    roms = tmp_path / "roms"
+    roms.mkdir()
+    (roms / "Game.bin").write_bytes(GAME)
+    # Neither the name nor the size of this file is in the datfile
+    (roms / "Other.bin").write_bytes(b"other")
+
+    read = []
+    prefetch_read = Prefetcher.read
+
+    def record_read(self, prefetched):
+        read.append(basename(prefetched.path))
+        prefetch_read(self, prefetched)
+
+    monkeypatch.setattr(Prefetcher, "read", record_read)
+    argv = ["-f", str(tmp_path / "test.dat"), "-c", str(roms), "--no-index"]
+    argv += ["--prefetch", "2", "--cache", str(tmp_path / "hashes.db")]
+
+    main(argv)
+    assert read == ["Game.bin"]
+
+    # Everything is answered by the hash cache the second time
+    read.clear()
+    main(argv)
+    assert read == []
@@ -0,0 +1,103 @@
+"""
+DATCHK
+A command line datfile parser and rom validator written in python.
+
+Written By: Daws
+"""
+
+from datchk.__main__ import main
+from datchk.rename import Rename, RenamePlan
+
+from os.path import basename
+import hashlib
+
+
+def test_rename_to_own_name_is_dropped(tmp_path):
+    path = tmp_path / "Game.bin"
+    path.write_bytes(b"game")
+    plan = RenamePlan([Rename(str(path), "Game.bin")])
+    assert plan.renames == []
+    assert plan.cycles == 0
+    assert plan.apply() == []
+    assert path.read_bytes() == b"game"
+
+
+def test_renamed_files_pass_in_the_report(tmp_path, capsys):
+    data = b"game"
+    (tmp_path / "test.dat").write_text(
+        '<?xml version="1.0"?>\n<datafile><header><name>Test</name></header>'
+        '<game name="Game"><description>Game</description><rom name="Game.bin" '
+        f'size="{len(data)}" md5="{hashlib.md5(data).hexdigest()}"/></game></datafile>\n'
+    )
+    roms = tmp_path / "roms"
+    roms.mkdir()
+    (roms / "Wrong.bin").write_bytes(data)
+
+    main(["-f", str(tmp_path / "test.dat"), "-c", str(roms), "-r", "--no-index"])
+    out = capsys.readouterr().out
+    assert (roms / "Game.bin").read_bytes() == data
+    assert "Suggested Name" not in out
+    assert "All files passed" in out
+
+
+def write_files(path, names) -> list:
+    for name in names:
+        (path / name).write_bytes(name.encode())
+    return [str(path / name) for name in names]
+
+
+def test_cycles_are_renamed_through_temporary_names(tmp_path):
+    a, b, c, d, e = write_files(tmp_path, ["A", "B", "C", "D", "E"])
+    renames = [
+        Rename(a, "B"),
+        Rename(b, "A"),
+        Rename(c, "D"),
+        Rename(d, "E"),
+        Rename(e, "C"),
+    ]
+    plan = RenamePlan(renames)
+    assert plan.cycles == 2
+    assert plan.skipped == []
+    assert all(rename.in_cycle for rename in plan.renames)
+
+    assert len(plan.apply()) == 5
+    for name, old in zip("ABCDE", "BAECD"):
+        assert (tmp_path / name).read_bytes() == old.encode()
+    assert sorted(p.name for p in tmp_path.iterdir()) == list("ABCDE")
+
+
+def test_blocked_targets_skip_the_renames_waiting_on_them(tmp_path):
+    a, b, c, d, _ = write_files(tmp_path, ["A", "B", "C", "D", "Kept"])
+    renames = [
+        # Kept isn't renamed, so A can't take its name and B can't take A's
+        Rename(a, "Kept"),
+        Rename(b, "A"),
+        # Nothing holds New, but two files want it
+        Rename(c, "New"),
+        Rename(d, "New"),
+    ]
+    plan = RenamePlan(renames)
+    reasons = {basename(rename.path): rename.reason for rename in plan.renames}
+    assert reasons == {
+        "A": "a file with the new name already exists",
+        "B": "a file with the new name already exists",
+        "C": "another file would get the same name",
+        "D": "another file would get the same name",
+    }
+    assert plan.cycles == 0
+    assert plan.apply() == []
+    for name in ["A", "B", "C", "D", "Kept"]:
+        assert (tmp_path / name).read_bytes() == name.encode()
+
+
+def test_chain_ending_in_a_free_name_is_not_a_cycle(tmp_path):
+    a, b = write_files(tmp_path, ["A", "B"])
+    plan = RenamePlan([Rename(a, "B"), Rename(b, "C")])
+    assert plan.cycles == 0
+    assert not any(rename.in_cycle for rename in plan.renames)
+    assert sorted(new for old, new in plan.apply()) == [
+        str(tmp_path / "B"),
+        str(tmp_path / "C"),
+    ]
+    assert (tmp_path / "B").read_bytes() == b"A"
+    assert (tmp_path / "C").read_bytes() == b"B"
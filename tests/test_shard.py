@@ -0,0 +1,99 @@
+"""
+DATCHK
+A command line datfile parser and rom validator written in python.
+
+Written By: Daws
+"""
+
+from datchk.__main__ import main
+from datchk.output import read_records
+from datchk.utilities import get_shard_key, shard_by_hash, shard_by_size
+
+import hashlib
+import shutil
+
+import pytest
+
+ROMS = {f"Game {i}.bin": f"game {i}".encode() for i in range(20)}
+
+
+@pytest.fixture
+def datfile(tmp_path):
+    path = tmp_path / "test.dat"
+    path.write_text(
+        '<?xml version="1.0"?>\n<datafile><header><name>Test</name></header>'
+        + "".join(
+            f'<game name="{name[:-4]}"><description>{name[:-4]}</description>'
+            f'<rom name="{name}" size="{len(data)}" md5="{hashlib.md5(data).hexdigest()}"/></game>'
+            for name, data in ROMS.items()
+        )
+        + "</datafile>\n"
+    )
+    return path
+
+
+@pytest.fixture
+def collection(tmp_path):
+    path = tmp_path / "node-a" / "roms"
+    (path / "sub").mkdir(parents=True)
+    for i, (name, data) in enumerate(ROMS.items()):
+        (path / ("sub" if i % 2 else "") / name).write_bytes(data)
+    return path
+
+
+def check_shard(datfile, path, shard: str, output) -> None:
+    main(
+        ["-f", str(datfile), "-c", str(path), "-R", "--shard", shard, "--no-index"]
+        + ["--output", "ndjson", "--output-file", str(output)]
+    )
+
+
+def test_merge_dedupes_shards_mounted_in_different_places(
+    tmp_path, datfile, collection, capsys
+):
+    # The same collection mounted somewhere else on a second machine
+    mirror = tmp_path / "mnt" / "node-b" / "roms"
+    shutil.copytree(collection, mirror)
+
+    check_shard(datfile, collection, "1/2", tmp_path / "a.ndjson")
+    check_shard(datfile, mirror, "2/2", tmp_path / "b.ndjson")
+    # Shard 1 checked again on the second machine overlaps the first
+    check_shard(datfile, mirror, "1/2", tmp_path / "c.ndjson")
+    capsys.readouterr()
+
+    merged = tmp_path / "merged.ndjson"
+    main(
+        ["merge"]
+        + [str(tmp_path / f"{name}.ndjson") for name in "abc"]
+        + ["--output", "ndjson", "--output-file", str(merged)]
+    )
+    out = capsys.readouterr().out
+    records = list(read_records(merged))
+    assert len(records) == len(ROMS)
+    assert sorted(r["relpath"] for r in records) == sorted(
+        ("sub/" if i % 2 else "") + name for i, name in enumerate(ROMS)
+    )
+    assert all(r["status"] == "PASS" for r in records)
+    shard_1 = len(list(read_records(tmp_path / "c.ndjson")))
+    assert f"Skipped {shard_1} results found in more than one file" in out
+
+
+@pytest.mark.parametrize("shard", [shard_by_hash, shard_by_size])
+def test_shards_split_the_same_from_any_mount(tmp_path, collection, shard):
+    mirror = tmp_path / "mnt" / "node-b" / "roms"
+    shutil.copytree(collection, mirror)
+
+    def split(base, reverse: bool = False) -> list:
+        # The order files are scanned in differs between machines too
+        paths = sorted(map(str, base.rglob("*.bin")), reverse=reverse)
+        return [
+            {get_shard_key(path, base) for path in shard(paths, index, 3, base)}
+            for index in range(3)
+        ]
+
+    shards = split(collection)
+    assert split(mirror, reverse=True) == shards
+    assert sum(map(len, shards)) == len(ROMS)
+    assert set().union(*shards) == {
+        ("sub/" if i % 2 else "") + name for i, name in enumerate(ROMS)
+    }